@@ -1,21 +1,35 @@
 #!/usr/bin/python3
 
+from array import array
 import os
 import re
 import sys
 import time
 import argparse
 import base64
+import concurrent.futures
+import datetime
+import hashlib
+import io
 import json
 import requests
+import subprocess
 import urllib
 
 options = None  # argparse.Namespace
 
+session = None  # requests.Session, shared by all requests
+
 main_url='https://aptera.us/leaderboard/'
 
 url='https://app.powerbi.com/view?r=eyJrIjoiZGZhODZhYmUtZjQ3My00NjViLWI3OWEtYWFkNzJjYWU0MzdiIiwidCI6ImU0ZGU0MGIzLTU3ODYtNDAyMC05YjcxLWNmOTM3NjE5ZTRkNiIsImMiOjZ9'
 
+def http_session():
+    global session
+    if session is None:
+        session = requests.Session()
+    return session
+
 def find_js_var_init(varname, text):
     regex = varname + r' *= *\'(.*?)\''
     m = re.search(regex, text)
@@ -53,11 +67,14 @@ def get_APIM_url(cluster_uri):
     t[0] = t[0] + '-api'
     return f'{parsed.scheme}://{".".join(t)}'
 
-def fetch_data():
+# Resolve the Power BI session parameters needed to query the data:
+# the tenant and resource key from the iframe URL, and the variables
+# and request IDs set by the iframe page's Javascript.
+def bootstrap():
     global url
 
     if options.check_main_page:
-        main_page = requests.get(main_url)
+        main_page = http_session().get(main_url)
         m = re.search(r'<iframe.*nitro-lazy-src="(.*powerbi.*?)".*</iframe>', main_page.text)
         if m is None:
             sys.stderr.write('iframe source not found\n')
@@ -89,7 +106,7 @@ def fetch_data():
         with open(options.use_canned_iframe_data) as f:
             frame_data = f.read()
     else:
-        request_result = requests.get(url)
+        request_result = http_session().get(url)
         frame_data = request_result.text
 
 
@@ -130,11 +147,6 @@ def fetch_data():
     if options.verbose > 1:
         print(f'req_map = {req_map}')
 
-    headers = xhr_request_headers(vmap['telemetrySessionId'],
-                                  req_map['resolveCluster'],
-                                  resource_key)
-
-    headers['referer'] = url
     # u = f'{get_APIM_url(vmap["resolvedClusterUri"])}{vmap["routingUrl"]}{tenant_id}'
     # print(f'URL={u}')
     # conn = requests.get(u, headers=headers)
@@ -142,9 +154,90 @@ def fetch_data():
     # print(f'conn.headers = {conn.headers}')
     # print(f'conn.status_code = {conn.status_code}')
 
-    u = f'{get_APIM_url(vmap["resolvedClusterUri"])}{vmap["queryDataUrl"]}?synchronous=true'
+    return {
+        'saved_at': time.time(),
+        'url': url,
+        'tenant_id': tenant_id,
+        'resource_key': resource_key,
+        'vmap': vmap,
+        'req_map': req_map,
+        'apim_url': get_APIM_url(vmap['resolvedClusterUri']),
+    }
+
+# The bootstrap is cached in a JSON file, so that a poll can skip the
+# page downloads and scans.  A cached bootstrap older than ttl seconds
+# (or for another iframe URL, unless -c may have changed it) is not
+# used.
+def load_bootstrap(fn, ttl):
+    try:
+        with open(fn) as f:
+            boot = json.load(f)
+        age = time.time() - boot['saved_at']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if age < 0 or age >= ttl:
+        return None
+    if not options.check_main_page and boot.get('url') != url:
+        return None
+    if options.verbose > 0:
+        print(f'Using bootstrap cached {age:.0f} seconds ago in {fn}')
+    return boot
+
+def save_bootstrap(fn, boot):
+    d = os.path.dirname(fn)
+    if d != '':
+        os.makedirs(d, exist_ok=True)
+    tmp = f'{fn}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(boot, f, indent=1)
+    os.replace(tmp, fn)
+
+def fresh_bootstrap():
+    boot = bootstrap()
+    if options.bootstrap_cache != '':
+        save_bootstrap(options.bootstrap_cache, boot)
+    return boot
+
+# Post the request for one window; returns the reply, or None if the
+# query failed.
+def query(boot, req, restart_tokens, n):
+    headers = xhr_request_headers(boot['vmap']['telemetrySessionId'],
+                                  boot['req_map']['resolveCluster'],
+                                  boot['resource_key'])
+    headers['referer'] = boot['url']
+    u = f'{boot["apim_url"]}{boot["vmap"]["queryDataUrl"]}?synchronous=true'
     if options.verbose > 2:
         print(f'URL={u}')
+    conn = http_session().post(u, window_request(req, restart_tokens), headers=headers)
+    if options.reply_log_file is not None:
+        with open(window_file(options.reply_log_file, n), 'wb') as f:
+            f.write(conn.content)
+    if conn.status_code != 200:
+        sys.stderr.write(f'query failed: HTTP status {conn.status_code}\n')
+        return None
+    try:
+        resp = json.loads(conn.content)
+    except ValueError:
+        return None
+    if not isinstance(resp, dict) or 'results' not in resp:
+        return None
+    return resp
+
+# Returns a function that posts the request for one window of the
+# reply, given the previous window's restart tokens (None for the
+# first) and the window number.  A bootstrap that was cached or has
+# been used before (even by a query that failed, which --watch
+# survives) is refreshed when a query using it fails, since the
+# session may have changed; it is also refreshed once it is ttl
+# seconds old (e.g., when --watch keeps using it).
+def fetch_data():
+    boot = None
+    if options.bootstrap_cache != '':
+        boot = load_bootstrap(options.bootstrap_cache, options.bootstrap_ttl)
+    may_be_stale = boot is not None
+    if boot is None:
+        boot = fresh_bootstrap()
+
     with open(options.request_file, 'rb') as f:
         req = f.read()
     # DatasetId, ReportId, VisualId are GUIDs in the request.  We are just
@@ -155,22 +248,55 @@ def fetch_data():
     # The request is obtained by using Chrome developer mode and
     # copying an actual request that was transmitted.  The "CacheKey"
     # entries is deleted.
-    conn = requests.post(u, req, headers=headers)
-    if options.reply_log_file is not None:
-        with open(options.reply_log_file, 'wb') as f:
-            f.write(conn.content)
-    return json.loads(conn.content)
-
-
-def process():
-    if options.load_xhr_response is not None:
-        if options.verbose > 0:
-            print(f'Loading canned data from file "{options.load_xhr_response}"')
-        with open(options.load_xhr_response, 'rb') as f:
-            resp = json.loads(f.read())
-    else:
-        resp = fetch_data()
+    def post(restart_tokens, n):
+        nonlocal boot, may_be_stale
+        if may_be_stale and time.time() - boot['saved_at'] >= options.bootstrap_ttl:
+            boot = fresh_bootstrap()
+            may_be_stale = False
+        resp = query(boot, req, restart_tokens, n)
+        if resp is None and may_be_stale:
+            if options.verbose > 0:
+                print('Query with an old bootstrap failed; refreshing it')
+            boot = fresh_bootstrap()
+            may_be_stale = False
+            resp = query(boot, req, restart_tokens, n)
+        may_be_stale = True
+        if resp is None:
+            sys.stderr.write('server XHR response incomplete/malformed?\n')
+            sys.exit(4)
+        return resp
+    return post
+
+# The reply only has up to the request's DataReduction window Count
+# rows.  When there are more, the reply's DS has restart tokens (RT),
+# the sort key values of its last row, and the next window is
+# requested by adding them to the request's Window as RestartTokens.
+def window_request(req, restart_tokens):
+    if restart_tokens is None and options.window_count == 0:
+        return req
+    req_json = json.loads(req)
+    for query in req_json['queries']:
+        for command in query['Query']['Commands']:
+            window = command['SemanticQueryDataShapeCommand']['Binding']['DataReduction']['Primary']['Window']
+            if options.window_count != 0:
+                window['Count'] = options.window_count
+            if restart_tokens is not None:
+                window['RestartTokens'] = restart_tokens
+    return json.dumps(req_json).encode()
+
+# Window n > 0 of a reply logged (-w) or loaded (-x) as fn goes in fn.n
+def window_file(fn, n):
+    return fn if n == 0 else f'{fn}.{n}'
+
+def load_window(restart_tokens, n):
+    fn = window_file(options.load_xhr_response, n)
+    if not os.path.isfile(fn):
+        sys.stderr.write(f'reply window {n} not found: {fn}\n')
+        sys.exit(4)
+    with open(fn, 'rb') as f:
+        return json.loads(f.read())
 
+def reply_dsr(resp):
     if 'results' not in resp:
         sys.stderr.write('server XHR response incomplete/malformed?\n')
         sys.exit(4)
@@ -183,7 +309,51 @@ def process():
     data = query_result['data']
     dsr = data['dsr']
     ds = dsr['DS']
-    ds0 = ds[0]
+    return ds[0]
+
+# The restart tokens for the window after ds0, or None if ds0 is the
+# last window (IC, is complete, is set).
+def restart_tokens(ds0):
+    if ds0.get('IC', False):
+        return None
+    return ds0.get('RT')
+
+def window_fetcher():
+    if options.load_xhr_response is not None:
+        if options.verbose > 0:
+            print(f'Loading canned data from file "{options.load_xhr_response}"')
+        return load_window
+    return fetch_data()
+
+# Fetch, decode and write the whole table to ostr.  Windows are
+# chained by their restart tokens, so they cannot be requested
+# independently; instead the next window is fetched while the current
+# one is decoded and written.  The rows are ordered by rank, so
+# writing the windows in order keeps them in rank order.
+def process(fetch_window, ostr):
+    resp = fetch_window(None, 0)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        n = 0
+        previous_tokens = None
+        while True:
+            ds0 = reply_dsr(resp)
+            tokens = restart_tokens(ds0)
+            if tokens is not None and tokens == previous_tokens:
+                sys.stderr.write(f'reply window {n} repeats the previous restart tokens\n')
+                sys.exit(4)
+            pending = None
+            if tokens is not None:
+                pending = executor.submit(fetch_window, tokens, n + 1)
+            process_window(ds0, ostr)
+            if pending is None:
+                break
+            resp = pending.result()
+            previous_tokens = tokens
+            n += 1
+
+# Decode and write one window of rows.  Each window has its own
+# ValueDicts.
+def process_window(ds0, ostr):
     row_data = ds0['PH']  # encoded
     # row_data[0]['DM0'] is list of row data
     #  "C" key to list:
@@ -192,56 +362,98 @@ def process():
 
     value_dicts = ds0['ValueDicts']
 
-    country_codes = value_dicts['D0']
-    initials = value_dicts['D1']
-    states = value_dicts['D2']
-    investment_ids = value_dicts['D3']
-
-    parsed = []
-    rnum = 0
-    v = {}
-    for row in row_data[0]['DM0']:
+    columns = decode_rows(row_data[0]['DM0'])
+    write_rows(ostr, columns, value_dicts)
+
+# The leaderboard columns, in the order the DSR rows encode them, and
+# the ValueDicts the indexed ones are looked up in.
+fields = ['rank', 'country', 'timestamp', 'inits', 'st', 'inv', 'accel', 'alltime']
+field_dicts = {'country': 'D0', 'inits': 'D1', 'st': 'D2', 'inv': 'D3'}
+# array typecodes for the numeric columns
+field_types = {'rank': 'q', 'timestamp': 'q', 'accel': 'd', 'alltime': 'd'}
+
+# Which fields a row with bitmasks r and o_slash supplies, as a list of
+# (field index, blanked) pairs.  r appears to be binary encoded for
+# which is NOT updated from the previous entry, so r=0 means everything
+# is present and r&1 means rank is the same (which will never occur),
+# and r&2 means country is the same.  o_slash are entries that are
+# blanked, rather than inherited; a blanked entry does not use up a
+# value in the row's 'C' list.
+def row_plan(r, o_slash):
+    plan = []
+    for ix in range(len(fields)):
+        omit = (o_slash & 1) != 0
+        o_slash = o_slash // 2
+        take = (r & 1) == 0
+        r = r // 2
+        if take:
+            plan.append((ix, omit))
+    return plan
+
+# Decode the compressed DSR rows into one column per field.  Rows only
+# differ in which fields they supply, and few combinations occur, so
+# the bitmasks are decoded once per combination; the decoded rows are
+# transposed into columns in one go, and the numeric columns are
+# packed into typed arrays (unless they hold blanks or other strings).
+def decode_rows(rows):
+    plans = {}
+    values = [None] * len(fields)
+    decoded = []
+    for rnum, row in enumerate(rows):
         if options.verbose > 1:
             print(f'{rnum}: {row}')
-        rnum = rnum + 1
+        masks = (row.get('R', 0), row.get('Ø', 0))
+        plan = plans.get(masks)
+        if plan is None:
+            plan = plans[masks] = row_plan(*masks)
         record = row['C']
-        r = row.get('R', 0)
-        o_slash = row.get('Ø', 0)
-        country = 0  # US default?
-
-        uncertain=''  # when decode is uncertain, change to visible marker
-
-        # r appears to be binary encoded for which is NOT updated
-        # from the previous entry, so r=0 means everything is present
-        # and r&1 means rank is the same (which will never occur), and
-        # r&2 means country is the same
-        #
-        # o_slash are entries that are blanked, rather than inherited
-
-        fields = ['rank', 'country', 'timestamp', 'inits', 'st', 'inv', 'accel', 'alltime']
-
-        rcopy = record[:]
-        for ix in range(len(fields)):
-            omit = (o_slash & 1) != 0
-            o_slash = o_slash // 2
-            take = (r & 1) == 0
-            r = r // 2
-            if not take:
-                continue
+        j = 0
+        for ix, omit in plan:
             if omit:
-                v[fields[ix]] = '  '
+                values[ix] = '  '
             else:
-                v[fields[ix]] = record[0]
-                record = record[1:]
+                values[ix] = record[j]
+                j += 1
+        decoded.append(tuple(values))
         if options.verbose > 1:
-            print(f'{v}')
-
-        inv_str = maybe_lookup(investment_ids, v['inv'])
-        st_str = maybe_lookup(states, v['st'])
-        init_str = maybe_lookup(initials, v['inits'])
-        country_str = maybe_lookup(country_codes, v['country'])
-
-        print(f'{v["rank"]}, {init_str}, {st_str}, {country_str}, {inv_str}, {format_time(v["timestamp"])}, "${v["accel"]:,.1f}", "${v["alltime"]:,.2f}"{uncertain}')
+            print(f'{dict(zip(fields, values))}')
+    columns = dict(zip(fields, map(list, zip(*decoded)))) if decoded else dict((f, []) for f in fields)
+    for f, typecode in field_types.items():
+        try:
+            columns[f] = array(typecode, columns[f])
+        except TypeError:
+            pass
+    return columns
+
+# Look up a whole column of ValueDicts indices; values that are already
+# strings (blanks, or values sent inline) are kept as they are.
+def lookup_column(d, column):
+    try:
+        return list(map(d.__getitem__, column))
+    except TypeError:
+        return [maybe_lookup(d, k) for k in column]
+
+# Format a column of timestamps.  They are shown to the minute, so the
+# formatted string is computed once per minute.
+def format_times(column):
+    formatted = {}
+    out = []
+    for msecs in column:
+        minute = msecs // 60000
+        s = formatted.get(minute)
+        if s is None:
+            s = formatted[minute] = format_time(msecs)
+        out.append(s)
+    return out
+
+def write_rows(ostr, columns, value_dicts):
+    looked_up = dict((f, lookup_column(value_dicts[d], columns[f])) for f, d in field_dicts.items())
+    uncertain = ''  # when decode is uncertain, change to visible marker
+    ostr.writelines(
+        f'{rank}, {init_str}, {st_str}, {country_str}, {inv_str}, {time_str}, "${accel:,.1f}", "${alltime:,.2f}"{uncertain}\n'
+        for rank, init_str, st_str, country_str, inv_str, time_str, accel, alltime in zip(
+                columns['rank'], looked_up['inits'], looked_up['st'], looked_up['country'],
+                looked_up['inv'], format_times(columns['timestamp']), columns['accel'], columns['alltime']))
 
 def maybe_lookup(d, k):
     # if k is a string, that's the answer; otherwise d[k]
@@ -253,6 +465,71 @@ def format_time(msecs):
     gm = time.gmtime(msecs/1000)
     return time.strftime('%m/%d/%Y %I:%M %p', gm)
 
+# Hashes of the rows of a snapshot, to compare with the next one.
+def row_hashes(lines):
+    return [hashlib.blake2b(line.encode(), digest_size=16).digest() for line in lines]
+
+def write_snapshot(fn, lines):
+    tmp = f'{fn}.tmp'
+    with open(tmp, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmp, fn)
+
+# Keep polling the leaderboard in this process (one HTTP session, one
+# bootstrap), keeping the previous snapshot's row hashes.  When a row
+# changes, the output file is replaced (the previous one is kept as
+# .old, for show-changed.sh), a copy is written to the history
+# directory as data.<time>.csv, and the --on-change command is run.
+# The poll interval starts at min_interval, doubles after each
+# unchanged poll up to max_interval, and drops back to min_interval
+# when the data changes.  Errors are reported and back off the same
+# way.
+def watch():
+    fetch_window = window_fetcher()
+    previous = None
+    if os.path.isfile(options.output):
+        with open(options.output) as f:
+            previous = row_hashes(f.readlines())
+    old = os.path.splitext(options.output)[0] + '.old'
+    interval = options.min_interval
+    try:
+        while True:
+            ostr = io.StringIO()
+            try:
+                process(fetch_window, ostr)
+            except (OSError, ValueError, KeyError, AssertionError, SystemExit) as e:
+                interval = min(interval * 2, options.max_interval)
+                now = datetime.datetime.now().astimezone().isoformat(timespec='minutes')
+                sys.stderr.write(f'Error occurred at {now} ({e}); retrying in {interval:g}s\n')
+                time.sleep(interval)
+                continue
+            lines = ostr.getvalue().splitlines(keepends=True)
+            hashes = row_hashes(lines)
+            if hashes != previous:
+                now = datetime.datetime.now().astimezone().isoformat(timespec='seconds')
+                changed = len(set(hashes) - set(previous or []))
+                sys.stderr.write(f'\nNew investor data has arrived\a\n{now}: {changed} new or changed rows\n')
+                if os.path.isfile(options.output):
+                    os.replace(options.output, old)
+                write_snapshot(options.output, lines)
+                if options.history_dir != '':
+                    os.makedirs(options.history_dir, exist_ok=True)
+                    write_snapshot(os.path.join(options.history_dir, f'data.{now}.csv'), lines)
+                if options.on_change != '':
+                    subprocess.run(options.on_change, shell=True)
+                previous = hashes
+                interval = options.min_interval
+            else:
+                interval = min(interval * 2, options.max_interval)
+                sys.stderr.write('.')  # progress
+                if options.verbose > 0:
+                    sys.stderr.write(f'unchanged; next poll in {interval:g}s\n')
+            sys.stderr.flush()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
 def find_request_file(binary_path, fname):
     dir = os.path.dirname(binary_path)
     search = ['.', '../lib/aptera-data', '../share/aptera-data']
@@ -274,9 +551,28 @@ def main(argv):
     parser.add_argument('--request-file', '-r', type=str, default=None,
                         help='file containing XHR data query')
     parser.add_argument('--reply-log-file', '-w', type=str, default=None,
-                        help='file into which the XHR data query reply should be written')
+                        help='file into which the XHR data query reply should be written (further windows into FILE.1, FILE.2, ...)')
     parser.add_argument('--load-xhr-response', '-x', type=str, default=None,
-                        help='load test XHR response from file instead of loading from web endpoints')
+                        help='load test XHR response from file instead of loading from web endpoints (further windows from FILE.1, FILE.2, ...)')
+    parser.add_argument('--bootstrap-cache', type=str, default='',
+                        help='file in which to cache the Power BI session bootstrap between runs')
+    parser.add_argument('--bootstrap-ttl', type=float, default=3600.0,
+                        help='seconds a cached bootstrap is used before it is refreshed (also refreshed when a query fails)')
+    parser.add_argument('--window-count', type=int, default=0,
+                        help='rows per reply window (default: as in the request file); more windows are fetched as needed')
+    parser.add_argument('--watch', type=bool, default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help='keep polling, writing --output (and a history snapshot) only when the data changes')
+    parser.add_argument('--output', '-o', type=str, default='data.csv',
+                        help='file the latest data is written to (--watch)')
+    parser.add_argument('--history-dir', type=str, default='history',
+                        help='directory for a copy of every changed snapshot, or empty for none (--watch)')
+    parser.add_argument('--on-change', type=str, default='',
+                        help='shell command to run after the data changed, e.g., to copy it elsewhere (--watch)')
+    parser.add_argument('--min-interval', type=float, default=60.0,
+                        help='seconds between polls while the data is changing (--watch)')
+    parser.add_argument('--max-interval', type=float, default=300.0,
+                        help='maximum seconds between polls while the data is unchanged (--watch)')
     parser.add_argument('--verbose', '-v', action='count',
                         default=0,
                         help='increment the verbosity level by 1')
@@ -286,7 +582,12 @@ def main(argv):
         # search for data file
         fname = 'aptera-data-request.txt'
         options.request_file = find_request_file(argv[0], fname)
-    process()
+    if options.watch:
+        if options.min_interval <= 0 or options.max_interval < options.min_interval:
+            sys.stderr.write('--min-interval must be positive and at most --max-interval\n')
+            return 1
+        return watch()
+    process(window_fetcher(), sys.stdout)
     return 0
 
 if __name__ == '__main__':
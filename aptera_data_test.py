@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import aptera_data
+
+class TestDecode(unittest.TestCase):
+
+    def setUp(self):
+        aptera_data.options = argparse.Namespace(verbose=0, window_count=0, load_xhr_response=None,
+                                                 check_main_page=False, bootstrap_cache='',
+                                                 bootstrap_ttl=3600.0, request_file=None)
+        self._bootstrap = aptera_data.bootstrap
+        self._query = aptera_data.query
+
+    def tearDown(self):
+        aptera_data.bootstrap = self._bootstrap
+        aptera_data.query = self._query
+
+    def load_reply(self):
+        with open(os.path.join(os.path.dirname(__file__), 'test_data', 'reply.js'), 'rb') as f:
+            return json.loads(f.read())
+
+    def test_decode_rows(self):
+        rows = [
+            {'C': [1, 0, 1674830410010, 0, 0, 0, 10500, 1010640]},
+            # same country (R bit 1)
+            {'R': 2, 'C': [2, 1678331953637, 1, 1, 1, 10101, 434215]},
+            # country and state blanked (Ø bits 1 and 4)
+            {'Ø': 18, 'C': [3, 1676806004030, 2, 'APT-INLINE', 31500, 421500.5]},
+        ]
+        columns = aptera_data.decode_rows(rows)
+        self.assertEqual(list(columns['rank']), [1, 2, 3])
+        self.assertEqual(columns['country'], [0, 0, '  '])
+        self.assertEqual(columns['st'], [0, 1, '  '])
+        self.assertEqual(columns['inv'], [0, 1, 'APT-INLINE'])
+        self.assertEqual(list(columns['alltime']), [1010640, 434215, 421500.5])
+
+        value_dicts = {'D0': ['US', 'DE'], 'D1': ['RP', 'KW', 'GZ'], 'D2': ['MD', 'Bayern'],
+                       'D3': ['APT-CPZNPO', 'APT-DPWJQO']}
+        ostr = io.StringIO()
+        aptera_data.write_rows(ostr, columns, value_dicts)
+        self.assertEqual(ostr.getvalue().splitlines(), [
+            '1, RP, MD, US, APT-CPZNPO, 01/27/2023 02:40 PM, "$10,500.0", "$1,010,640.00"',
+            '2, KW, Bayern, US, APT-DPWJQO, 03/09/2023 03:19 AM, "$10,101.0", "$434,215.00"',
+            '3, GZ,   ,   , APT-INLINE, 02/19/2023 11:26 AM, "$31,500.0", "$421,500.50"',
+        ])
+
+    def test_reply(self):
+        resp = self.load_reply()
+        ds0 = resp['results'][0]['result']['data']['dsr']['DS'][0]
+        columns = aptera_data.decode_rows(ds0['PH'][0]['DM0'])
+        ostr = io.StringIO()
+        aptera_data.write_rows(ostr, columns, ds0['ValueDicts'])
+        lines = ostr.getvalue().splitlines()
+        self.assertEqual(len(lines), 975)
+        self.assertEqual(lines[0], '1, RP, MD, US, APT-CPZNPO, 01/27/2023 02:40 PM, "$10,500.0", "$1,010,640.00"')
+
+    # Split reply.js into windows of size rows, chained by restart
+    # tokens, each with full rows and its own ValueDicts.
+    def split_reply(self, fn, size):
+        resp = self.load_reply()
+        ds0 = resp['results'][0]['result']['data']['dsr']['DS'][0]
+        columns = aptera_data.decode_rows(ds0['PH'][0]['DM0'])
+        rows = list(zip(*(columns[f] for f in aptera_data.fields)))
+        for n, start in enumerate(range(0, len(rows), size)):
+            window = copy.deepcopy(resp)
+            wds0 = window['results'][0]['result']['data']['dsr']['DS'][0]
+            value_dicts = dict((d, []) for d in aptera_data.field_dicts.values())
+            dm0 = []
+            for row in rows[start:start + size]:
+                record = list(row)
+                for f, d in aptera_data.field_dicts.items():
+                    ix = aptera_data.fields.index(f)
+                    if isinstance(record[ix], str):
+                        continue
+                    value = ds0['ValueDicts'][d][record[ix]]
+                    if value not in value_dicts[d]:
+                        value_dicts[d].append(value)
+                    record[ix] = value_dicts[d].index(value)
+                dm0.append({'C': record})
+            wds0['PH'][0]['DM0'] = dm0
+            wds0['ValueDicts'] = value_dicts
+            if start + size < len(rows):
+                del wds0['IC']
+                wds0['RT'] = [[str(rows[start + size - 1][0]) + 'L']]
+            with open(aptera_data.window_file(fn, n), 'w') as ostr:
+                json.dump(window, ostr)
+
+    def test_windows(self):
+        expected = io.StringIO()
+        resp = self.load_reply()
+        ds0 = resp['results'][0]['result']['data']['dsr']['DS'][0]
+        aptera_data.write_rows(expected, aptera_data.decode_rows(ds0['PH'][0]['DM0']), ds0['ValueDicts'])
+        with tempfile.TemporaryDirectory() as dir:
+            fn = os.path.join(dir, 'reply.js')
+            self.split_reply(fn, 300)
+            self.assertTrue(os.path.isfile(fn + '.3'))
+            aptera_data.options.load_xhr_response = fn
+            out = io.StringIO()
+            aptera_data.process(aptera_data.window_fetcher(), out)
+            self.assertEqual(out.getvalue(), expected.getvalue())
+
+            # a missing window is an error rather than a truncated leaderboard
+            os.remove(fn + '.2')
+            with contextlib.redirect_stderr(io.StringIO()):
+                with self.assertRaises(SystemExit):
+                    aptera_data.process(aptera_data.window_fetcher(), io.StringIO())
+
+    def test_window_request(self):
+        req = json.dumps({'queries': [{'Query': {'Commands': [{'SemanticQueryDataShapeCommand': {
+            'Binding': {'DataReduction': {'DataVolume': 3, 'Primary': {'Window': {'Count': 3000}}}}}}]}}]}).encode()
+        self.assertEqual(aptera_data.window_request(req, None), req)
+        aptera_data.options.window_count = 500
+        window = json.loads(aptera_data.window_request(req, [['3000L']]))['queries'][0]['Query']['Commands'][0][
+            'SemanticQueryDataShapeCommand']['Binding']['DataReduction']['Primary']['Window']
+        self.assertEqual(window, {'Count': 500, 'RestartTokens': [['3000L']]})
+
+    def test_bootstrap_cache(self):
+        with tempfile.TemporaryDirectory() as dir:
+            fn = os.path.join(dir, 'cache', 'bootstrap.json')
+            self.assertIsNone(aptera_data.load_bootstrap(fn, 3600))
+            boot = {'saved_at': time.time() - 100, 'url': aptera_data.url, 'vmap': {}}
+            aptera_data.save_bootstrap(fn, boot)
+            self.assertEqual(aptera_data.load_bootstrap(fn, 3600), boot)
+            # expired
+            self.assertIsNone(aptera_data.load_bootstrap(fn, 60))
+            # for another iframe URL, unless checking the main page
+            aptera_data.save_bootstrap(fn, dict(boot, url='https://app.powerbi.com/view?r=other'))
+            self.assertIsNone(aptera_data.load_bootstrap(fn, 3600))
+            aptera_data.options.check_main_page = True
+            self.assertIsNotNone(aptera_data.load_bootstrap(fn, 3600))
+            with open(fn, 'w') as ostr:
+                ostr.write('{')
+            self.assertIsNone(aptera_data.load_bootstrap(fn, 3600))
+
+    def test_bootstrap_refresh(self):
+        bootstraps = []
+        def bootstrap():
+            bootstraps.append({'saved_at': time.time(), 'url': aptera_data.url,
+                               'session': len(bootstraps)})
+            return bootstraps[-1]
+        # the query only succeeds with the latest bootstrap
+        def query(boot, req, restart_tokens, n):
+            return {'results': []} if boot['session'] == len(bootstraps) - 1 else None
+        aptera_data.bootstrap = bootstrap
+        aptera_data.query = query
+        with tempfile.TemporaryDirectory() as dir:
+            aptera_data.options.request_file = os.path.join(dir, 'request.txt')
+            with open(aptera_data.options.request_file, 'w') as ostr:
+                ostr.write('{}')
+            aptera_data.options.bootstrap_cache = os.path.join(dir, 'bootstrap.json')
+
+            self.assertEqual(aptera_data.fetch_data()(None, 0), {'results': []})
+            self.assertEqual(len(bootstraps), 1)
+            # cached: no bootstrap
+            self.assertEqual(aptera_data.fetch_data()(None, 0), {'results': []})
+            self.assertEqual(len(bootstraps), 1)
+
+            # the cached session went stale: refreshed once
+            bootstraps.append({'session': -1})
+            self.assertEqual(aptera_data.fetch_data()(None, 0), {'results': []})
+            self.assertEqual(len(bootstraps), 3)
+            with open(aptera_data.options.bootstrap_cache) as istr:
+                self.assertEqual(json.load(istr)['session'], 2)
+
+            # a fresh bootstrap that fails is not retried
+            aptera_data.options.bootstrap_ttl = 0
+            aptera_data.query = lambda boot, req, restart_tokens, n: None
+            post = aptera_data.fetch_data()
+            with contextlib.redirect_stderr(io.StringIO()):
+                with self.assertRaises(SystemExit):
+                    post(None, 0)
+            self.assertEqual(len(bootstraps), 4)
+
+            # but the next poll (--watch carries on after the exit) does
+            # not keep using it
+            aptera_data.options.bootstrap_ttl = 3600
+            aptera_data.query = query
+            bootstraps.append({'session': -1})
+            self.assertEqual(post(None, 0), {'results': []})
+            self.assertEqual(len(bootstraps), 6)
+
+    def test_watch(self):
+        resp = self.load_reply()
+        with tempfile.TemporaryDirectory() as dir:
+            fn = os.path.join(dir, 'reply.js')
+            def write_reply(num_rows):
+                reply = copy.deepcopy(resp)
+                ds0 = reply['results'][0]['result']['data']['dsr']['DS'][0]
+                ds0['PH'][0]['DM0'] = ds0['PH'][0]['DM0'][:num_rows]
+                with open(fn, 'w') as ostr:
+                    json.dump(reply, ostr)
+            write_reply(900)
+            aptera_data.options = argparse.Namespace(
+                verbose=0, window_count=0, load_xhr_response=fn,
+                output=os.path.join(dir, 'data.csv'), history_dir=os.path.join(dir, 'history'),
+                on_change=f'touch {os.path.join(dir, "changed")}',
+                min_interval=60.0, max_interval=300.0)
+
+            # between polls: unchanged, a new row, unchanged, stop
+            intervals = []
+            def sleep(interval):
+                intervals.append(interval)
+                if len(intervals) == 2:
+                    os.remove(os.path.join(dir, 'changed'))
+                    write_reply(901)
+                elif len(intervals) == 4:
+                    raise KeyboardInterrupt
+            real_sleep = aptera_data.time.sleep
+            aptera_data.time.sleep = sleep
+            try:
+                with contextlib.redirect_stderr(io.StringIO()):
+                    self.assertEqual(aptera_data.watch(), 0)
+            finally:
+                aptera_data.time.sleep = real_sleep
+            self.assertEqual(intervals, [60.0, 120.0, 60.0, 120.0])
+            self.assertTrue(os.path.isfile(os.path.join(dir, 'changed')))
+            with open(os.path.join(dir, 'data.csv')) as istr:
+                self.assertEqual(len(istr.readlines()), 901)
+            with open(os.path.join(dir, 'data.old')) as istr:
+                self.assertEqual(len(istr.readlines()), 900)
+            history = sorted(os.listdir(os.path.join(dir, 'history')))
+            self.assertTrue(all(f.startswith('data.') and f.endswith('.csv') for f in history))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,49 +1,346 @@
 #!/usr/bin/python3
 
+from abc import ABC, abstractmethod
+import sqlite3
 import sys
-from typing import Any, Callable, Dict
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
 
-# Cache grows unbounded, so beware.  The set_cache method can be used
-# to clear the cache.  The cache and set_cache methods are intended to
-# allow writing the cache contents to a file to avoid the expense of
-# repeated calls to f across executions.  If f represents a network
-# query, the query results should not change over time during the
-# usage (including saves and reloads) of a FuncCache object.
+# By default the cache grows unbounded, so beware.  The set_cache
+# method can be used to clear the cache.  The cache and set_cache
+# methods are intended to allow writing the cache contents to a file
+# to avoid the expense of repeated calls to f across executions.  If
+# f represents a network query, the query results should not change
+# over time during the usage (including saves and reloads) of a
+# FuncCache object.
+#
+# A FuncCache may be shared by several threads.  The lock protects
+# only the cache dictionary and counters; f itself is called without
+# holding the lock, so concurrent misses run concurrently (and two
+# threads missing on the same key will both call f).
+#
+# A FuncCache may also be backed by a persistent CacheStore.  Entries
+# not in memory are looked up in the store, and every newly computed
+# entry is written to the store right away, so nothing is loaded up
+# front and an interrupted run loses no completed calls.  Only entries
+# for which persist holds (all entries, if persist is None) are read
+# from or written to the store: a result that can still change, e.g.,
+# a query about the current day, must not be reused by a later run.
+#
+# For long running processes, the cache can be bounded: max_entries
+# limits the number of entries, evicting the least recently used one,
+# and ttl (in seconds) limits how long entries for which ttl_applies
+# (all entries, if ttl_applies is None) are kept, e.g., queries whose
+# results can still change because they are about the current day.
+# The stats method reports hits, misses, evictions, expirations,
+# invalidations and the approximate memory used by the entries.
+#
+# When only some results have changed (e.g., new investments on one
+# day), invalidate removes just the entries whose arguments match a
+# predicate, from memory and from the store, instead of flushing
+# everything.  That scans every entry; for (threshold, day) queries,
+# invalidate_days removes a range of days using an index by day, and
+# the store deletes the range itself.
+
+class CacheStore(ABC):
+    def __init__(self) -> None:
+        pass
+
+    # returns None if args is not in the store
+    @abstractmethod
+    def get(self, args: Tuple[Any, ...]) -> Any:
+        pass
+
+    @abstractmethod
+    def put(self, args: Tuple[Any, ...], value: Any) -> None:
+        pass
+
+    @abstractmethod
+    def clear(self) -> None:
+        pass
+
+    # remove the entries whose args satisfy pred
+    @abstractmethod
+    def invalidate(self, pred: Callable[[Tuple[Any, ...]], bool]) -> None:
+        pass
+
+    # remove the (threshold, day) entries for days first through last
+    # (inclusive), only those for threshold None if totals_only.
+    # Stores that can select the range directly should override this.
+    def invalidate_days(self, first: int, last: int, totals_only: bool) -> None:
+        self.invalidate(lambda args: first <= args[1] <= last and (not totals_only or args[0] is None))
+
+# Store for investment_data queries, (threshold, day) -> (amount,
+# count), in an SQLite database.  One database file can hold the
+# entries for several slugs and query modes (e.g., 'cumulative' and
+# 'day'), each FuncCache using the store for its own (slug, mode).
+# Each put is committed immediately; the write-ahead log makes that
+# cheap.
+class SqliteCacheStore(CacheStore):
+    # threshold None is stored as -1, since NULLs are never equal in a
+    # primary key
+    _NO_THRESHOLD = -1
+
+    def __init__(self, path: str, slug: str, mode: str) -> None:
+        self._slug = slug
+        self._mode = mode
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS query_cache ('
+                           ' slug TEXT NOT NULL,'
+                           ' mode TEXT NOT NULL,'
+                           ' threshold INTEGER NOT NULL,'
+                           ' day INTEGER NOT NULL,'
+                           ' amount INTEGER NOT NULL,'
+                           ' count INTEGER NOT NULL,'
+                           ' PRIMARY KEY (slug, mode, threshold, day))'
+                           ' WITHOUT ROWID')
+
+    def _key(self, args: Tuple[Any, ...]) -> Tuple[str, str, int, int]:
+        threshold, day = args
+        if threshold is None:
+            threshold = self._NO_THRESHOLD
+        return (self._slug, self._mode, threshold, day)
+
+    def get(self, args: Tuple[Any, ...]) -> Any:
+        with self._lock:
+            row = self._conn.execute('SELECT amount, count FROM query_cache'
+                                     ' WHERE slug = ? AND mode = ? AND threshold = ? AND day = ?',
+                                     self._key(args)).fetchone()
+        if row is None:
+            return None
+        return (row[0], row[1])
+
+    def put(self, args: Tuple[Any, ...], value: Any) -> None:
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO query_cache VALUES (?, ?, ?, ?, ?, ?)',
+                               self._key(args) + (value[0], value[1]))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM query_cache WHERE slug = ? AND mode = ?',
+                               (self._slug, self._mode))
+
+    def invalidate(self, pred: Callable[[Tuple[Any, ...]], bool]) -> None:
+        with self._lock:
+            rows = self._conn.execute('SELECT threshold, day FROM query_cache'
+                                      ' WHERE slug = ? AND mode = ?',
+                                      (self._slug, self._mode)).fetchall()
+            doomed = []
+            for threshold, day in rows:
+                args = (None if threshold == self._NO_THRESHOLD else threshold, day)
+                if pred(args):
+                    doomed.append((self._slug, self._mode, threshold, day))
+            self._conn.executemany('DELETE FROM query_cache'
+                                   ' WHERE slug = ? AND mode = ? AND threshold = ? AND day = ?',
+                                   doomed)
+
+    def invalidate_days(self, first: int, last: int, totals_only: bool) -> None:
+        sql = 'DELETE FROM query_cache WHERE slug = ? AND mode = ? AND day BETWEEN ? AND ?'
+        params: Tuple[Any, ...] = (self._slug, self._mode, first, last)
+        if totals_only:
+            sql += ' AND threshold = ?'
+            params += (self._NO_THRESHOLD,)
+        with self._lock:
+            self._conn.execute(sql, params)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+def _approx_size(x: Any) -> int:
+    if isinstance(x, tuple):
+        return sys.getsizeof(x) + sum(_approx_size(y) for y in x)
+    return sys.getsizeof(x)
 
 class FuncCache:
-    def __init__(self, f: Callable[..., Any]):
+    def __init__(self, f: Callable[..., Any],
+                 store: CacheStore | None = None,
+                 max_entries: int = 0,
+                 ttl: float = 0.0,
+                 ttl_applies: Optional[Callable[[Tuple[Any, ...]], bool]] = None,
+                 persist: Optional[Callable[[Tuple[Any, ...]], bool]] = None):
         self._f = f
+        self._store = store
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._ttl_applies = ttl_applies
+        self._persist = persist
+        # insertion order of _cache is the LRU order
         self._cache: Dict[Any, Any] = dict()
+        self._expiry: Dict[Any, float] = dict()
+        # the keys of _cache by their last argument (the day, for
+        # investment_data queries), for invalidate_days
+        self._by_day: Dict[Any, set] = dict()
         self._progress: int = 0
         self._hits: int = 0
         self._misses: int = 0
+        self._evictions: int = 0
+        self._expirations: int = 0
+        self._invalidations: int = 0
+        self._bytes: int = 0
+        self._lock = threading.Lock()
 
     def set_show_progress_period(self, p: int) -> None:
         self._progress = p
 
-    def __call__(self, *args: Any) -> Any:
+    def _hit(self) -> None:
+        # called with self._lock held
+        self._hits += 1
+        if self._progress > 0 and self._hits % self._progress == 0:
+            sys.stderr.write('.')
+            sys.stderr.flush()
+
+    def _has_ttl(self, args: Tuple[Any, ...]) -> bool:
+        return self._ttl > 0 and (self._ttl_applies is None or self._ttl_applies(args))
+
+    def _persists(self, args: Tuple[Any, ...]) -> bool:
+        return self._store is not None and (self._persist is None or self._persist(args))
+
+    def _remove(self, args: Tuple[Any, ...]) -> None:
+        # called with self._lock held
+        y = self._cache.pop(args)
+        self._expiry.pop(args, None)
+        if args:
+            day_keys = self._by_day[args[-1]]
+            day_keys.discard(args)
+            if not day_keys:
+                del self._by_day[args[-1]]
+        self._bytes -= _approx_size(args) + _approx_size(y)
+
+    def _insert(self, args: Tuple[Any, ...], y: Any) -> None:
+        # called with self._lock held
         if args in self._cache:
-            self._hits += 1
-            if self._progress > 0 and self._hits % self._progress == 0:
-                sys.stderr.write('.')
+            self._remove(args)
+        self._cache[args] = y
+        if args:
+            self._by_day.setdefault(args[-1], set()).add(args)
+        self._bytes += _approx_size(args) + _approx_size(y)
+        if self._has_ttl(args):
+            self._expiry[args] = time.monotonic() + self._ttl
+        if self._max_entries > 0:
+            while len(self._cache) > self._max_entries:
+                self._remove(next(iter(self._cache)))
+                self._evictions += 1
+
+    def _lookup(self, args: Tuple[Any, ...]) -> Tuple[bool, Any]:
+        # called with self._lock held
+        if args not in self._cache:
+            return (False, None)
+        if args in self._expiry and self._expiry[args] <= time.monotonic():
+            self._remove(args)
+            self._expirations += 1
+            return (False, None)
+        y = self._cache[args]
+        if self._max_entries > 0:
+            # move to the most recently used end
+            del self._cache[args]
+            self._cache[args] = y
+        return (True, y)
+
+    # Look args up without calling f, counting a hit or a miss.  For
+    # callers that compute f themselves (e.g., asynchronously) and
+    # then insert the result.
+    def lookup(self, *args: Any) -> Tuple[bool, Any]:
+        with self._lock:
+            found, y = self._lookup(args)
+            if found:
+                self._hit()
+                return (True, y)
+        if self._persists(args):
+            assert self._store is not None
+            y = self._store.get(args)
+            if y is not None:
+                with self._lock:
+                    self._hit()
+                    self._insert(args, y)
+                return (True, y)
+        with self._lock:
+            self._misses += 1
+            if self._progress > 0 and self._misses % self._progress == 0:
+                sys.stderr.write(',')
                 sys.stderr.flush()
-            return self._cache[args]
-        self._misses += 1
-        if self._progress > 0 and self._misses % self._progress == 0:
-            sys.stderr.write(',')
-            sys.stderr.flush()
+        return (False, None)
+
+    def insert(self, args: Tuple[Any, ...], y: Any) -> None:
+        with self._lock:
+            self._insert(args, y)
+        if self._persists(args):
+            assert self._store is not None
+            self._store.put(args, y)
+
+    def __call__(self, *args: Any) -> Any:
+        found, y = self.lookup(*args)
+        if found:
+            return y
         y = self._f(*args)
-        self._cache[args] = y
+        self.insert(args, y)
         return y
 
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'invalidations': self._invalidations,
+                'entries': len(self._cache),
+                'bytes': self._bytes,
+            }
+
     def cache(self) -> Dict[Any, Any]:
         return self._cache
 
     def set_cache(self, cache: Dict[Any, Any]) -> None:
-        self._cache = cache
+        with self._lock:
+            self._cache = dict()
+            self._expiry = dict()
+            self._by_day = dict()
+            self._bytes = 0
+            for args, y in cache.items():
+                self._insert(args, y)
+
+    # Remove the entries whose args satisfy pred, returning how many
+    # were in memory.
+    def invalidate(self, pred: Callable[[Tuple[Any, ...]], bool]) -> int:
+        with self._lock:
+            doomed = [args for args in self._cache if pred(args)]
+            for args in doomed:
+                self._remove(args)
+            self._invalidations += len(doomed)
+        if self._store is not None:
+            self._store.invalidate(pred)
+        return len(doomed)
+
+    # Remove the entries for (threshold, day) args with days first
+    # through last (inclusive), only those for threshold None if
+    # totals_only, returning how many were in memory.  Unlike
+    # invalidate, this looks at the range's entries only.
+    def invalidate_days(self, first: int, last: int, totals_only: bool = False) -> int:
+        with self._lock:
+            if totals_only:
+                doomed = [(None, day) for day in range(first, last + 1) if (None, day) in self._cache]
+            else:
+                doomed = [args for day in range(first, last + 1) for args in self._by_day.get(day, ())]
+            for args in doomed:
+                self._remove(args)
+            self._invalidations += len(doomed)
+        if self._store is not None:
+            self._store.invalidate_days(first, last, totals_only)
+        return len(doomed)
 
     def flush_cache(self) -> None:
-        self._cache = {}
+        with self._lock:
+            self._cache = {}
+            self._expiry = {}
+            self._by_day = {}
+            self._bytes = 0
+        if self._store is not None:
+            self._store.clear()
         if self._progress != 0:
             sys.stderr.write('!')
             sys.stderr.flush()
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import time
+import unittest
+
+import cache
+
+class Counter:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, threshold, day):
+        self.calls += 1
+        return (day * 100, day)
+
+class TestFuncCache(unittest.TestCase):
+
+    def test_hits(self):
+        f = Counter()
+        c = cache.FuncCache(f)
+        self.assertEqual(c(None, 3), (300, 3))
+        self.assertEqual(c(None, 3), (300, 3))
+        self.assertEqual(f.calls, 1)
+        c.flush_cache()
+        c(None, 3)
+        self.assertEqual(f.calls, 2)
+
+    def test_lru(self):
+        f = Counter()
+        c = cache.FuncCache(f, max_entries=2)
+        c(None, 1)
+        c(None, 2)
+        c(None, 1)  # 2 is now least recently used
+        c(None, 3)
+        self.assertEqual(set(c.cache().keys()), set([(None, 1), (None, 3)]))
+        stats = c.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['entries'], 2)
+        self.assertGreater(stats['bytes'], 0)
+        c.flush_cache()
+        self.assertEqual(c.stats()['bytes'], 0)
+
+    def test_ttl(self):
+        f = Counter()
+        # only day 5 (the "current day") expires
+        c = cache.FuncCache(f, ttl=0.05, ttl_applies=lambda args: args[1] == 5)
+        c(None, 4)
+        c(None, 5)
+        time.sleep(0.1)
+        c(None, 4)
+        c(None, 5)
+        self.assertEqual(f.calls, 3)
+        self.assertEqual(c.stats()['expirations'], 1)
+
+    def test_invalidate(self):
+        f = Counter()
+        c = cache.FuncCache(f)
+        for day in range(5):
+            c(None, day)
+            c(500, day)
+        self.assertEqual(c.invalidate(lambda args: args[1] >= 3 and args[0] is None), 2)
+        self.assertEqual(set(c.cache().keys()),
+                         set([(t, d) for t in [None, 500] for d in range(5)]) - set([(None, 3), (None, 4)]))
+        self.assertEqual(c.stats()['invalidations'], 2)
+        c(None, 3)
+        c(500, 3)
+        self.assertEqual(f.calls, 11)
+
+    def test_invalidate_days(self):
+        f = Counter()
+        c = cache.FuncCache(f)
+        for day in range(5):
+            c(None, day)
+            c(500, day)
+        self.assertEqual(c.invalidate_days(3, 4, totals_only=True), 2)
+        self.assertEqual(c.invalidate_days(1, 2), 4)
+        self.assertEqual(set(c.cache().keys()), set([(None, 0), (500, 0), (500, 3), (500, 4)]))
+        self.assertEqual(c.stats()['invalidations'], 6)
+        # the index by day follows evictions and reloads
+        c.set_cache({(None, 1): (100, 1), (700, 1): (300, 1)})
+        self.assertEqual(c.invalidate_days(0, 4), 2)
+        self.assertEqual(c.cache(), {})
+
+class TestSqliteCacheStore(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'cache.db')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_persistence(self):
+        f = Counter()
+        store = cache.SqliteCacheStore(self._path, 'aptera-rega', 'day')
+        c = cache.FuncCache(f, store)
+        c(None, 1)
+        c(500, 2)
+        store.close()
+
+        # a new process would start with an empty memory cache
+        store = cache.SqliteCacheStore(self._path, 'aptera-rega', 'day')
+        c = cache.FuncCache(f, store)
+        self.assertEqual(c(None, 1), (100, 1))
+        self.assertEqual(c(500, 2), (200, 2))
+        self.assertEqual(f.calls, 2)
+
+        # keyed by slug and mode as well
+        other = cache.FuncCache(f, cache.SqliteCacheStore(self._path, 'aptera-regd', 'day'))
+        other(None, 1)
+        self.assertEqual(f.calls, 3)
+
+        c.invalidate(lambda args: args[1] == 2)
+        self.assertIsNone(store.get((500, 2)))
+        self.assertEqual(store.get((None, 1)), (100, 1))
+
+        # ranges of days are deleted by the store itself
+        c(None, 2)
+        c(500, 2)
+        c(500, 3)
+        c.invalidate_days(2, 3, totals_only=True)
+        self.assertIsNone(store.get((None, 2)))
+        self.assertEqual(store.get((500, 2)), (200, 2))
+        c.invalidate_days(1, 2)
+        self.assertIsNone(store.get((None, 1)))
+        self.assertIsNone(store.get((500, 2)))
+        self.assertEqual(store.get((500, 3)), (300, 3))
+
+        c.flush_cache()
+        self.assertIsNone(store.get((None, 1)))
+        store.close()
+
+    def test_persist(self):
+        f = Counter()
+        # day 2 is still changing: kept in memory only, even without a ttl
+        store = cache.SqliteCacheStore(self._path, 'aptera-rega', 'day')
+        c = cache.FuncCache(f, store, persist=lambda args: args[1] < 2)
+        c(None, 1)
+        c(None, 2)
+        self.assertEqual(c(None, 2), (200, 2))
+        self.assertEqual(f.calls, 2)
+        self.assertEqual(store.get((None, 1)), (100, 1))
+        self.assertIsNone(store.get((None, 2)))
+
+        # nor read back, should an earlier run have stored it
+        store.put((500, 2), (0, 0))
+        c = cache.FuncCache(f, store, persist=lambda args: args[1] < 2)
+        self.assertEqual(c(500, 2), (200, 2))
+        self.assertEqual(c(None, 1), (100, 1))
+        self.assertEqual(f.calls, 3)
+        store.close()
+
+if __name__ == '__main__':
+    unittest.main()
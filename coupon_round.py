@@ -5,6 +5,7 @@ import datetime
 import json
 import requests
 import sys
+import time
 
 from typing import Any, Dict, Generator, Optional, Tuple
 
@@ -40,31 +41,54 @@ def main(argv: list[str]) -> int:
     parser.add_argument('--average-investment', type=bool, default=False,
                         action=argparse.BooleanOptionalAction,
                         help='print average investment amount for current investment category selected')
+    parser.add_argument('--issuance-url', type=str, default=issuance.issuance_url,
+                        help='Issuance investment summary end point (e.g., an issuance_server stand-in)')
+    parser.add_argument('--watch', '-w', type=bool, default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help='keep sampling, writing only samples whose values changed')
+    parser.add_argument('--min-interval', type=float, default=15.0,
+                        help='seconds between samples while the values are changing (--watch)')
+    parser.add_argument('--max-interval', type=float, default=600.0,
+                        help='maximum seconds between samples while the values are unchanged (--watch)')
     parser.add_argument('--verbose', '-v', action='count',
                         default=0,
                         help='increment the verbosity level by 1')
     options = parser.parse_args(argv[1:])
 
     issuance.verbose = options.verbose
+    issuance.issuance_url = options.issuance_url
 
     if not options.priority_only and options.remaining:
         print('Counting non-priority commitments and printing slots remaining are incompatible options', file=sys.stderr)
         return 1
 
-    if options.timestamp:
-        ts = f'{datetime.datetime.now().isoformat()}'
-    else:
-        ts = ''
+    if options.watch:
+        if options.min_interval <= 0 or options.max_interval < options.min_interval:
+            print('--min-interval must be positive and at most --max-interval', file=sys.stderr)
+            return 1
+        return watch()
 
     try:
-        if options.priority_only:
-            investment_threshold = 5000 * 100
-        else:
-            investment_threshold = None
-        sums = issuance.total_committed_amount_and_count_at_threshold(investment_threshold)
+        sums = fetch_sums()
     except IOError:
         print('Error while fetching data', file=sys.stderr)
         return 1
+    line, _ = format_sample(sums)
+    sys.stdout.write(line)
+    return 0
+
+def fetch_sums() -> Tuple[float, int]:
+    assert options is not None
+    if options.priority_only:
+        investment_threshold = 5000 * 100
+    else:
+        investment_threshold = None
+    return issuance.total_committed_amount_and_count_at_threshold(investment_threshold)
+
+# Returns the output line for sums, and the same values without the
+# timestamp, which tell whether a sample changed.
+def format_sample(sums: Tuple[float, int]) -> Tuple[str, str]:
+    assert options is not None
     slots = sums[1]
 
     if options.remaining:
@@ -108,17 +132,50 @@ def main(argv: list[str]) -> int:
     else:
         sep = sepgen_human()
 
+    line = ''
+    values = []
     for (p, l, vf) in output_control:
         if p:
+            v = vf()
             if options.csv:
-                sys.stdout.write(next(sep))
-                sys.stdout.write(comma_quote(vf()))
+                line += next(sep) + comma_quote(v)
             else:
-                sys.stdout.write(next(sep))
-                sys.stdout.write(l)
-                sys.stdout.write(vf())
-
-    sys.stdout.write('\n')
+                line += next(sep) + l + v
+            if l != '':
+                values.append(v)
+
+    return (line + '\n', ', '.join(values))
+
+# Keep sampling (on issuance's keep-alive sessions), writing a line
+# only when the values change.  The poll interval starts at
+# min_interval, doubles after each unchanged sample up to
+# max_interval, and drops back to min_interval when the values
+# change.  Errors are reported and back off the same way.
+def watch() -> int:
+    assert options is not None
+    interval = options.min_interval
+    last_key = None
+    try:
+        while True:
+            try:
+                sums = fetch_sums()
+            except IOError as e:
+                interval = min(interval * 2, options.max_interval)
+                sys.stderr.write(f'Error while fetching data ({e}); retrying in {interval:g}s\n')
+            else:
+                line, key = format_sample(sums)
+                if key != last_key:
+                    sys.stdout.write(line)
+                    sys.stdout.flush()
+                    last_key = key
+                    interval = options.min_interval
+                else:
+                    interval = min(interval * 2, options.max_interval)
+                    if options.verbose > 0:
+                        sys.stderr.write(f'unchanged; next sample in {interval:g}s\n')
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
     return 0
 
 if __name__ == '__main__':
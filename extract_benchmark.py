@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+
+# Benchmark the investment extraction algorithms over a matrix of
+# synthetic data sets (number of investments, number of days, value
+# range, fraction of duplicate investments).  For every case and
+# algorithm it reports the number of queries, the number of sequential
+# search rounds and probes, the wall time, and queries per investment
+# compared with an information-theoretic lower bound, plus the wall
+# time projected (by latency_sim) for each simulated query latency
+# distribution.  Results are written as JSON; a stored baseline
+# (e.g., test_data/extract_benchmark.json) can be compared against,
+# failing if queries or rounds regress by more than a tolerance.  The
+# wall time depends on the machine, so it is left out of a baseline.
+#
+#   extract_benchmark.py --output results.json
+#   extract_benchmark.py --no-wall-time --output test_data/extract_benchmark.json
+#   extract_benchmark.py --baseline test_data/extract_benchmark.json
+
+import argparse
+import json
+import math
+import random
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import extract_investments
+import latency_sim
+import synthetic_investments
+
+options: Optional[argparse.Namespace] = None
+
+Extract = Callable[[extract_investments.ExtractInvestment], List[Tuple[int, int]]]
+
+# name -> (ExtractInvestment keyword arguments, extraction method)
+algorithms: Dict[str, Tuple[Dict[str, Any], Extract]] = {
+    'bisect': (dict(), lambda e: e.extract_investments()),
+    'fast': (dict(), lambda e: e.fast_extraction()),
+    'fast-jobs4': (dict(jobs=4), lambda e: e.fast_extraction()),
+    'batched': (dict(batched=True), lambda e: e.fast_extraction()),
+    'kary4': (dict(split_k=4), lambda e: e.fast_extraction()),
+    'amounts': (dict(use_amounts=True), lambda e: e.fast_extraction()),
+}
+
+# Synthetic investments, a fraction of which duplicate (same day and
+# amount) an earlier one.
+def make_investments(num_entries: int, num_days: int, min_inv: int, max_inv: int,
+                     duplicates: float, rng: random.Random) -> List[Tuple[int, int]]:
+    investments: List[Tuple[int, int]] = []
+    for _ in range(num_entries):
+        if investments and rng.random() < duplicates:
+            investments.append(rng.choice(investments))
+        else:
+            investments.append((rng.randrange(num_days), rng.randrange(min_inv, max_inv)))
+    return investments
+
+# log2 of the number of multisets of k values out of v
+def log2_multisets(v: int, k: int) -> float:
+    return (math.lgamma(v + k) - math.lgamma(k + 1) - math.lgamma(v)) / math.log(2)
+
+# Lower bound on the number of count queries needed to identify the
+# investments, given each day's count (from the day totals): a day
+# with k investments has C(v + k - 1, k) possible contents, for v
+# possible values, and a count query answer on it is one of k + 1
+# values.  Amount totals carry more information, so algorithms using
+# them can beat this bound.
+def lower_bound(investments: List[Tuple[int, int]], num_values: int) -> float:
+    per_day: Dict[int, int] = dict()
+    for day, _ in investments:
+        per_day[day] = per_day.get(day, 0) + 1
+    return sum(log2_multisets(num_values, k) / math.log2(k + 1) for k in per_day.values())
+
+def run_case(case: Dict[str, Any], algorithm: str, latencies: List[str],
+             max_in_flight: int) -> Dict[str, Any]:
+    kwargs, extract = algorithms[algorithm]
+    rng = random.Random(case['seed'])
+    investments = make_investments(case['entries'], case['days'],
+                                   case['min_investment'], case['max_investment'],
+                                   case['duplicates'], rng)
+    si = synthetic_investments.SyntheticInvestmentData(
+        0, case['days'], case['min_investment'], case['max_investment'], rng.randrange)
+    si.set_investments(investments)
+    extractor = extract_investments.ExtractInvestment(
+        si, case['days'], case['min_investment'], case['max_investment'], **kwargs)
+    start = time.monotonic()
+    extracted = extract(extractor)
+    wall = time.monotonic() - start
+    if sorted(extracted) != sorted(investments):
+        raise RuntimeError(f'{algorithm} extracted the wrong investments for {case}')
+    stats = extractor.search_stats()
+    queries = si.num_queries()
+    bound = lower_bound(investments, case['max_investment'] - case['min_investment'])
+    n = len(investments)
+    projected = dict()
+    for spec in latencies:
+        sim = latency_sim.SimulatedLatencyInvestmentData(
+            si, latency_sim.Latency(spec, case['seed']), max_in_flight)
+        extract(extract_investments.ExtractInvestment(
+            sim, case['days'], case['min_investment'], case['max_investment'], **kwargs))
+        projected[spec] = sim.elapsed()
+    return dict(case, **{
+        'algorithm': algorithm,
+        'queries': queries,
+        'rounds': stats.rounds(),
+        'probes': stats.probes(),
+        'wall_seconds': wall,
+        'queries_per_investment': queries / n if n else None,
+        'lower_bound_queries': bound,
+        'lower_bound_ratio': queries / bound if bound else None,
+        'projected_seconds': projected,
+    })
+
+def case_key(r: Dict[str, Any]) -> Tuple:
+    return (r['algorithm'], r['entries'], r['days'], r['min_investment'],
+            r['max_investment'], r['duplicates'], r['seed'])
+
+# Regressions of queries or rounds by more than tolerance (a fraction)
+# relative to baseline.
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]],
+            tolerance: float) -> List[str]:
+    previous = dict((case_key(r), r) for r in baseline)
+    regressions = []
+    for r in results:
+        b = previous.get(case_key(r))
+        if b is None:
+            continue
+        for metric in ['queries', 'rounds']:
+            if r[metric] > b[metric] * (1 + tolerance):
+                regressions.append(f'{r["algorithm"]} {case_key(r)[1:]}: {metric} {b[metric]} -> {r[metric]}')
+            elif options is not None and options.verbose > 0 and r[metric] != b[metric]:
+                sys.stderr.write(f'{r["algorithm"]} {case_key(r)[1:]}: {metric} {b[metric]} -> {r[metric]}\n')
+    return regressions
+
+def int_list(s: str) -> List[int]:
+    return [int(v) for v in s.split(',')]
+
+def float_list(s: str) -> List[float]:
+    return [float(v) for v in s.split(',')]
+
+def range_list(s: str) -> List[Tuple[int, int]]:
+    ranges = []
+    for r in s.split(','):
+        lo, hi = r.split(':')
+        ranges.append((int(lo), int(hi)))
+    return ranges
+
+def main(argv: list[str]) -> int:
+    global options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--algorithms', type=str, default=','.join(algorithms.keys()),
+                        help=f'comma separated algorithms to run, out of {", ".join(algorithms.keys())}')
+    parser.add_argument('--entries', type=int_list, default=[100, 1000],
+                        help='comma separated numbers of investments')
+    parser.add_argument('--days', type=int_list, default=[10, 100],
+                        help='comma separated numbers of days')
+    parser.add_argument('--value-ranges', type=range_list, default=[(500, 10_000), (100_000, 10_000_000)],
+                        help='comma separated MIN:MAX investment ranges, in cents')
+    parser.add_argument('--duplicates', type=float_list, default=[0.0, 0.1],
+                        help='comma separated fractions of investments duplicating an earlier one')
+    parser.add_argument('--latencies', type=str, default='fixed:0.05,lognormal:0.2:0.5',
+                        help='comma separated query latency distributions to project wall time for: fixed:S (or just S), lognormal:MEDIAN:SIGMA or replay:FILE (seconds)')
+    parser.add_argument('--max-in-flight', type=int, default=64,
+                        help='concurrent query limit for the projected wall times')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='random seed for the synthetic data')
+    parser.add_argument('--output', '-o', type=str, default='',
+                        help='write the results as JSON to this file (default standard output)')
+    parser.add_argument('--wall-time', type=bool, default=True,
+                        action=argparse.BooleanOptionalAction,
+                        help='include the (machine-specific) wall times in the results; leave them out of a stored baseline')
+    parser.add_argument('--baseline', type=str, default='',
+                        help='compare with the results stored in this file')
+    parser.add_argument('--tolerance', type=float, default=0.0,
+                        help='fraction by which queries or rounds may exceed the baseline')
+    parser.add_argument('--verbose', '-v', action='count',
+                        default=0,
+                        help='increment the verbosity level by 1')
+    options = parser.parse_args(argv[1:])
+
+    latencies = [spec for spec in options.latencies.split(',') if spec != '']
+    try:
+        for spec in latencies:
+            latency_sim.Latency(spec)
+    except (ValueError, OSError) as e:
+        sys.stderr.write(f'{e}\n')
+        return 1
+    names = options.algorithms.split(',')
+    for name in names:
+        if name not in algorithms:
+            sys.stderr.write(f'unknown algorithm {name}\n')
+            return 1
+
+    results = []
+    for entries in options.entries:
+        for days in options.days:
+            for (min_inv, max_inv) in options.value_ranges:
+                for duplicates in options.duplicates:
+                    case = {
+                        'entries': entries,
+                        'days': days,
+                        'min_investment': min_inv,
+                        'max_investment': max_inv,
+                        'duplicates': duplicates,
+                        'seed': options.seed,
+                    }
+                    for name in names:
+                        r = run_case(case, name, latencies, options.max_in_flight)
+                        if options.verbose > 0:
+                            sys.stderr.write(f'{name} {case_key(r)[1:]}: {r["queries"]} queries, '
+                                             f'{r["rounds"]} rounds, {r["wall_seconds"]:.2f}s, '
+                                             f'{r["lower_bound_ratio"]:.2f}x lower bound\n')
+                        if not options.wall_time:
+                            del r['wall_seconds']
+                        results.append(r)
+
+    if options.output != '':
+        with open(options.output, 'w') as ostr:
+            json.dump(results, ostr, indent=1)
+            ostr.write('\n')
+    else:
+        json.dump(results, sys.stdout, indent=1)
+        sys.stdout.write('\n')
+
+    if options.baseline != '':
+        with open(options.baseline) as istr:
+            baseline = json.load(istr)
+        regressions = compare(results, baseline, options.tolerance)
+        for regression in regressions:
+            sys.stderr.write(f'regression: {regression}\n')
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,22 +1,43 @@
 #!/usr/bin/python3
 
 import argparse
+import ast
 import csv
 import json
 import os
 import sys
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 
 import cache
 import extract_investments
 import investment_data
 import issuance
+import metrics
+import query_trace
 
 options: Optional[argparse.Namespace] = None
 
+# Read a previous run's output in the json or csv output format, as
+# a map from slug to list of (day, value) pairs.
+def load_baseline(fn: str) -> Dict[str, list[Tuple[int, int]]]:
+    with open(fn, newline='') as istr:
+        text = istr.read()
+    baseline: Dict[str, list[Tuple[int, int]]] = dict()
+    if text.lstrip().startswith('{'):
+        for slug, investments in json.loads(text).items():
+            baseline[slug] = [(int(day), int(amt)) for day, amt in investments]
+        return baseline
+    for row in csv.reader(text.splitlines()):
+        if len(row) != 3:
+            raise ValueError(f'{fn}: malformed baseline row {row}')
+        baseline.setdefault(row[0], []).append((int(row[1]), int(row[2])))
+    return baseline
+
 def main(argv: list[str]) -> int:
     global options
     parser = argparse.ArgumentParser()
+    parser.add_argument('--issuance-url', type=str, default=issuance.issuance_url,
+                        help='Issuance investment summary end point (e.g., an issuance_server stand-in)')
     parser.add_argument('--verbose', '-v', action='count',
                         default=0,
                         help='increment the verbosity level by 1')
@@ -27,8 +48,18 @@ def main(argv: list[str]) -> int:
                         help='save web API query cache contents to this file prior before quitting')
     parser.add_argument('--load-cache', type=str, default='',
                         help='pre-load query cache from this file')
+    parser.add_argument('--cache-db', type=str, default='',
+                        help='keep the query cache in this SQLite database, reading entries on demand and writing each new entry immediately (only day-specific queries about days before today, whose results cannot change)')
+    parser.add_argument('--cache-max-entries', type=int, default=0,
+                        help='evict least recently used query cache entries beyond this many (0 for no limit)')
+    parser.add_argument('--cache-ttl', type=float, default=0.0,
+                        help='seconds to keep cached queries that include the current day (0 for no limit)')
     parser.add_argument('--show-cache-progress', type=int, default=0,
                         help='print indicator for every this many cache hits (.) and misses (,) (0 to disable)')
+    parser.add_argument('--metrics-json', type=str, default='',
+                        help='write query metrics (latencies, queries per day and per investment, cache hit ratio, retries) as JSON to this file')
+    parser.add_argument('--metrics-prometheus', type=str, default='',
+                        help='write query metrics in the Prometheus text format to this file')
     parser.add_argument('--output-format', type=str, choices=['json', 'old', 'csv'],
                         default='csv',
                         help='output style')
@@ -38,66 +69,255 @@ def main(argv: list[str]) -> int:
     parser.add_argument('--use-day-query', type=bool, default=True,
                         action=argparse.BooleanOptionalAction,
                         help='use more specific (day-only) query')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of days to extract concurrently (fast extraction only)')
+    parser.add_argument('--batched', type=bool, default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help='issue all probes of a bisection level together (fast extraction only)')
+    parser.add_argument('--batch-workers', type=int, default=8,
+                        help='maximum number of concurrent queries for a batch of probes')
+    parser.add_argument('--async-client', type=bool, default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help='use the asyncio Issuance client (requires aiohttp); best with --batched')
+    parser.add_argument('--max-in-flight', type=int, default=100,
+                        help='maximum number of concurrent queries of the asyncio client')
+    parser.add_argument('--governor', type=bool, default=True,
+                        action=argparse.BooleanOptionalAction,
+                        help='adapt the number of concurrent queries to the server and retry throttled or failed queries')
+    parser.add_argument('--max-concurrency', type=int, default=64,
+                        help='upper bound for the number of concurrent queries allowed by the governor')
+    parser.add_argument('--target-latency', type=float, default=1.0,
+                        help='query latency (in seconds) above which the governor reduces concurrency')
+    parser.add_argument('--max-retries', type=int, default=6,
+                        help='number of times the governor retries a throttled or failed query')
+    parser.add_argument('--split-k', type=int, default=2,
+                        help='split search intervals this many ways, probing the split points together (implies --batched)')
+    parser.add_argument('--lattice-step', type=int, default=0,
+                        help='search multiples of this amount (in cents, e.g., the share price) first, falling back to a full search (0 to disable; fast extraction only)')
+    parser.add_argument('--lattice-offsets', type=str, default='0',
+                        help='comma separated amounts (in cents, e.g., fees) added to the lattice multiples')
+    parser.add_argument('--use-amounts', type=bool, default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help='use amount totals to locate single investments without bisecting (fast extraction only, not with --batched or --lattice-step)')
+    parser.add_argument('--check-fingerprint', type=bool, default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help='compare each day\'s totals before and after extracting it, waiting for changing days to settle')
+    parser.add_argument('--quiesce-interval', type=float, default=5.0,
+                        help='seconds a changing day\'s totals must stay the same before it is extracted again')
+    parser.add_argument('--quiesce-timeout', type=float, default=300.0,
+                        help='maximum seconds to wait for a changing day to settle')
+    parser.add_argument('--baseline', type=str, default='',
+                        help='previous json or csv output; only days whose totals changed are re-extracted (fast extraction only)')
+    parser.add_argument('--record-trace', type=str, default='',
+                        help='record every Issuance query, its answer and latency to this JSON lines file (.gz to compress)')
+    parser.add_argument('--replay-trace', type=str, default='',
+                        help='answer queries from a file written by --record-trace instead of Issuance')
+    parser.add_argument('--replay-speed', type=float, default=0.0,
+                        help='replay recorded latencies at this speed (1 = as recorded, 0 = no delays) (--replay-trace)')
 
     options = parser.parse_args(argv[1:])
 
-    if (options.save_cache != '' or options.load_cache != '') and not options.cache:
-        sys.stderr.write(f'Without --cache option, neither --load-cache nor --save-cache makes sense\n')
+    if (options.save_cache != '' or options.load_cache != '' or options.cache_db != '') and not options.cache:
+        sys.stderr.write(f'Without --cache option, none of --load-cache, --save-cache or --cache-db makes sense\n')
+        return 1
+
+    if options.jobs < 1:
+        sys.stderr.write(f'--jobs must be at least 1\n')
+        return 1
+    if options.jobs > 1 and not options.fast_extraction:
+        sys.stderr.write(f'--jobs is only supported with --fast-extraction\n')
+        return 1
+    if options.split_k < 2:
+        sys.stderr.write(f'--split-k must be at least 2\n')
+        return 1
+    if options.batched and not options.fast_extraction:
+        sys.stderr.write(f'--batched is only supported with --fast-extraction\n')
+        return 1
+    lattice_offsets = []
+    if options.lattice_step != 0:
+        if not options.fast_extraction:
+            sys.stderr.write(f'--lattice-step is only supported with --fast-extraction\n')
+            return 1
+        try:
+            lattice_offsets = [int(off) for off in options.lattice_offsets.split(',')]
+        except ValueError:
+            sys.stderr.write(f'--lattice-offsets should be comma separated integers\n')
+            return 1
+        if options.lattice_step < 0 or any(off < 0 or off >= options.lattice_step for off in lattice_offsets):
+            sys.stderr.write(f'--lattice-offsets should be in [0, --lattice-step)\n')
+            return 1
+    if options.use_amounts and (not options.fast_extraction or options.batched
+                                or options.split_k > 2 or options.lattice_step != 0):
+        sys.stderr.write(f'--use-amounts requires --fast-extraction, and is incompatible with --batched, --split-k and --lattice-step\n')
+        return 1
+    if options.baseline != '' and not options.fast_extraction:
+        sys.stderr.write(f'--baseline is only supported with --fast-extraction\n')
+        return 1
+
+    if options.record_trace != '' and options.replay_trace != '':
+        sys.stderr.write(f'--record-trace and --replay-trace are mutually exclusive\n')
+        return 1
+    if options.replay_trace != '' and options.async_client:
+        sys.stderr.write(f'--replay-trace does not use the --async-client\n')
         return 1
 
+    baseline: Dict[str, list[Tuple[int, int]]] = dict()
+    if options.baseline != '':
+        try:
+            baseline = load_baseline(options.baseline)
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f'Error: cannot load baseline: {e}\n')
+            return 1
+
     issuance.verbose = options.verbose
+    issuance.issuance_url = options.issuance_url
     extract_investments.verbose = options.verbose
     # need a way to register all imported modules to automatically set
     # their verbosity, if they sign up for it.
 
     today = issuance.today_day_number()
 
+    query_metrics = None
+    if options.metrics_json != '' or options.metrics_prometheus != '':
+        query_metrics = metrics.QueryMetrics()
+
+    # one governor for both slugs, since they share the server
+    governor = None
+    if options.governor:
+        governor = issuance.RequestGovernor(max_limit=options.max_concurrency,
+                                            target_latency=options.target_latency,
+                                            max_retries=options.max_retries,
+                                            query_metrics=query_metrics)
+
+    trace = None
+    if options.record_trace != '':
+        trace = query_trace.TraceWriter(options.record_trace)
+
     investments_json: Dict[str, Any] = dict()
 
-    for slug in ['aptera-rega', 'aptera-regd']:
-        if options.use_day_query:
-            data_src: investment_data.InvestmentData = issuance.IssuanceInvestmentDataSpecific(slug)
-        else:
-            data_src = issuance.IssuanceInvestmentData(slug)
-
-        qf = data_src
-        if options.cache:
-            qf.enable_cache()
-            qf.set_progress_period(options.show_cache_progress)
-
-            if options.load_cache != '':
-                cache_file = f'{options.load_cache}-{slug}'
-                if os.path.isfile(cache_file):
-                    with open(cache_file) as istr:
-                        qf.set_cache(eval(istr.read()))  # potentially unsafe!
-                    if options.verbose:
-                        sys.stderr.write(f'Cache {cache_file} loaded.\n')
-                else:
-                    sys.stderr.write(f'Error: cache file {cache_file} does not exist.\n')
-                    # we don't quit because we may have a cache file for one
-                    # slug but not the other
+    # the trace is closed however the extraction ends, so that a failed
+    # run can be replayed too
+    try:
+        for slug in ['aptera-rega', 'aptera-regd']:
+            mode = 'day' if options.use_day_query else 'cumulative'
+            if options.replay_trace != '':
+                replay_src = query_trace.ReplayInvestmentData(options.replay_trace, slug, mode,
+                                                              options.replay_speed)
+                # the recorded run's today
+                today = replay_src.max_day()
+                if today < 0:
+                    sys.stderr.write(f'Error: no {mode} queries for {slug} in {options.replay_trace}\n')
+                    return 1
+                data_src: investment_data.InvestmentData = replay_src
+            elif options.async_client:
+                # aiohttp is only needed for the asyncio client
+                import issuance_async
+                data_src = issuance_async.AsyncIssuanceInvestmentData(
+                    slug, options.use_day_query, options.max_in_flight,
+                    governor=governor, query_metrics=query_metrics)
+            elif options.use_day_query:
+                data_src = issuance.IssuanceInvestmentDataSpecific(slug, options.batch_workers, governor,
+                                                                   query_metrics)
+            else:
+                data_src = issuance.IssuanceInvestmentData(slug, options.batch_workers, governor,
+                                                           query_metrics)
+
+            store: cache.SqliteCacheStore | None = None
+            # closed however the slug's extraction ends
+            try:
+                qf = data_src
+                if trace is not None:
+                    # record only real queries: the cache is enabled on the wrapper
+                    qf = query_trace.RecordingInvestmentData(data_src, trace, slug, mode)
+                if options.cache:
+                    if options.cache_db != '':
+                        store = cache.SqliteCacheStore(options.cache_db, slug, mode)
+                    qf.enable_cache(store, options.cache_max_entries, options.cache_ttl)
+                    qf.set_progress_period(options.show_cache_progress)
+
+                    if options.load_cache != '':
+                        cache_file = f'{options.load_cache}-{slug}'
+                        if os.path.isfile(cache_file):
+                            with open(cache_file) as istr:
+                                qf.set_cache(ast.literal_eval(istr.read()))
+                            if options.verbose:
+                                sys.stderr.write(f'Cache {cache_file} loaded.\n')
+                        else:
+                            sys.stderr.write(f'Error: cache file {cache_file} does not exist.\n')
+                            # we don't quit because we may have a cache file for one
+                            # slug but not the other
     
-        extractor = extract_investments.ExtractInvestment(
-            qf,
-            today + 1,
-            0, 10_000_000 * 100,
-            src_is_cumulative = not options.use_day_query
-        )
-
-        if options.fast_extraction:
-            investments = extractor.fast_extraction()
-        else:
-            investments = extractor.extract_investments()
-        if options.output_format == 'old':
-            sys.stdout.write(f'investments[\'{slug}\'] = {investments}\n')
-        elif options.output_format == 'json' or options.output_format == 'csv':
-            investments_json[slug] = investments
-        if options.save_cache != '':
-            cache_file = f'{options.save_cache}-{slug}'
-            with open(cache_file, 'w') as ostr:
-                ostr.write(repr(qf.cache()))
-            if options.verbose:
-                sys.stderr.write(f'Cache {cache_file} written.\n')
+                max_investment = 10_000_000 * 100
+                lattice = None
+                if options.lattice_step != 0:
+                    lattice = extract_investments.AmountLattice(0, max_investment,
+                                                                options.lattice_step,
+                                                                lattice_offsets)
+
+                extractor = extract_investments.ExtractInvestment(
+                    qf,
+                    today + 1,
+                    0, max_investment,
+                    src_is_cumulative = not options.use_day_query,
+                    jobs = options.jobs,
+                    batched = options.batched,
+                    split_k = options.split_k,
+                    lattice = lattice,
+                    use_amounts = options.use_amounts,
+                    query_metrics = query_metrics,
+                    metrics_label = slug,
+                    check_fingerprint = options.check_fingerprint,
+                    quiesce_interval = options.quiesce_interval,
+                    quiesce_timeout = options.quiesce_timeout
+                )
+
+                if options.baseline != '':
+                    investments = extractor.incremental_extraction(baseline.get(slug, []))
+                elif options.fast_extraction:
+                    investments = extractor.fast_extraction()
+                else:
+                    investments = extractor.extract_investments()
+                if options.verbose:
+                    stats = extractor.search_stats()
+                    query_cache = qf.cache()
+                    # the cache's misses are all the queries that reached
+                    # the source, the searches' and the others
+                    real = '' if query_cache is None else f', {query_cache.stats()["misses"]} real queries in all'
+                    sys.stderr.write(f'{slug}: split k={options.split_k}: {stats.rounds()} rounds,'
+                                     f' {stats.probes()} probes, {stats.queries()} queries{real}\n')
+                    if query_cache is not None:
+                        sys.stderr.write(f'{slug}: cache {query_cache.stats()}\n')
+                    if governor is not None:
+                        sys.stderr.write(f'{slug}: governor limit {governor.limit():.1f}, rate {governor.rate():.2f}/s, {governor.retries()} retries\n')
+                if options.output_format == 'old':
+                    sys.stdout.write(f'investments[\'{slug}\'] = {investments}\n')
+                elif options.output_format == 'json' or options.output_format == 'csv':
+                    investments_json[slug] = investments
+                if options.save_cache != '':
+                    cache_file = f'{options.save_cache}-{slug}'
+                    query_cache = qf.cache()
+                    assert query_cache is not None
+                    with open(cache_file, 'w') as ostr:
+                        ostr.write(repr(query_cache.cache()))
+                    if options.verbose:
+                        sys.stderr.write(f'Cache {cache_file} written.\n')
+                query_cache = qf.cache()
+                if query_metrics is not None and query_cache is not None:
+                    query_metrics.set_cache_stats(slug, query_cache.stats())
+            finally:
+                data_src.close()
+                if store is not None:
+                    store.close()
+    finally:
+        if trace is not None:
+            trace.close()
+    if query_metrics is not None:
+        if options.metrics_json != '':
+            with open(options.metrics_json, 'w') as ostr:
+                json.dump(query_metrics.report(), ostr, indent=1)
+        if options.metrics_prometheus != '':
+            with open(options.metrics_prometheus, 'w') as ostr:
+                ostr.write(query_metrics.prometheus())
     if options.output_format == 'json':
         sys.stdout.write(json.dumps(investments_json))
     elif options.output_format == 'csv':
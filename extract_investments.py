@@ -1,12 +1,17 @@
 #!/usr/bin/python3
 
 from abc import ABC, abstractmethod
+import bisect
+import concurrent.futures
 import sys
-from typing import Callable, Tuple
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
 import fbisect
 import find_jumps
 import investment_data
+import metrics
 
 verbose: int = 0
 
@@ -18,9 +23,22 @@ class BisectFunc(ABC):
     def __call__(self, threshold: int) -> int:
         pass
 
+    @abstractmethod
+    def batch(self, thresholds: List[int]) -> List[int]:
+        pass
+
+    # how many source queries evaluating one threshold takes
+    def queries_per_probe(self) -> int:
+        return 1
+
+    # (amount, count) version of __call__; amount is -1 if redacted
+    @abstractmethod
+    def amount_and_count(self, threshold: int) -> Tuple[int, int]:
+        pass
+
 class CumulativeCountBisectFunc(BisectFunc):
     def __init__(self,
-                 src: Callable[[int|None, int], Tuple[int, int]],
+                 src: investment_data.InvestmentData,
                  day: int,
                  max_day: int):
         self._src = src
@@ -38,9 +56,33 @@ class CumulativeCountBisectFunc(BisectFunc):
         incr = today_count - next_day_count
         return incr
 
+    def batch(self, thresholds: List[int]) -> List[int]:
+        queries = [(t, self._day) for t in thresholds]
+        if self._day + 1 != self._max_day:
+            queries += [(t, self._day + 1) for t in thresholds]
+        counts = [r[1] for r in self._src.batch(queries)]
+        n = len(thresholds)
+        if self._day + 1 == self._max_day:
+            return counts
+        return [counts[i] - counts[n + i] for i in range(n)]
+
+    def queries_per_probe(self) -> int:
+        return 1 if self._day + 1 == self._max_day else 2
+
+    def amount_and_count(self, threshold: int) -> Tuple[int, int]:
+        today = self._src(threshold, self._day)
+        if self._day + 1 == self._max_day:
+            return today
+        next_day = self._src(threshold, self._day + 1)
+        if today[0] == -1 or next_day[0] == -1:
+            amount = -1
+        else:
+            amount = today[0] - next_day[0]
+        return (amount, today[1] - next_day[1])
+
 class DailyCountBisectFunc(BisectFunc):
     def __init__(self,
-                 src: Callable[[int|None, int], Tuple[int, int]],
+                 src: investment_data.InvestmentData,
                  day: int):
         self._src = src
         self._day = day
@@ -49,6 +91,107 @@ class DailyCountBisectFunc(BisectFunc):
         incr = self._src(threshold, self._day)[1]
         return incr
 
+    def batch(self, thresholds: List[int]) -> List[int]:
+        return [r[1] for r in self._src.batch([(t, self._day) for t in thresholds])]
+
+    def amount_and_count(self, threshold: int) -> Tuple[int, int]:
+        return self._src(threshold, self._day)
+
+# Counts the sequential rounds, the total number of probes (threshold
+# evaluations) and the source queries those took, made by the
+# searches.  A __call__ is one round with one probe; a batch of n
+# thresholds is one round with n probes.  In cumulative mode a probe
+# is two queries (one on the last day).  Queries answered by the
+# source's cache are counted too; its misses are the real ones.
+# Shared by the days being extracted concurrently.
+class SearchStats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._rounds = 0
+        self._probes = 0
+        self._queries = 0
+
+    def record(self, probes: int, queries: int) -> None:
+        with self._lock:
+            self._rounds += 1
+            self._probes += probes
+            self._queries += queries
+
+    def rounds(self) -> int:
+        return self._rounds
+
+    def probes(self) -> int:
+        return self._probes
+
+    def queries(self) -> int:
+        return self._queries
+
+class CountingBisectFunc(BisectFunc):
+    def __init__(self, func: BisectFunc, stats: SearchStats):
+        self._func = func
+        self._stats = stats
+
+    def _record(self, probes: int) -> None:
+        self._stats.record(probes, probes * self._func.queries_per_probe())
+
+    def __call__(self, threshold: int) -> int:
+        self._record(1)
+        return self._func(threshold)
+
+    def batch(self, thresholds: List[int]) -> List[int]:
+        self._record(len(thresholds))
+        return self._func.batch(thresholds)
+
+    def queries_per_probe(self) -> int:
+        return self._func.queries_per_probe()
+
+    def amount_and_count(self, threshold: int) -> Tuple[int, int]:
+        self._record(1)
+        return self._func.amount_and_count(threshold)
+
+# Candidate investment amounts for find_jumps.find_lasts_lattice: the
+# values n * step + offset, for n >= 0 and offset in offsets, that lie
+# strictly between x0 and x1, plus x0 and x1 themselves.  step would be
+# the share price and offsets the usual fee amounts (0 for no fee),
+# all in cents.  The points are computed on demand, so a fine lattice
+# over the whole investment range takes no space.
+class AmountLattice(Sequence[int]):
+    def __init__(self, x0: int, x1: int, step: int, offsets: List[int]) -> None:
+        assert 0 <= x0 < x1, f'AmountLattice: bad range [{x0},{x1}]'
+        assert step > 0, f'AmountLattice: step {step} not positive'
+        self._x0 = x0
+        self._x1 = x1
+        self._step = step
+        self._offsets = sorted(set(offsets))
+        assert all(0 <= off < step for off in self._offsets), f'AmountLattice: offsets {offsets} not in [0,{step})'
+        # lattice indices of the first point > x0 and first point >= x1
+        self._lo = self._count_le(x0)
+        self._hi = self._count_le(x1 - 1)
+
+    # number of lattice values <= x
+    def _count_le(self, x: int) -> int:
+        return (x // self._step) * len(self._offsets) + bisect.bisect_right(self._offsets, x % self._step)
+
+    def _value(self, j: int) -> int:
+        m = len(self._offsets)
+        return (j // m) * self._step + self._offsets[j % m]
+
+    def __len__(self) -> int:
+        return self._hi - self._lo + 2
+
+    def __getitem__(self, i):  # type: ignore[override]
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError(f'AmountLattice index {i} out of range')
+        if i == 0:
+            return self._x0
+        if i == n - 1:
+            return self._x1
+        return self._value(self._lo + i - 1)
 
 class ExtractInvestment:
     def __init__(self,
@@ -57,21 +200,81 @@ class ExtractInvestment:
                  min_investment: int,
                  max_investment: int,
                  max_day_error: int = 8,
-                 src_is_cumulative: bool = True) -> None:
+                 src_is_cumulative: bool = True,
+                 jobs: int = 1,
+                 batched: bool = False,
+                 split_k: int = 2,
+                 lattice: Optional[Sequence[int]] = None,
+                 use_amounts: bool = False,
+                 query_metrics: metrics.QueryMetrics | None = None,
+                 metrics_label: str = '',
+                 check_fingerprint: bool = False,
+                 quiesce_interval: float = 5.0,
+                 quiesce_timeout: float = 300.0) -> None:
         self._src = src
         self._max_day = max_day
         self._min_inv = min_investment
         self._max_inv = max_investment
         self._max_day_error = max_day_error
         self._src_is_cumulative = src_is_cumulative
+        # number of days fast_extraction works on concurrently.  src
+        # must be thread safe if this is more than 1.
+        self._jobs = jobs
+        # use the level-synchronous search, evaluating each level's
+        # probes with one src.batch call
+        # split search intervals split_k ways; only useful (and only
+        # implemented) with batched probes, so split_k > 2 implies
+        # batched.
+        self._split_k = split_k
+        self._batched = batched or split_k > 2
+        self._stats = SearchStats()
+        # candidate amounts (e.g., an AmountLattice over [0,
+        # max_investment]) searched first by fast extraction
+        self._lattice = lattice
+        # let fast extraction settle intervals holding a single
+        # investment from the amount totals (unbatched search only)
+        self._use_amounts = use_amounts
+        # per-day wall time and investment counts are recorded under
+        # metrics_label (the slug)
+        self._metrics = query_metrics
+        self._metrics_label = metrics_label
+        # compare each day's fresh totals before and after extracting
+        # it, and wait for a changing day to settle (no change for
+        # quiesce_interval seconds, giving up after quiesce_timeout)
+        # before extracting it again
+        self._check_fingerprint = check_fingerprint
+        self._quiesce_interval = quiesce_interval
+        self._quiesce_timeout = quiesce_timeout
 
+        # protects the daily totals, which are refreshed by
+        # invalidate_changed when the data changes under a search
+        self._daily_lock = threading.Lock()
         self._daily_data: list[Tuple[int, int]] = []
         self._daily_amt: list[int] = [ -1 ] * max_day
         self._daily_count: list[int] = [ 0 ] * max_day
 
-    def compute_daily_data(self):
-        for day in range(self._max_day):
-            self._daily_data.append(self._src(None, day))
+    def search_stats(self) -> SearchStats:
+        return self._stats
+
+    def record_day(self, day: int, start: float, day_list: list[Tuple[int, int]]) -> None:
+        if self._metrics is not None:
+            self._metrics.record_day(self._metrics_label, day, time.monotonic() - start, len(day_list))
+
+    # the day's own counts (and amounts), whether or not the source
+    # is cumulative
+    def day_func(self, day: int) -> BisectFunc:
+        if self._src_is_cumulative:
+            return CumulativeCountBisectFunc(self._src, day, self._max_day)
+        return DailyCountBisectFunc(self._src, day)
+
+    def bisect_func(self, day: int) -> BisectFunc:
+        return CountingBisectFunc(self.day_func(day), self._stats)
+
+    # fresh reads the totals from the source itself rather than from
+    # its cache
+    def compute_daily_data(self, fresh: bool = False):
+        query = self._src.real_work if fresh else self._src
+        self._daily_data = [query(None, day) for day in range(self._max_day)]
 
         if self._src_is_cumulative:
             for day in range(0, self._max_day - 1):
@@ -86,8 +289,100 @@ class ExtractInvestment:
                 self._daily_amt[day] = self._daily_data[day][0]
                 self._daily_count[day] = self._daily_data[day][1]
 
+    # Called when the search for day saw inconsistent counts, i.e., the
+    # data changed under it.  Rather than flushing the whole cache,
+    # re-read the (uncached) day totals to find the days that changed
+    # and forget only the cached queries those changes affect: the
+    # changed days' queries if src is day-specific, and the queries
+    # for all dates up to the latest changed day if src is cumulative.
+    # The queries day's own search uses are forgotten too, in case the
+    # totals did not show the change (or were not yet known).
+    def invalidate_changed(self, day: int) -> None:
+        with self._daily_lock:
+            known = len(self._daily_data) == self._max_day
+            old_amt = list(self._daily_amt)
+            old_count = list(self._daily_count)
+            self.compute_daily_data(fresh=True)
+            if known:
+                changed = [d for d in range(self._max_day)
+                           if (old_amt[d], old_count[d]) != (self._daily_amt[d], self._daily_count[d])]
+            else:
+                changed = []
+        if verbose > 0:
+            sys.stderr.write(f'day {day}: invalidating changed days {changed}\n')
+        if self._src_is_cumulative:
+            if changed:
+                self._src.invalidate_days(0, max(changed))
+            self._src.invalidate_days(day, min(day + 1, self._max_day - 1))
+        else:
+            for d in set(changed + [day]):
+                self._src.invalidate_days(d, d)
+
+    # The uncached threshold None totals that the search for day
+    # depends on: the day's own, and in cumulative mode also the next
+    # day's, since the day's counts are differences of the two.
+    def day_fingerprint(self, day: int) -> Tuple[Tuple[int, int], ...]:
+        days = [day]
+        if self._src_is_cumulative and day + 1 < self._max_day:
+            days.append(day + 1)
+        return tuple(self._src.real_work(None, d) for d in days)
+
+    # the fingerprint implied by the last compute_daily_data, or None
+    def known_fingerprint(self, day: int) -> Tuple[Tuple[int, int], ...] | None:
+        with self._daily_lock:
+            if len(self._daily_data) != self._max_day:
+                return None
+            if self._src_is_cumulative and day + 1 < self._max_day:
+                return (self._daily_data[day], self._daily_data[day + 1])
+            return (self._daily_data[day],)
+
+    # Poll the day's fingerprint until it stays the same for
+    # quiesce_interval seconds, and return it.  Gives up (returning
+    # the latest fingerprint) after quiesce_timeout seconds.
+    def wait_for_quiescence(self, day: int) -> Tuple[Tuple[int, int], ...]:
+        deadline = time.monotonic() + self._quiesce_timeout
+        fingerprint = self.day_fingerprint(day)
+        while True:
+            if time.monotonic() + self._quiesce_interval > deadline:
+                sys.stderr.write(f'day {day} did not settle in {self._quiesce_timeout}s; extracting anyway\n')
+                return fingerprint
+            time.sleep(self._quiesce_interval)
+            latest = self.day_fingerprint(day)
+            if latest == fingerprint:
+                return fingerprint
+            fingerprint = latest
+
+    # Run extract_day(day) between two fingerprint checks.  If the day
+    # is already changing before the search starts, or changed while
+    # it ran, its cached queries are invalidated and the extraction
+    # waits for the day to settle before (re)spending the search's
+    # queries, instead of failing deep inside a bisection.
+    def checked_extract_day(self, extract_day: Callable[[int], list[Tuple[int, int]]],
+                            day: int) -> list[Tuple[int, int]]:
+        before = self.day_fingerprint(day)
+        if before != self.known_fingerprint(day):
+            sys.stderr.write(f'day {day} is changing; waiting for it to settle\n')
+            before = self.wait_for_quiescence(day)
+            self.invalidate_changed(day)
+        unstable_count = 0
+        while True:
+            day_list = extract_day(day)
+            after = self.day_fingerprint(day)
+            if after == before:
+                return day_list
+            unstable_count += 1
+            if unstable_count >= self._max_day_error:
+                sys.stderr.write(f'max day error exceeded, aborting\n')
+                raise RuntimeError('Max day error exceeded')
+            sys.stderr.write(f'day {day} changed during extraction; waiting for it to settle\n')
+            before = self.wait_for_quiescence(day)
+            self.invalidate_changed(day)
+
     def extract_investments(self) -> list[Tuple[int, int]]:
         self.compute_daily_data()
+        return self.extract_days(self.bisect_extract_day, jobs=1)
+
+    def bisect_extract_day(self, day: int) -> list[Tuple[int, int]]:
         # daily_amt has total for a day, but we do not yet know what the
         # individual transaction amounts are yet.
 
@@ -96,120 +391,200 @@ class ExtractInvestment:
         # that the decrease could be by more than 1, since there could
         # be two transactions with the same amount.
 
-        investments: list[Tuple[int, int]] = []
         qf = self._src
-        for day in range(self._max_day):
-            day_column_done = False
-            day_error_count = 0
-            while not day_column_done:
-                count = self._daily_count[day]
-                if self._src_is_cumulative:
-                    func: BisectFunc = CumulativeCountBisectFunc(qf, day, self._max_day)
-                else:
-                    func = DailyCountBisectFunc(qf, day)
+        day_column_done = False
+        day_error_count = 0
+        while not day_column_done:
+            count = self._daily_count[day]
+            func = self.bisect_func(day)
+            day_amounts = self.day_func(day)
+            day_list: list[Tuple[int, int]] = []
 
-                count_history = []
-                while count > 0:
-                    count_history.append(count)
-                    try:
+            count_history = []
+            while count > 0:
+                count_history.append(count)
+                try:
+                    if self._split_k > 2:
+                        value = fbisect.find_last_ge_kary(func.batch,
+                                                          count,
+                                                          self._min_inv,
+                                                          self._max_inv,
+                                                          self._split_k)
+                    else:
                         value = fbisect.find_last_ge(func,
                                                      count,
                                                      self._min_inv,
                                                      self._max_inv)
-                    except AssertionError as e:
-                        sys.stderr.write(f'bisection assertion error ({e}); retrying day {day}\n')
-                        break
-                    if verbose > 1:
-                        sys.stderr.write(f'{count} {func(value)} {func(value+1)}\n')
-                    if count != func(value):
-                        # this occurs if there's live new data
-                        sys.stderr.write(f'bisection count changed, history {count_history}; retrying day {day}\n')
-                        sys.stderr.write(f'count ({count}) != func({value}) ({func(value)}): nearby: {func(value-1)} {func(value)} {func(value+1)}\n')
-                        sys.stderr.write(f'qf({value},{day}) = {qf(value,day)}\n')
-                        sys.stderr.write(f'qf({value+1},{day}) = {qf(value+1,day)}\n')
-                        sys.stderr.write(f'qf({value},{day+1}) = {qf(value,day+1)}\n')
-                        sys.stderr.write(f'qf({value+1},{day+1}) = {qf(value+1,day+1)}\n')
+                except AssertionError as e:
+                    sys.stderr.write(f'bisection assertion error ({e}); retrying day {day}\n')
+                    break
+                if verbose > 1:
+                    sys.stderr.write(f'{count} {func(value)} {func(value+1)}\n')
+                if count != func(value):
+                    # this occurs if there's live new data
+                    sys.stderr.write(f'bisection count changed, history {count_history}; retrying day {day}\n')
+                    sys.stderr.write(f'count ({count}) != func({value}) ({func(value)}): nearby: {func(value-1)} {func(value)} {func(value+1)}\n')
+                    sys.stderr.write(f'qf({value},{day}) = {qf(value,day)}\n')
+                    sys.stderr.write(f'qf({value+1},{day}) = {qf(value+1,day)}\n')
+                    sys.stderr.write(f'qf({value},{day+1}) = {qf(value,day+1)}\n')
+                    sys.stderr.write(f'qf({value+1},{day+1}) = {qf(value+1,day+1)}\n')
+                    break
+
+                new_count = func(value+1)
+                count_changed = count - new_count
+                if verbose > 1:
+                    sys.stderr.write(f'new_count = {new_count}, func({value+1}) = {func(value+1)}\n')
+                    if count_changed <= 0:
+                        sys.stderr.write(f'bisection count change ({count}-{new_count}={count_changed}) not positive, history {count_history}; retrying day {day}\n')
                         break
+                # investment totals at value and value+1 for today only
+                # (not the search's probes, so they are not counted)
+                amount_ge = day_amounts.amount_and_count(value)[0]
+                amount_gt = day_amounts.amount_and_count(value+1)[0]
+                investment_diff = amount_ge - amount_gt
 
-                    new_count = func(value+1)
-                    count_changed = count - new_count
-                    if verbose > 1:
-                        sys.stderr.write(f'new_count = {new_count}, func({value+1}) = {func(value+1)}\n')
-                        if count_changed <= 0:
-                            sys.stderr.write(f'bisection count change ({count}-{new_count}={count_changed}) not positive, history {count_history}; retrying day {day}\n')
-                            break
-                    # investment totals at value and value+1 for today
-                    investment_diff = (self._src(value, day)[0] - self._src(value+1, day)[0])
-
-                    # Sometimes investment_diff is not evenly divisible by
-                    # count_changed.  My guess is that this represents
-                    # fees charged by issuance.
-
-                    if investment_diff % count_changed != 0:
-                        sys.stderr.write(f'FEES? investment_diff = {investment_diff}, count_changed = {count_changed}\n')
-                        sys.stderr.write(f'qf({value},{day}) = {qf(value,day)}\n')
-                        sys.stderr.write(f'qf({value+1},{day}) = {qf(value+1,day)}\n')
-                        sys.stderr.write(f'qf({value},{day+1}) = {qf(value,day+1)}\n')
-                        sys.stderr.write(f'qf({value+1},{day+1}) = {qf(value+1,day+1)}\n')
-
-                    # investment = investment_diff // count_changed
-                    # investment > value due to fees
-                    for _ in range(count_changed):
-                        investments.append((day, value))
-                    count = new_count
-                # we may have exited early due to new data arriving,
-                # in which case we re-extract the entire day's
-                # investment
-                day_column_done = count == 0
-                if not day_column_done:
-                    day_error_count += 1
-                    if day_error_count >= self._max_day_error:
-                        sys.stderr.write(f'max day error exceeded, aborting\n')
-                        raise RuntimeError('Max day error exceeded')
-                    sys.stderr.write('sanity check violation. likely new data incorporated.\n')
-                    qf.flush_cache()
-                    self.compute_daily_data()
-            # redo column?
-        return investments
+                # Sometimes investment_diff is not evenly divisible by
+                # count_changed.  My guess is that this represents
+                # fees charged by issuance.
+
+                if amount_ge != -1 and amount_gt != -1 and investment_diff % count_changed != 0:
+                    sys.stderr.write(f'FEES? investment_diff = {investment_diff}, count_changed = {count_changed}\n')
+                    sys.stderr.write(f'qf({value},{day}) = {qf(value,day)}\n')
+                    sys.stderr.write(f'qf({value+1},{day}) = {qf(value+1,day)}\n')
+                    sys.stderr.write(f'qf({value},{day+1}) = {qf(value,day+1)}\n')
+                    sys.stderr.write(f'qf({value+1},{day+1}) = {qf(value+1,day+1)}\n')
+
+                # investment = investment_diff // count_changed
+                # investment > value due to fees
+                for _ in range(count_changed):
+                    day_list.append((day, value))
+                count = new_count
+            # we may have exited early due to new data arriving,
+            # in which case we re-extract the entire day's
+            # investment
+            day_column_done = count == 0
+            if not day_column_done:
+                day_error_count += 1
+                if day_error_count >= self._max_day_error:
+                    sys.stderr.write(f'max day error exceeded, aborting\n')
+                    raise RuntimeError('Max day error exceeded')
+                sys.stderr.write('sanity check violation. likely new data incorporated.\n')
+                self.invalidate_changed(day)
+        return day_list
 
     def fast_extraction(self) -> list[Tuple[int, int]]:
-        investments: list[Tuple[int, int]] = []
-        qf = self._src
+        return self.extract_days(self.fast_extract_day)
+
+    # Re-extract only the days that changed since a previous
+    # extraction.  baseline is the previous output, a list of (day,
+    # value) pairs.  A day is reused from the baseline if its
+    # (threshold=None) count matches the baseline's number of
+    # investments; otherwise it is extracted anew.  Amounts are not
+    # compared, since the day's amount total includes fees that the
+    # extracted values do not add up to.  So a day whose count stayed
+    # the same while its contents changed (e.g., a cancellation and a
+    # new investment) is reused; a full extraction picks that up.
+    def incremental_extraction(self, baseline: list[Tuple[int, int]]) -> list[Tuple[int, int]]:
+        self.compute_daily_data()
+        previous: Dict[int, list[Tuple[int, int]]] = dict()
         for day in range(self._max_day):
-            day_column_done = False
-            day_error_count = 0
-            while not day_column_done:
-                if self._src_is_cumulative:
-                    func: BisectFunc = CumulativeCountBisectFunc(qf, day, self._max_day)
+            previous[day] = []
+        for day, value in baseline:
+            if day in previous:
+                previous[day].append((day, value))
+
+        def extract_day(day: int) -> list[Tuple[int, int]]:
+            if self.baseline_day_matches(day, previous[day]):
+                return previous[day]
+            if verbose > 0:
+                sys.stderr.write(f'day {day} changed; extracting\n')
+            return self.fast_extract_day(day)
+
+        return self.extract_days(extract_day)
+
+    def baseline_day_matches(self, day: int, day_list: list[Tuple[int, int]]) -> bool:
+        return self._daily_count[day] == len(day_list)
+
+    # Days are independent of each other, so with jobs > 1 they are
+    # extracted concurrently.  Results are gathered in day order, so
+    # the output is identical to the serial case.  jobs overrides the
+    # constructor's jobs.
+    def extract_days(self, extract_day: Callable[[int], list[Tuple[int, int]]],
+                     jobs: int | None = None) -> list[Tuple[int, int]]:
+        def timed_extract_day(day: int) -> list[Tuple[int, int]]:
+            start = time.monotonic()
+            if self._check_fingerprint:
+                day_list = self.checked_extract_day(extract_day, day)
+            else:
+                day_list = extract_day(day)
+            self.record_day(day, start, day_list)
+            return day_list
+
+        if jobs is None:
+            jobs = self._jobs
+        if self._check_fingerprint and self.known_fingerprint(0) is None:
+            self.compute_daily_data()
+        days = range(self._max_day)
+        if jobs > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                day_lists = list(pool.map(timed_extract_day, days))
+        else:
+            day_lists = [timed_extract_day(day) for day in days]
+        investments: list[Tuple[int, int]] = []
+        for day_list in day_lists:
+            investments += day_list
+        return investments
+
+    def fast_extract_day(self, day: int) -> list[Tuple[int, int]]:
+        day_column_done = False
+        day_error_count = 0
+        while not day_column_done:
+            func = self.bisect_func(day)
+            day_amounts = self.day_func(day)
+            day_list = []
+            try:
+                if self._lattice is not None:
+                    fbatch = func.batch if self._batched else None
+                    day_investments = find_jumps.find_lasts_lattice(func, self._lattice, fbatch, self._split_k)
+                elif self._batched:
+                    day_investments = find_jumps.find_lasts_batched(func.batch, 0, self._max_inv, self._split_k)
+                elif self._use_amounts:
+                    day_investments = find_jumps.find_lasts_amounts(func.amount_and_count, 0, self._max_inv)
                 else:
-                    func = DailyCountBisectFunc(qf, day)
-                day_list = []
-                try:
                     day_investments = find_jumps.find_lasts(func, 0, self._max_inv)
-                except AssertionError as e:
-                    sys.stderr.write(f'bisection assertion error ({e}); retrying at day {day}\n')
-                    day_error_count += 1
-                    if day_error_count >= self._max_day_error:
-                        break
-                retry = False
-                for x in day_investments:
+            except AssertionError as e:
+                sys.stderr.write(f'bisection assertion error ({e}); retrying at day {day}\n')
+                day_error_count += 1
+                if day_error_count >= self._max_day_error:
+                    break
+                self.invalidate_changed(day)
+                continue
+            retry = False
+            if self._batched:
+                n = len(day_investments)
+                counts = func.batch(day_investments + [x + 1 for x in day_investments])
+            for ix, x in enumerate(day_investments):
+                if self._batched:
+                    count = counts[ix]
+                    new_count = counts[n + ix]
+                else:
                     count = func(x)
                     new_count = func(x + 1)
-                    count_changed = count - new_count
-                    if count_changed <= 0:
-                        sys.stderr.write(f'count change not positive; retrying day {day}\n')
-                        retry = True
-                        break
-                    for _ in range(count_changed):
-                        day_list.append((day, x))
-                if not retry:
-                    day_column_done = True
-                else:
-                    day_error_count += 1
-                    if day_error_count >= self._max_day_error:
-                        break
-            if not day_column_done:
-                sys.stderr.write(f'max day error exceeded, aborting\n')
-                raise RuntimeError('Max day error exceeded')
-            investments += day_list
-        return investments
+                count_changed = count - new_count
+                if count_changed <= 0:
+                    sys.stderr.write(f'count change not positive; retrying day {day}\n')
+                    retry = True
+                    break
+                for _ in range(count_changed):
+                    day_list.append((day, x))
+            if not retry:
+                day_column_done = True
+            else:
+                day_error_count += 1
+                if day_error_count >= self._max_day_error:
+                    break
+                self.invalidate_changed(day)
+        if not day_column_done:
+            sys.stderr.write(f'max day error exceeded, aborting\n')
+            raise RuntimeError('Max day error exceeded')
+        return day_list
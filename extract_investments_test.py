@@ -6,16 +6,60 @@ import random
 import sys
 import unittest
 
+import cache
 import extract_investments
+import investment_data
 import issuance
 import synthetic_investments
 
-from typing import Callable, Dict
+from typing import Any, Callable, Dict, Tuple
 
 SEEDENV = 'EXTRACT_SEED'
 
 seed: int = 0
 
+# A cached view of a SyntheticInvestmentData, so that cache
+# invalidation can be observed.
+class CachedInvestmentData(investment_data.InvestmentData):
+    def __init__(self, si: synthetic_investments.SyntheticInvestmentData) -> None:
+        self._si = si
+        self._cache: cache.FuncCache | None = None
+        self.real_queries = 0
+        # (n, investment): investment arrives at the nth real query for
+        # its day with a threshold
+        self.late: Tuple[int, Tuple[int, int]] | None = None
+        self._late_queries = 0
+
+    def __call__(self, threshold: int | None, date: int) -> Tuple[int, int]:
+        assert self._cache is not None
+        return self._cache(threshold, date)
+
+    def real_work(self, threshold: int | None, date: int) -> Tuple[int, int]:
+        self.real_queries += 1
+        if self.late is not None and threshold is not None and date == self.late[1][0]:
+            self._late_queries += 1
+            if self._late_queries == self.late[0]:
+                self._si.add_investments([self.late[1]])
+        return self._si(threshold, date)
+
+    def enable_cache(self, store: cache.CacheStore | None = None,
+                     max_entries: int = 0, ttl: float = 0.0) -> None:
+        self._cache = cache.FuncCache(self.real_work, store, max_entries, ttl)
+
+    def flush_cache(self):
+        assert self._cache is not None
+        self._cache.flush_cache()
+
+    def cache(self) -> cache.FuncCache | None:
+        return self._cache
+
+    def set_cache(self, c: Dict[Any, Any]) -> None:
+        assert self._cache is not None
+        self._cache.set_cache(c)
+
+    def set_progress_period(self, p: int) -> None:
+        return
+
 class TestExtraction(unittest.TestCase):
     def test_synth(self) -> None:
         assert(seed != 0)
@@ -33,14 +77,14 @@ class TestExtraction(unittest.TestCase):
         daily: Dict[int, int] = dict()
         for day in range(num_days):
             daily[day] = 0
-        for day, value in si._investments:
+        for day, value in si.investments():
             daily[day] += value
         daily_totals = set(daily.items())
         extracted_totals = set((d, extractor._daily_amt[d]) for d in range(num_days))
         self.assertEqual(daily_totals, extracted_totals)
 
         iset = set(investments)
-        siset = set(si._investments)
+        siset = set(si.investments())
         self.assertEqual(iset, siset)
         sys.stdout.write(f'si.num_queries() = {si.num_queries()}\n')
 
@@ -62,17 +106,225 @@ class TestExtraction(unittest.TestCase):
         daily: Dict[int, int] = dict()
         for day in range(num_days):
             daily[day] = 0
-        for day, value in si._investments:
+        for day, value in si.investments():
             daily[day] += value
         daily_totals = set(daily.items())
         extracted_totals = set((d, extractor._daily_amt[d]) for d in range(num_days))
         self.assertEqual(daily_totals, extracted_totals)
 
         iset = set(investments)
-        siset = set(si._investments)
+        siset = set(si.investments())
         self.assertEqual(iset, siset)
         sys.stdout.write(f'si.num_queries() = {si.num_queries()}\n')
 
+    def test_parallel_fast(self) -> None:
+        assert(seed != 0)
+        rng = random.Random(seed + 2)
+        num_entries = 100
+        num_days = 30
+        min_inv = 500
+        max_inv = 10_000
+        si = synthetic_investments.SyntheticInvestmentData(
+            num_entries, num_days, min_inv, max_inv, rng.randrange)
+        serial = extract_investments.ExtractInvestment(
+            si, num_days, min_inv, max_inv)
+        parallel = extract_investments.ExtractInvestment(
+            si, num_days, min_inv, max_inv, jobs=4)
+
+        serial_investments = serial.fast_extraction()
+        parallel_investments = parallel.fast_extraction()
+        self.assertEqual(serial_investments, parallel_investments)
+        self.assertEqual(sorted(parallel_investments), sorted(si.investments()))
+
+    def test_batched_fast(self) -> None:
+        assert(seed != 0)
+        rng = random.Random(seed + 3)
+        num_entries = 100
+        num_days = 30
+        min_inv = 500
+        max_inv = 10_000
+        si = synthetic_investments.SyntheticInvestmentData(
+            num_entries, num_days, min_inv, max_inv, rng.randrange)
+        serial = extract_investments.ExtractInvestment(
+            si, num_days, min_inv, max_inv)
+        batched = extract_investments.ExtractInvestment(
+            si, num_days, min_inv, max_inv, batched=True)
+
+        self.assertEqual(serial.fast_extraction(), batched.fast_extraction())
+
+    def test_incremental(self) -> None:
+        assert(seed != 0)
+        rng = random.Random(seed + 4)
+        num_entries = 200
+        num_days = 30
+        min_inv = 500
+        max_inv = 10_000
+        si = synthetic_investments.SyntheticInvestmentData(
+            num_entries, num_days, min_inv, max_inv, rng.randrange)
+        extractor = extract_investments.ExtractInvestment(
+            si, num_days, min_inv, max_inv)
+        baseline = extractor.fast_extraction()
+
+        # late-arriving investments on the last two days
+        si.add_investments([(num_days - 1, 777), (num_days - 2, 5000), (num_days - 2, 5000)])
+        si.reset_num_queries()
+        extractor = extract_investments.ExtractInvestment(
+            si, num_days, min_inv, max_inv)
+        investments = extractor.incremental_extraction(baseline)
+        incremental_queries = si.num_queries()
+        self.assertEqual(sorted(investments), sorted(si.investments()))
+
+        si.reset_num_queries()
+        extractor = extract_investments.ExtractInvestment(
+            si, num_days, min_inv, max_inv)
+        self.assertEqual(investments, extractor.fast_extraction())
+        self.assertLess(incremental_queries, si.num_queries())
+
+        # days are matched by count alone, since the day's amount
+        # includes fees that the values do not: a baseline day whose
+        # values do not add up to the day's amount is still reused
+        fee_day = investments[0][0]
+        feed = [(day, value + 1 if day == fee_day else value) for day, value in investments]
+        extractor = extract_investments.ExtractInvestment(
+            si, num_days, min_inv, max_inv)
+        self.assertEqual(extractor.incremental_extraction(feed), feed)
+
+    def test_kary(self) -> None:
+        assert(seed != 0)
+        rng = random.Random(seed + 5)
+        num_entries = 100
+        num_days = 10
+        min_inv = 500
+        max_inv = 10_000
+        si = synthetic_investments.SyntheticInvestmentData(
+            num_entries, num_days, min_inv, max_inv, rng.randrange)
+        expected = extract_investments.ExtractInvestment(
+            si, num_days, min_inv, max_inv).fast_extraction()
+        rounds = dict()
+        for k in [2, 8]:
+            extractor = extract_investments.ExtractInvestment(
+                si, num_days, min_inv, max_inv, batched=True, split_k=k)
+            self.assertEqual(extractor.fast_extraction(), expected)
+            stats = extractor.search_stats()
+            rounds[k] = stats.rounds()
+            sys.stdout.write(f'k={k}: {rounds[k]} rounds, {stats.probes()} probes, {stats.queries()} queries\n')
+            # cumulative: two queries per probe, except on the last day
+            self.assertLess(stats.probes(), stats.queries())
+            self.assertLessEqual(stats.queries(), 2 * stats.probes())
+        self.assertLess(rounds[8], rounds[2])
+
+        old_style = extract_investments.ExtractInvestment(
+            si, num_days, min_inv, max_inv, split_k=4)
+        self.assertEqual(sorted(old_style.extract_investments()), sorted(expected))
+
+    def test_lattice(self) -> None:
+        assert(seed != 0)
+        rng = random.Random(seed + 6)
+        num_entries = 100
+        num_days = 10
+        min_inv = 500
+        max_inv = 1_000_000
+        share_price = 1085
+        fees = [0, 350]
+        si = synthetic_investments.SyntheticInvestmentData(
+            num_entries, num_days, min_inv, max_inv, rng.randrange)
+        # mostly whole shares plus fees, with a few off-lattice amounts
+        si.set_investments([
+            (day, (value // share_price) * share_price + rng.choice(fees) if ix % 10 else value)
+            for ix, (day, value) in enumerate(si.investments())])
+        expected = extract_investments.ExtractInvestment(
+            si, num_days, min_inv, max_inv).fast_extraction()
+        full_queries = si.num_queries()
+
+        lattice = extract_investments.AmountLattice(0, max_inv, share_price, fees)
+        for batched in [False, True]:
+            si.reset_num_queries()
+            extractor = extract_investments.ExtractInvestment(
+                si, num_days, min_inv, max_inv, batched=batched, lattice=lattice)
+            self.assertEqual(extractor.fast_extraction(), expected)
+            self.assertLess(si.num_queries(), full_queries)
+
+    def test_use_amounts(self) -> None:
+        assert(seed != 0)
+        rng = random.Random(seed + 7)
+        num_entries = 30
+        num_days = 20
+        min_inv = 500
+        max_inv = 1_000_000
+        si = synthetic_investments.SyntheticInvestmentData(
+            num_entries, num_days, min_inv, max_inv, rng.randrange)
+        plain = extract_investments.ExtractInvestment(
+            si, num_days, min_inv, max_inv)
+        expected = plain.fast_extraction()
+        amounts = extract_investments.ExtractInvestment(
+            si, num_days, min_inv, max_inv, use_amounts=True)
+        self.assertEqual(amounts.fast_extraction(), expected)
+        self.assertLess(amounts.search_stats().probes(), plain.search_stats().probes())
+
+    def test_invalidate_changed(self) -> None:
+        assert(seed != 0)
+        rng = random.Random(seed + 8)
+        num_entries = 100
+        num_days = 20
+        min_inv = 500
+        max_inv = 10_000
+        late_day = 12
+        for day_specific in [True, False]:
+            si = synthetic_investments.SyntheticInvestmentData(
+                num_entries, num_days, min_inv, max_inv, rng.randrange, day_specific)
+            src = CachedInvestmentData(si)
+            src.enable_cache()
+            extractor = extract_investments.ExtractInvestment(
+                src, num_days, min_inv, max_inv, src_is_cumulative=not day_specific)
+            extractor.compute_daily_data()
+            before = extractor.fast_extraction()
+            assert src._cache is not None
+            cached = set(src._cache.cache().keys())
+
+            si.add_investments([(late_day, 4321)])
+            extractor.invalidate_changed(late_day)
+            kept = set(src._cache.cache().keys())
+            if day_specific:
+                expected_kept = set(k for k in cached if k[1] != late_day)
+            else:
+                expected_kept = set(k for k in cached if k[1] > late_day + 1)
+            # the totals are re-read around the cache, so the unaffected
+            # days' cached totals are kept too
+            self.assertEqual(kept, expected_kept)
+            self.assertEqual(src._cache.stats()['invalidations'], len(cached - kept))
+
+            # re-extraction queries only what was forgotten
+            src.real_queries = 0
+            self.assertEqual(sorted(extractor.fast_extraction()), sorted(si.investments()))
+            self.assertGreater(len(kept), 0)
+            self.assertLess(src.real_queries, len(cached))
+            self.assertNotEqual(before, extractor.fast_extraction())
+
+    def test_fingerprint(self) -> None:
+        assert(seed != 0)
+        rng = random.Random(seed + 9)
+        num_entries = 100
+        num_days = 20
+        min_inv = 500
+        max_inv = 10_000
+        for day_specific in [True, False]:
+            for nth in [1, 5]:
+                for fast in [True, False]:
+                    si = synthetic_investments.SyntheticInvestmentData(
+                        num_entries, num_days, min_inv, max_inv, rng.randrange, day_specific)
+                    src = CachedInvestmentData(si)
+                    src.enable_cache()
+                    src.late = (nth, (7, 4321))
+                    extractor = extract_investments.ExtractInvestment(
+                        src, num_days, min_inv, max_inv, src_is_cumulative=not day_specific,
+                        check_fingerprint=True, quiesce_interval=0.01)
+                    if fast:
+                        investments = extractor.fast_extraction()
+                    else:
+                        investments = extractor.extract_investments()
+                    self.assertIn((7, 4321), si.investments())
+                    self.assertEqual(sorted(investments), sorted(si.investments()))
+
 if __name__ == '__main__':
     if SEEDENV in os.environ:
         seed = int(os.environ[SEEDENV], 16)
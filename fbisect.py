@@ -4,7 +4,7 @@
 # doing bisection using an univariate monotonically non-decreasing (or
 # non-increasing) function from integers to integers.
 
-from typing import Callable
+from typing import Callable, List
 
 # range R = \left\[x0,x1\right\]
 
@@ -121,3 +121,43 @@ def find_last_ge_intern(f: Callable[[int], int],
 
     # f(xmid) < ythreshold
     return find_last_ge_intern(f, ythreshold, x0, xmid)
+
+# k-ary variants.  Instead of a single midpoint, the k-1 points that
+# split the range into k (nearly) equal parts are evaluated together
+# by fbatch, which maps a list of inputs to the list of f values.
+# When fbatch evaluates its inputs concurrently, this reduces the
+# number of sequential rounds by a factor of log2(k), at the cost of
+# (k-1)/log2(k) times as many evaluations.
+
+# returns the distinct points strictly between x0 and x1 that split
+# \left\[x0,x1\right\] into k parts.  requires x0 + 1 < x1.
+def kary_split(x0: int, x1: int, k: int) -> List[int]:
+    assert k >= 2, f'kary_split: k={k} < 2'
+    points: List[int] = []
+    for i in range(1, k):
+        x = x0 + (x1 - x0) * i // k
+        if x0 < x < x1 and (not points or points[-1] < x):
+            points.append(x)
+    return points
+
+# f is monotonically nonincreasing.  Same result as find_last_ge.
+def find_last_ge_kary(fbatch: Callable[[List[int]], List[int]],
+                      ythreshold: int,
+                      x0: int,
+                      x1: int,
+                      k: int) -> int:
+    assert x0 <= x1, f'find_last_ge_kary: {x0}>{x1}: empty range'  # non-empty range
+    y0, y1 = fbatch([x0, x1])
+    assert y0 >= ythreshold, f'find_last_ge_kary: f({x0})={y0}<{ythreshold}: left end of range below threshold'
+    if y1 >= ythreshold:
+        return x1
+    # invariant: f(x0) >= ythreshold > f(x1)
+    while x0 + 1 < x1:
+        xs = kary_split(x0, x1, k)
+        for x, y in zip(xs, fbatch(xs)):
+            if y >= ythreshold:
+                x0 = x
+            else:
+                x1 = x
+                break
+    return x0
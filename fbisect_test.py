@@ -51,5 +51,24 @@ class TestSimpleSearch(unittest.TestCase):
                 lambda x: int(x * 200 + 300), 123, -1000, 1000),
             0)
 
+class TestKarySearch(unittest.TestCase):
+
+    def test_split(self):
+        self.assertEqual(fbisect.kary_split(0, 8, 2), [4])
+        self.assertEqual(fbisect.kary_split(0, 8, 4), [2, 4, 6])
+        self.assertEqual(fbisect.kary_split(0, 3, 8), [1, 2])
+
+    def test_last_ge(self):
+        data = [30, 20, 20, 10, 0, 0, -1, -1, -2] + [-i - 3 for i in range(1000)]
+        def f(ix):
+            return data[ix]
+        def fbatch(xs):
+            return [data[x] for x in xs]
+        for k in [2, 3, 4, 16]:
+            for y in [30, 20, 11, 10, 0, -1, -500]:
+                self.assertEqual(
+                    fbisect.find_last_ge_kary(fbatch, y, 0, len(data)-1, k),
+                    fbisect.find_last_ge(f, y, 0, len(data)-1))
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,7 +4,9 @@
 # non-increasing integer to integer function f where f(x) > f(x+1),
 # where x0 \le x \le x1.
 
-from typing import Callable
+from typing import Callable, Optional, Sequence, Tuple
+
+import fbisect
 
 def find_lasts(f: Callable[[int], int],
                x0: int,
@@ -42,3 +44,143 @@ def find_lasts_intern(f: Callable[[int], int],
         find_lasts_intern(f, x0, y0, xmid, ymid, g)
     if ymid > y1:
         find_lasts_intern(f, xmid, ymid, x1, y1, g)
+
+# Breadth-first (level-synchronous) variant of find_lasts.  Rather than
+# recursing into one interval at a time, the probe points of all open
+# intervals at one level of the search are evaluated together by
+# fbatch, which maps a list of inputs to the list of f values.  When
+# fbatch can evaluate its inputs concurrently, each level costs one
+# round trip instead of one per interval, i.e., about log(x1 - x0)
+# rounds rather than j log(x1 - x0) for j jumps.  With k > 2, each
+# interval is split k ways (see fbisect.kary_split), so there are
+# about log_k(x1 - x0) levels.  Returns the same (ascending) list as
+# find_lasts.
+def find_lasts_batched(fbatch: Callable[[list[int]], list[int]],
+                       x0: int,
+                       x1: int,
+                       k: int = 2) -> list[int]:
+    y0, y1 = fbatch([x0, x1])
+    if y0 == y1:
+        return []
+    assert y0 > y1, f'find_lasts_batched: {y0} < {y1}: not monotonically non-increasing / no jumps exists in range'  # precondition check
+    results = []
+    # each interval (x0, y0, x1, y1) satisfies the preconditions of
+    # find_lasts_intern
+    intervals = [(x0, y0, x1, y1)]
+    while intervals:
+        open_intervals = []
+        for iv in intervals:
+            if iv[0] + 1 == iv[2]:
+                results.append(iv[0])
+            else:
+                open_intervals.append(iv)
+        if not open_intervals:
+            break
+        splits = [fbisect.kary_split(a, b, k) for (a, _, b, _) in open_intervals]
+        ys = fbatch([x for xs in splits for x in xs])
+        intervals = []
+        ix = 0
+        for (a, ya, b, yb), xs in zip(open_intervals, splits):
+            xprev, yprev = a, ya
+            for x in xs + [b]:
+                if x == b:
+                    y = yb
+                else:
+                    y = ys[ix]
+                    ix += 1
+                if yprev > y:
+                    intervals.append((xprev, yprev, x, y))
+                xprev, yprev = x, y
+    results.sort()
+    return results
+
+# Lattice variant.  points is an ascending sequence of candidate
+# jump locations, with points[0] = x0 and points[-1] = x1.  The search
+# first runs over indices into points, so it costs about log(len(points))
+# evaluations per jump rather than log(x1 - x0).  A jump found between
+# points[i] and points[i+1] is accepted as a jump at points[i] if
+# f(points[i] + 1) == f(points[i+1]), i.e., f drops only at points[i];
+# otherwise the interval is searched in full.  Returns the same list as
+# find_lasts(f, x0, x1).  If fbatch is given, the searches are done
+# level-synchronously as in find_lasts_batched, splitting k ways.
+def find_lasts_lattice(f: Callable[[int], int],
+                       points: Sequence[int],
+                       fbatch: Optional[Callable[[list[int]], list[int]]] = None,
+                       k: int = 2) -> list[int]:
+    n = len(points)
+    assert n >= 2, f'find_lasts_lattice: {n} points, need at least 2'
+    if fbatch is None:
+        candidates = find_lasts(lambda i: f(points[i]), 0, n - 1)
+    else:
+        fb = fbatch
+        candidates = find_lasts_batched(lambda ixs: fb([points[i] for i in ixs]), 0, n - 1, k)
+    open_candidates = [i for i in candidates if points[i] + 1 < points[i + 1]]
+    checks = [points[i] + 1 for i in open_candidates] + [points[i + 1] for i in open_candidates]
+    if fbatch is None:
+        ys = [f(x) for x in checks]
+    else:
+        ys = fbatch(checks)
+    m = len(open_candidates)
+    off_lattice = set(i for j, i in enumerate(open_candidates) if ys[j] != ys[m + j])
+    results = []
+    for i in candidates:
+        if i not in off_lattice:
+            results.append(points[i])
+        elif fbatch is None:
+            results += find_lasts(f, points[i], points[i + 1])
+        else:
+            results += find_lasts_batched(fbatch, points[i], points[i + 1], k)
+    return results
+
+# Amount-aware variant.  f2(x) returns (amount, count), where count is
+# the monotonically non-increasing function f of find_lasts and amount
+# is the sum of the values of the items counted by count, or -1 if the
+# amount is not known (redacted).  If an interval \left\[x0,x1\right)
+# contains a single jump of size one, amount(x0) - amount(x1) is where
+# that jump should be; probing there (and one past it) either confirms
+# the jump immediately or splits the interval at that point, so no
+# evaluations are wasted when the guess is wrong (e.g., due to fees).
+# Otherwise, or if the amount is redacted, this is find_lasts.
+def find_lasts_amounts(f2: Callable[[int], Tuple[int, int]],
+                       x0: int,
+                       x1: int) -> list[int]:
+    a0, y0 = f2(x0)
+    a1, y1 = f2(x1)
+    if y0 == y1:
+        return []
+    assert y0 > y1, f'find_lasts_amounts: {y0} < {y1}: not monotonically non-increasing / no jumps exists in range'  # precondition check
+    results = []
+    def g(x):
+        results.append(x)
+    find_lasts_amounts_intern(f2, x0, a0, y0, x1, a1, y1, g)
+    return results
+
+def find_lasts_amounts_intern(f2: Callable[[int], Tuple[int, int]],
+                              x0: int,
+                              a0: int,
+                              y0: int,
+                              x1: int,
+                              a1: int,
+                              y1: int,
+                              g: Callable[[int], None]) -> None:
+    # preconditions as for find_lasts_intern
+    if x0 + 1 == x1:
+        g(x0)
+        return
+    if y0 - y1 == 1 and a0 != -1 and a1 != -1 and x0 <= a0 - a1 < x1:
+        xv = a0 - a1
+        av, yv = f2(xv)
+        av1, yv1 = f2(xv + 1)
+        if y0 > yv:
+            find_lasts_amounts_intern(f2, x0, a0, y0, xv, av, yv, g)
+        if yv > yv1:
+            g(xv)
+        if yv1 > y1:
+            find_lasts_amounts_intern(f2, xv + 1, av1, yv1, x1, a1, y1, g)
+        return
+    xmid = (x0 + x1) // 2
+    amid, ymid = f2(xmid)
+    if y0 > ymid:
+        find_lasts_amounts_intern(f2, x0, a0, y0, xmid, amid, ymid, g)
+    if ymid > y1:
+        find_lasts_amounts_intern(f2, xmid, amid, ymid, x1, a1, y1, g)
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+import random
+import unittest
+
+import find_jumps
+
+def make_step_func(values: list[int]):
+    # f(x) = number of values >= x, monotonically non-increasing
+    def f(x: int) -> int:
+        return len([v for v in values if v >= x])
+    return f
+
+class TestFindLasts(unittest.TestCase):
+
+    def test_simple(self):
+        f = make_step_func([3, 7, 7, 20])
+        self.assertEqual(find_jumps.find_lasts(f, 0, 100), [3, 7, 20])
+
+    def test_no_jumps(self):
+        f = make_step_func([])
+        self.assertEqual(find_jumps.find_lasts(f, 0, 100), [])
+
+class TestFindLastsBatched(unittest.TestCase):
+
+    def test_matches_find_lasts(self):
+        rng = random.Random(1)
+        for _ in range(20):
+            values = [rng.randrange(0, 1000) for _ in range(rng.randrange(0, 30))]
+            f = make_step_func(values)
+            rounds = []
+            def fbatch(xs):
+                rounds.append(len(xs))
+                return [f(x) for x in xs]
+            self.assertEqual(find_jumps.find_lasts_batched(fbatch, 0, 1000),
+                             find_jumps.find_lasts(f, 0, 1000))
+            # one round for the end points, then at most one per level
+            self.assertLessEqual(len(rounds), 1 + 10)
+
+    def test_kary(self):
+        rng = random.Random(2)
+        values = [rng.randrange(0, 1 << 20) for _ in range(50)]
+        f = make_step_func(values)
+        expected = find_jumps.find_lasts(f, 0, 1 << 20)
+        rounds = dict()
+        for k in [2, 4, 16]:
+            n = 0
+            def fbatch(xs):
+                nonlocal n
+                n += 1
+                return [f(x) for x in xs]
+            self.assertEqual(find_jumps.find_lasts_batched(fbatch, 0, 1 << 20, k),
+                             expected)
+            rounds[k] = n
+        self.assertLess(rounds[4], rounds[2])
+        self.assertLess(rounds[16], rounds[4])
+
+class TestFindLastsLattice(unittest.TestCase):
+
+    def test_lattice(self):
+        points = [0] + list(range(100, 10000, 100)) + [10000]
+        values = [100, 500, 500, 9900, 123, 9999, 0]
+        f = make_step_func(values)
+        expected = find_jumps.find_lasts(f, 0, 10000)
+        self.assertEqual(find_jumps.find_lasts_lattice(f, points), expected)
+        def fbatch(xs):
+            return [f(x) for x in xs]
+        for k in [2, 4]:
+            self.assertEqual(find_jumps.find_lasts_lattice(f, points, fbatch, k),
+                             expected)
+
+class TestFindLastsAmounts(unittest.TestCase):
+
+    def test_amounts(self):
+        rng = random.Random(3)
+        for _ in range(20):
+            values = [rng.randrange(0, 1 << 20) for _ in range(rng.randrange(0, 10))]
+            f = make_step_func(values)
+            probes = 0
+            def f2(x):
+                nonlocal probes
+                probes += 1
+                return (sum(v for v in values if v >= x), f(x))
+            self.assertEqual(find_jumps.find_lasts_amounts(f2, 0, 1 << 20),
+                             find_jumps.find_lasts(f, 0, 1 << 20))
+        # a single jump is found with the two end point probes and
+        # two more to confirm it
+        values = [12345]
+        f = make_step_func(values)
+        probes = 0
+        self.assertEqual(find_jumps.find_lasts_amounts(f2, 0, 1 << 20), values)
+        self.assertEqual(probes, 4)
+
+    def test_fees_and_redaction(self):
+        values = [100, 5000, 70000]
+        f = make_step_func(values)
+        expected = find_jumps.find_lasts(f, 0, 1 << 20)
+        def with_fees(x):
+            return (sum(v + 3 for v in values if v >= x), f(x))
+        def redacted(x):
+            return (-1, f(x))
+        self.assertEqual(find_jumps.find_lasts_amounts(with_fees, 0, 1 << 20), expected)
+        self.assertEqual(find_jumps.find_lasts_amounts(redacted, 0, 1 << 20), expected)
+
+if __name__ == '__main__':
+    unittest.main()
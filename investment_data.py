@@ -1,7 +1,7 @@
 #!/usr/bin/python3
 
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, List, Tuple
 
 import cache
 
@@ -13,10 +13,49 @@ class InvestmentData(ABC):
     def __call__(self, threshold: int | None, date: int) -> Tuple[int, int]:
         pass
 
+    # Answer the query from the source itself, bypassing any cache,
+    # e.g., to see whether the data has changed.
+    @abstractmethod
+    def real_work(self, threshold: int | None, date: int) -> Tuple[int, int]:
+        pass
+
+    # Evaluate several (threshold, date) queries, returning the results
+    # in the same order.  Sources that can have several queries
+    # outstanding at once should override this.
+    def batch(self, queries: List[Tuple[int | None, int]]) -> List[Tuple[int, int]]:
+        return [self(threshold, date) for (threshold, date) in queries]
+
+    # Release any threads or connections the source holds.
+    def close(self) -> None:
+        pass
+
+    # Whether the result of the query can no longer change, e.g.,
+    # because it is about a day before today.  Only final results are
+    # kept in a persistent cache store, and the cache ttl applies to
+    # the others.
+    def is_final(self, threshold: int | None, date: int) -> bool:
+        return True
+
+    # store, if given, makes the cache persistent.  max_entries and
+    # ttl bound the cache (see cache.FuncCache); ttl applies to
+    # queries whose results can still change (see is_final).
+    @abstractmethod
+    def enable_cache(self, store: cache.CacheStore | None = None,
+                     max_entries: int = 0, ttl: float = 0.0) -> None:
+        pass
+
     @abstractmethod
     def flush_cache(self):
         pass
 
+    # Forget the cached results for dates first through last
+    # (inclusive), e.g., because new investments arrived.  With
+    # totals_only, only the threshold None queries are forgotten.
+    def invalidate_days(self, first: int, last: int, totals_only: bool = False) -> None:
+        c = self.cache()
+        if c is not None:
+            c.invalidate_days(first, last, totals_only)
+
     @abstractmethod
     def cache(self) -> cache.FuncCache | None:
         return None
@@ -26,9 +65,66 @@ class InvestmentData(ABC):
         pass
 
     @abstractmethod
-    def enable_cache(self) -> None:
+    def set_progress_period(self, p: int) -> None:
         pass
 
-    @abstractmethod
+# A source that caches its own real queries: real_work answers one
+# query and real_batch (by default, real_work on each) several at
+# once, and enable_cache puts a FuncCache in front of them.  batch looks every query up in the cache
+# first and hands only the misses to real_batch, together.  Useful for
+# wrappers (e.g., recording or simulating latencies) around an
+# uncached source, so that only real queries reach it.
+class CachingInvestmentData(InvestmentData):
+    def __init__(self) -> None:
+        self._cache: cache.FuncCache | None = None
+
+    def real_batch(self, queries: List[Tuple[int | None, int]]) -> List[Tuple[int, int]]:
+        return [self.real_work(threshold, date) for (threshold, date) in queries]
+
+    def __call__(self, threshold: int | None, date: int) -> Tuple[int, int]:
+        if self._cache is not None:
+            return self._cache(threshold, date)
+        return self.real_work(threshold, date)
+
+    def batch(self, queries: List[Tuple[int | None, int]]) -> List[Tuple[int, int]]:
+        results: List[Any] = [None] * len(queries)
+        misses = []
+        for ix, (threshold, date) in enumerate(queries):
+            if self._cache is not None:
+                found, y = self._cache.lookup(threshold, date)
+                if found:
+                    results[ix] = y
+                    continue
+            misses.append(ix)
+        if not misses:
+            return results
+        for ix, y in zip(misses, self.real_batch([queries[ix] for ix in misses])):
+            results[ix] = y
+            if self._cache is not None:
+                self._cache.insert(queries[ix], y)
+        return results
+
+    def enable_cache(self, store: cache.CacheStore | None = None,
+                     max_entries: int = 0, ttl: float = 0.0) -> None:
+        self._cache = cache.FuncCache(self.real_work, store, max_entries, ttl,
+                                      ttl_applies=lambda args: not self.is_final(*args),
+                                      persist=lambda args: self.is_final(*args))
+
+    def flush_cache(self):
+        if self._cache is not None:
+            self._cache.flush_cache()
+
+    def cache(self) -> cache.FuncCache | None:
+        return self._cache
+
+    def set_cache(self, c: Dict[Any, Any]) -> None:
+        # throws if self._cache is None
+        if self._cache is None:
+            raise RuntimeError('caching not enabled')
+        self._cache.set_cache(c)
+
     def set_progress_period(self, p: int) -> None:
-        pass
+        # throws if self._cache is None
+        if self._cache is None:
+            raise RuntimeError('caching not enabled')
+        self._cache.set_show_progress_period(p)
@@ -1,15 +1,20 @@
 #!/usr/bin/python3
 
+import concurrent.futures
+import collections
 import datetime
 import json
+import random
 import requests
 import sys
+import threading
 import time
 
-from typing import Any, Dict, Generator, Tuple
+from typing import Any, Deque, Dict, Generator, List, Mapping, Tuple
 
 import cache
 import investment_data
+import metrics
 
 verbose = 0  # verbosity level
 
@@ -31,16 +36,210 @@ def get_count(d: Dict[str, str]) -> str:
     sys.stderr.write(f'No count key found in {d}\n')
     return '-1'
 
+# Client side request governor.  The number of requests in flight is
+# limited by an AIMD (additive increase, multiplicative decrease)
+# controller: each reply with a latency at or below target_latency
+# increases the limit by about one per limit's worth of requests,
+# while a slow reply decreases it a little and a 429 or 5xx reply
+# (or a connection error) halves it.  Such transient failures are
+# retried after an exponential backoff with jitter (or the server's
+# Retry-After), up to max_retries times; only then is IOError raised.
+# Retries happen below any FuncCache, so cache contents survive.
+# One governor should be shared by all users of the same server.
+# Clients that cannot block (e.g., on an asyncio event loop) use
+# try_acquire, release and retry_delay instead of get.
+class RequestGovernor:
+    def __init__(self,
+                 initial_limit: float = 4.0,
+                 min_limit: float = 1.0,
+                 max_limit: float = 64.0,
+                 target_latency: float = 1.0,
+                 max_retries: int = 6,
+                 base_backoff: float = 1.0,
+                 max_backoff: float = 60.0,
+                 rate_window: float = 60.0,
+                 query_metrics: metrics.QueryMetrics | None = None) -> None:
+        self._limit = initial_limit
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._target_latency = target_latency
+        self._max_retries = max_retries
+        self._base_backoff = base_backoff
+        self._max_backoff = max_backoff
+        self._rate_window = rate_window
+        self._metrics = query_metrics
+        self._in_flight = 0
+        self._retries = 0
+        self._completions: Deque[float] = collections.deque()
+        self._cond = threading.Condition()
+
+    def limit(self) -> float:
+        with self._cond:
+            return self._limit
+
+    def in_flight(self) -> int:
+        with self._cond:
+            return self._in_flight
+
+    def retries(self) -> int:
+        with self._cond:
+            return self._retries
+
+    # successful replies per second over the last rate_window seconds
+    def rate(self) -> float:
+        with self._cond:
+            self._expire_completions(time.monotonic())
+            return len(self._completions) / self._rate_window
+
+    def _expire_completions(self, now: float) -> None:
+        while self._completions and self._completions[0] < now - self._rate_window:
+            self._completions.popleft()
+
+    def _acquire(self) -> None:
+        with self._cond:
+            while self._in_flight >= max(1, int(self._limit)):
+                self._cond.wait()
+            self._in_flight += 1
+
+    # Take a request slot if one is free, without waiting.
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self._in_flight >= max(1, int(self._limit)):
+                return False
+            self._in_flight += 1
+            return True
+
+    # 429, 5xx and no reply at all (status None) are worth retrying
+    @staticmethod
+    def transient(status: int | None) -> bool:
+        return status is None or status == 429 or status >= 500
+
+    # Give back the slot of a request that took latency seconds, and
+    # adapt the limit to how it went.
+    def release(self, latency: float | None, ok: bool) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            if not ok:
+                self._limit = max(self._min_limit, self._limit / 2)
+            elif latency is not None and latency > self._target_latency:
+                self._limit = max(self._min_limit, self._limit * 0.9)
+            else:
+                self._limit = min(self._max_limit, self._limit + 1 / self._limit)
+            if ok:
+                now = time.monotonic()
+                self._completions.append(now)
+                self._expire_completions(now)
+            self._cond.notify_all()
+
+    def _backoff(self, attempt: int, headers: Mapping[str, str] | None) -> float:
+        if headers is not None and 'Retry-After' in headers:
+            try:
+                return min(self._max_backoff, float(headers['Retry-After']))
+            except ValueError:
+                pass  # an HTTP date; use our own backoff
+        delay = min(self._max_backoff, self._base_backoff * 2 ** attempt)
+        return delay * (0.5 + random.random() / 2)
+
+    def get(self, session: requests.Session, url: str, params: Dict[str, str]) -> requests.Response:
+        attempt = 0
+        while True:
+            self._acquire()
+            start = time.monotonic()
+            data: requests.Response | None = None
+            try:
+                data = session.get(url, params=params)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if verbose:
+                    sys.stderr.write(f'request error {e}\n')
+            finally:
+                # give the slot back even if some other error escapes
+                latency = time.monotonic() - start
+                status = None if data is None else data.status_code
+                self.release(latency, not self.transient(status))
+            if data is not None and not self.transient(status):
+                if not data.ok:
+                    raise IOError(f'{url}: HTTP status {data.status_code}')
+                return data
+            time.sleep(self.retry_delay(url, params, attempt, status,
+                                        None if data is None else data.headers))
+            attempt += 1
+
+    # Count the retry of a request to url with params whose attempt (0
+    # for the first) failed transiently with status (None for no
+    # reply), and return how long to wait before retrying.  Raises
+    # IOError once max_retries are used up.
+    def retry_delay(self, url: str, params: Dict[str, str], attempt: int, status: int | None,
+                    headers: Mapping[str, str] | None) -> float:
+        if attempt >= self._max_retries:
+            raise IOError(f'{url}: giving up after {attempt + 1} attempts')
+        delay = self._backoff(attempt, headers)
+        with self._cond:
+            self._retries += 1
+        if self._metrics is not None:
+            self._metrics.record_retry(params.get('slug', ''))
+        if verbose:
+            reply = 'no reply' if status is None else f'status {status}'
+            sys.stderr.write(f'{reply}; retrying in {delay:.1f}s, limit now {self.limit():.1f}\n')
+        return delay
+
+def governed_get(session: requests.Session,
+                 url: str,
+                 params: Dict[str, str],
+                 governor: RequestGovernor | None) -> requests.Response:
+    if governor is not None:
+        return governor.get(session, url, params)
+    data = session.get(url, params=params)
+    if not data.ok:
+        raise IOError
+    return data
+
+# Query parameters for the summary of investments of slug at or above
+# threshold (in cents; None for no threshold) processed on day number
+# date (day_specific) or on or after it.
+def summary_params(slug: str, threshold: int | None, date: int, day_specific: bool) -> Dict[str, str]:
+    params: Dict[str, str] = dict()
+
+    params['slug'] = slug
+    if threshold is not None:
+        params['shares_amount__gte'] = f'{threshold / 100.0:.2f}'
+
+    day_zero = datetime.date.fromisoformat(priority_program_start_date_iso)
+    date_str = (day_zero + datetime.timedelta(days=date)).isoformat()
+    params['processed_at__date__gte'] = date_str
+    if day_specific:
+        params['processed_at__date__lte'] = date_str
+    return params
+
+# Decode a summary reply into (amount in cents, count), where the
+# amount is -1 if it has been redacted.
+def parse_summary(content: bytes) -> Tuple[int, int]:
+    jdata = json.loads(content)
+    if 'amount' in jdata['total_amount_committed']:
+        a = jdata['total_amount_committed']['amount']
+    else:
+        a = -1
+    c = get_count(jdata['total_amount_committed'])
+    if verbose > 2:
+        sys.stderr.write(f'a = {a}, c = {c}\n')
+    if a != -1:
+        amount = int(100 * a + 0.5)
+    else:
+        amount = -1
+    return (amount, int(c))
+
 def today_day_number():
     start_day = datetime.date.fromisoformat(priority_program_start_date_iso)
     today = datetime.date.today()
     elapsed = today - start_day
     return elapsed.days
 
+aptera_slugs = ['aptera-rega', 'aptera-regd']
+
 # investment_threshold is in USD in cents
-def make_params(investment_threshold_cents: int | None) -> list[Dict[str, str]]:
+def make_params(investment_threshold_cents: int | None,
+                slugs: List[str] = aptera_slugs) -> list[Dict[str, str]]:
     plist = []
-    for reg in ['aptera-rega', 'aptera-regd']:
+    for reg in slugs:
         params = issuance_params.copy()
         params['slug'] = reg
         if investment_threshold_cents is not None:
@@ -48,8 +247,30 @@ def make_params(investment_threshold_cents: int | None) -> list[Dict[str, str]]:
         plist.append(params)
     return plist
 
+# The aggregate queries below are made concurrently by a thread pool
+# shared by the whole process.  requests.Session is not thread safe, so
+# each pool thread has its own keep-alive session; the threads outlive
+# the calls, so repeated calls (e.g., coupon_round --watch or the
+# sanitizer service) pay for TLS handshakes only once per thread.
+summary_pool_size = 16
+_summary_lock = threading.Lock()
+_summary_local = threading.local()
+_summary_pool: concurrent.futures.ThreadPoolExecutor | None = None
+
+def thread_session() -> requests.Session:
+    if not hasattr(_summary_local, 'session'):
+        _summary_local.session = requests.Session()
+    return _summary_local.session
+
+def _shared_pool() -> concurrent.futures.ThreadPoolExecutor:
+    global _summary_pool
+    with _summary_lock:
+        if _summary_pool is None:
+            _summary_pool = concurrent.futures.ThreadPoolExecutor(max_workers=summary_pool_size)
+        return _summary_pool
+
 def fetch_amount_and_count(url: str, params: Dict[str, str]) -> Tuple[float, float]:
-    data = requests.get(url, params=params)
+    data = thread_session().get(url, params=params)
     if verbose > 3:
         print(f'fetched from {url}, {params}: {data.ok} {data.content!r}')
     if not data.ok:
@@ -61,8 +282,12 @@ def fetch_amount_and_count(url: str, params: Dict[str, str]) -> Tuple[float, flo
         # data has been sanitized
         return (-1, get_count(jdata['total_amount_committed']))
 
+# Fetch the summaries for all params in one concurrent round.
+def fetch_all_amounts_and_counts(url: str, params: list[Dict[str, str]]) -> list[Tuple[float, float]]:
+    return list(_shared_pool().map(lambda p: fetch_amount_and_count(url, p), params))
+
 def total_committed_amount_and_count(url: str, params: list[Dict[str, str]]) -> Tuple[float, int]:
-    d = [fetch_amount_and_count(url, p) for p in params]
+    d = fetch_all_amounts_and_counts(url, params)
     amt, cnt = map(list, zip(*d))
     def sum_invalid(lst):
         if -1 in lst:
@@ -74,53 +299,66 @@ def total_committed_amount_and_count_at_threshold(threshold: int | None):
     return total_committed_amount_and_count(issuance_url, make_params(threshold))
 
 class IssuanceInvestmentData(investment_data.InvestmentData):
-    def __init__(self, slug: str):
-        self._day_zero = datetime.date.fromisoformat(priority_program_start_date_iso)
-        self._one_day = datetime.timedelta(days=1)
+    def __init__(self, slug: str, batch_workers: int = 8,
+                 governor: RequestGovernor | None = None,
+                 query_metrics: metrics.QueryMetrics | None = None):
         self._slug = slug
         self._cache: cache.FuncCache | None = None
-        self._session = requests.Session()
+        # requests.Session is not thread safe, so each thread doing
+        # queries (see ExtractInvestment's jobs parameter) gets its own.
+        self._local = threading.local()
+        self._batch_workers = batch_workers
+        self._batch_pool: concurrent.futures.ThreadPoolExecutor | None = None
+        # batch may be called by several threads (jobs > 1)
+        self._pool_lock = threading.Lock()
+        self._governor = governor
+        self._metrics = query_metrics
 
     def __call__(self, threshold: int | None, date: int) -> Tuple[int, int]:
         if self._cache is not None:
             return self._cache(threshold, date)
         return self.real_work(threshold, date)
 
-    def real_work(self, threshold: int | None, date: int) -> Tuple[int, int]:
-        params: Dict[str, str] = dict()
-
-        params['slug'] = self._slug
-        if threshold is not None:
-            params['shares_amount__gte'] = f'{threshold / 100.0:.2f}'
+    def batch(self, queries: List[Tuple[int | None, int]]) -> List[Tuple[int, int]]:
+        # queries go through __call__ so that the cache is used
+        with self._pool_lock:
+            if self._batch_pool is None:
+                self._batch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._batch_workers)
+            pool = self._batch_pool
+        return list(pool.map(lambda q: self(*q), queries))
+
+    def close(self) -> None:
+        with self._pool_lock:
+            pool = self._batch_pool
+            self._batch_pool = None
+        if pool is not None:
+            pool.shutdown()
+
+    def session(self) -> requests.Session:
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    # every cumulative query includes the current day, so a later run
+    # would get stale totals from a persistent store
+    def is_final(self, threshold: int | None, date: int) -> bool:
+        return False
 
-        date_str = (self._day_zero + date * self._one_day).isoformat()
-        params['processed_at__date__gte'] = date_str
-
-        amount = 0
-        count = 0
+    def real_work(self, threshold: int | None, date: int) -> Tuple[int, int]:
+        params = summary_params(self._slug, threshold, date, False)
         if verbose > 2:
             sys.stderr.write(f'params {params}\n')
-
-        data = self._session.get(issuance_url, params=params)
-        if not data.ok:
-            raise IOError
-        jdata = json.loads(data.content)
-        if 'amount' in jdata['total_committed_amount_and_count']:
-            a = jdata['total_amount_committed']['amount']
-        else:
-            a = -1
-        c = get_count(jdata['total_amount_committed'])
-        if verbose > 2:
-            sys.stderr.write(f'slug = {self._slug}, a = {a:18f}, c = {c:18f}\n')
-        if a != -1 and amount != -1:
-            amount += int(100 * a + 0.5)
-        else:
-            amount = -1
-        count += int(c)
-        return (amount, count)
-
-    def enable_cache(self):
-        self._cache = cache.FuncCache(self.real_work)
+        start = time.monotonic()
+        data = governed_get(self.session(), issuance_url, params, self._governor)
+        if self._metrics is not None:
+            self._metrics.record_query(self._slug, date, time.monotonic() - start)
+        return parse_summary(data.content)
+
+    def enable_cache(self, store: cache.CacheStore | None = None,
+                     max_entries: int = 0, ttl: float = 0.0) -> None:
+        self._cache = cache.FuncCache(self.real_work, store, max_entries, ttl,
+                                      ttl_applies=lambda args: not self.is_final(*args),
+                                      persist=lambda args: self.is_final(*args))
 
     def flush_cache(self):
         if self._cache is not None:
@@ -144,54 +382,65 @@ class IssuanceInvestmentData(investment_data.InvestmentData):
 # Use a day-specific query.  Note that the semantics of date argument
 # in __call__ is different from the previous class.
 class IssuanceInvestmentDataSpecific(investment_data.InvestmentData):
-    def __init__(self, slug: str):
-        self._day_zero = datetime.date.fromisoformat(priority_program_start_date_iso)
-        self._one_day = datetime.timedelta(days=1)
+    def __init__(self, slug: str, batch_workers: int = 8,
+                 governor: RequestGovernor | None = None,
+                 query_metrics: metrics.QueryMetrics | None = None):
         self._slug = slug
         self._cache: cache.FuncCache | None = None
-        self._session = requests.Session()
+        # requests.Session is not thread safe, so each thread doing
+        # queries (see ExtractInvestment's jobs parameter) gets its own.
+        self._local = threading.local()
+        self._batch_workers = batch_workers
+        self._batch_pool: concurrent.futures.ThreadPoolExecutor | None = None
+        # batch may be called by several threads (jobs > 1)
+        self._pool_lock = threading.Lock()
+        self._governor = governor
+        self._metrics = query_metrics
 
     def __call__(self, threshold: int | None, date: int) -> Tuple[int, int]:
         if self._cache is not None:
             return self._cache(threshold, date)
         return self.real_work(threshold, date)
 
-    def real_work(self, threshold: int | None, date: int) -> Tuple[int, int]:
-        params: Dict[str, str] = dict()
-
-        params['slug'] = self._slug
-        if threshold is not None:
-            params['shares_amount__gte'] = f'{threshold / 100.0:.2f}'
-
-        date_str = (self._day_zero + date * self._one_day).isoformat()
-        params['processed_at__date__gte'] = date_str
-        params['processed_at__date__lte'] = date_str
+    def batch(self, queries: List[Tuple[int | None, int]]) -> List[Tuple[int, int]]:
+        # queries go through __call__ so that the cache is used
+        with self._pool_lock:
+            if self._batch_pool is None:
+                self._batch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._batch_workers)
+            pool = self._batch_pool
+        return list(pool.map(lambda q: self(*q), queries))
+
+    def close(self) -> None:
+        with self._pool_lock:
+            pool = self._batch_pool
+            self._batch_pool = None
+        if pool is not None:
+            pool.shutdown()
+
+    def session(self) -> requests.Session:
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    # investments may still arrive today
+    def is_final(self, threshold: int | None, date: int) -> bool:
+        return date < today_day_number()
 
-        amount = 0
-        count = 0
+    def real_work(self, threshold: int | None, date: int) -> Tuple[int, int]:
+        params = summary_params(self._slug, threshold, date, True)
         if verbose > 2:
             sys.stderr.write(f'params {params}\n')
-
-        data = self._session.get(issuance_url, params=params)
-        if not data.ok:
-            raise IOError
-        jdata = json.loads(data.content)
-        if 'amount' in jdata['total_amount_committed']:
-            a = jdata['total_amount_committed']['amount']
-        else:
-            a = -1
-        c = get_count(jdata['total_amount_committed'])
-        if verbose > 2:
-            sys.stderr.write(f'slug = {self._slug}, a = {a:18f}, c = {c:18f}\n')
-        if a != -1:
-            amount += int(100 * a + 0.5)
-        else:
-            amount = -1
-        count += int(c)
-        return (amount, count)
-
-    def enable_cache(self):
-        self._cache = cache.FuncCache(self.real_work)
+        start = time.monotonic()
+        data = governed_get(self.session(), issuance_url, params, self._governor)
+        if self._metrics is not None:
+            self._metrics.record_query(self._slug, date, time.monotonic() - start)
+        return parse_summary(data.content)
+
+    def enable_cache(self, store: cache.CacheStore | None = None,
+                     max_entries: int = 0, ttl: float = 0.0) -> None:
+        self._cache = cache.FuncCache(self.real_work, store, max_entries, ttl,
+                                      ttl_applies=lambda args: not self.is_final(*args),
+                                      persist=lambda args: self.is_final(*args))
 
     def flush_cache(self):
         if self._cache is not None:
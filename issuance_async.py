@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+
+# asyncio implementation of the Issuance summary queries.  All queries
+# run on one event loop thread owned by the AsyncIssuanceInvestmentData
+# object, over a pooled keep-alive aiohttp session, so a batch of
+# hundreds of queries can be outstanding at once without a thread per
+# query.  The synchronous InvestmentData interface (__call__, batch)
+# submits to that loop and waits; coroutines (query, query_batch) must
+# be run on loop().
+#
+# With a governor (see issuance.RequestGovernor), a query waits for a
+# slot of the governor as well as for one of the max_in_flight ones,
+# and throttled or failed queries are retried as the governor decides.
+# Cache lookups and inserts may hit a CacheStore (e.g., SQLite), so
+# they run in the loop's default executor rather than on the loop.
+
+import asyncio
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Mapping, Tuple
+
+import aiohttp
+
+import cache
+import investment_data
+import issuance
+import metrics
+
+class AsyncIssuanceInvestmentData(investment_data.InvestmentData):
+    def __init__(self, slug: str, day_specific: bool = True,
+                 max_in_flight: int = 100,
+                 keepalive_timeout: float = 30.0,
+                 governor: issuance.RequestGovernor | None = None,
+                 query_metrics: metrics.QueryMetrics | None = None):
+        self._slug = slug
+        self._day_specific = day_specific
+        self._max_in_flight = max_in_flight
+        self._keepalive_timeout = keepalive_timeout
+        self._governor = governor
+        self._metrics = query_metrics
+        self._cache: cache.FuncCache | None = None
+        self._start_lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        # created on the loop by _open
+        self._session: aiohttp.ClientSession | None = None
+        self._in_flight: asyncio.Semaphore | None = None
+        self._released: asyncio.Event | None = None
+
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._start_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever,
+                                                name=f'issuance-{self._slug}',
+                                                daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def _run(self, coro: Any) -> Any:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop()).result()
+
+    async def _open(self) -> aiohttp.ClientSession:
+        # no await between test and set, so this is race free on the loop
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self._max_in_flight,
+                                             keepalive_timeout=self._keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._in_flight = asyncio.Semaphore(self._max_in_flight)
+            self._released = asyncio.Event()
+        return self._session
+
+    async def _acquire(self) -> None:
+        assert self._governor is not None and self._released is not None
+        while True:
+            # no await between clear and try_acquire, so a release on
+            # this loop in between cannot be missed
+            self._released.clear()
+            if self._governor.try_acquire():
+                return
+            # slots given back by other users of the governor do not
+            # wake up this loop, hence the timeout
+            try:
+                await asyncio.wait_for(self._released.wait(), 0.1)
+            except asyncio.TimeoutError:
+                pass
+
+    # Does not await, so the slot is given back even by a query that
+    # is being cancelled.
+    def _release(self, latency: float, ok: bool) -> None:
+        assert self._governor is not None and self._released is not None
+        self._governor.release(latency, ok)
+        self._released.set()
+
+    async def fetch(self, threshold: int | None, date: int) -> Tuple[int, int]:
+        session = await self._open()
+        assert self._in_flight is not None
+        url = issuance.issuance_url
+        params = issuance.summary_params(self._slug, threshold, date, self._day_specific)
+        if issuance.verbose > 2:
+            sys.stderr.write(f'params {params}\n')
+        # latency includes any retries, as for the synchronous sources
+        query_start = time.monotonic()
+        attempt = 0
+        while True:
+            async with self._in_flight:
+                if self._governor is not None:
+                    await self._acquire()
+                start = time.monotonic()
+                status: int | None = None
+                headers: Mapping[str, str] | None = None
+                content = b''
+                try:
+                    async with session.get(url, params=params) as data:
+                        headers = data.headers
+                        content = await data.read()
+                        status = data.status
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if self._governor is None:
+                        raise
+                    if issuance.verbose:
+                        sys.stderr.write(f'request error {e}\n')
+                finally:
+                    # also on cancellation or any other error
+                    latency = time.monotonic() - start
+                    if self._governor is not None:
+                        self._release(latency, not self._governor.transient(status))
+            if self._governor is None or not self._governor.transient(status):
+                assert status is not None
+                if status >= 400:
+                    raise IOError(f'{url}: HTTP status {status}')
+                if self._metrics is not None:
+                    self._metrics.record_query(self._slug, date, time.monotonic() - query_start)
+                return issuance.parse_summary(content)
+            await asyncio.sleep(self._governor.retry_delay(url, params, attempt, status, headers))
+            attempt += 1
+
+    async def query(self, threshold: int | None, date: int) -> Tuple[int, int]:
+        if self._cache is None:
+            return await self.fetch(threshold, date)
+        loop = asyncio.get_running_loop()
+        found, y = await loop.run_in_executor(None, self._cache.lookup, threshold, date)
+        if found:
+            return y
+        y = await self.fetch(threshold, date)
+        await loop.run_in_executor(None, self._cache.insert, (threshold, date), y)
+        return y
+
+    async def query_batch(self, queries: List[Tuple[int | None, int]]) -> List[Tuple[int, int]]:
+        return list(await asyncio.gather(*(self.query(t, d) for (t, d) in queries)))
+
+    def __call__(self, threshold: int | None, date: int) -> Tuple[int, int]:
+        return self._run(self.query(threshold, date))
+
+    def batch(self, queries: List[Tuple[int | None, int]]) -> List[Tuple[int, int]]:
+        return self._run(self.query_batch(queries))
+
+    # as for issuance's IssuanceInvestmentData and
+    # IssuanceInvestmentDataSpecific
+    def is_final(self, threshold: int | None, date: int) -> bool:
+        return self._day_specific and date < issuance.today_day_number()
+
+    def real_work(self, threshold: int | None, date: int) -> Tuple[int, int]:
+        return self._run(self.fetch(threshold, date))
+
+    async def _close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        await asyncio.get_running_loop().shutdown_default_executor()
+
+    def close(self) -> None:
+        with self._start_lock:
+            loop = self._loop
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        assert self._thread is not None
+        self._thread.join()
+        loop.close()
+        with self._start_lock:
+            self._loop = None
+            self._thread = None
+
+    def enable_cache(self, store: cache.CacheStore | None = None,
+                     max_entries: int = 0, ttl: float = 0.0) -> None:
+        self._cache = cache.FuncCache(self.real_work, store, max_entries, ttl,
+                                      ttl_applies=lambda args: not self.is_final(*args),
+                                      persist=lambda args: self.is_final(*args))
+
+    def flush_cache(self):
+        if self._cache is not None:
+            self._cache.flush_cache()
+
+    def cache(self) -> cache.FuncCache | None:
+        return self._cache
+
+    def set_cache(self, c: Dict[Any, Any]) -> None:
+        # throws if self._cache is None
+        if self._cache is None:
+            raise RuntimeError('caching not enabled')
+        self._cache.set_cache(c)
+
+    def set_progress_period(self, p: int) -> None:
+        # throws if self._cache is None
+        if self._cache is None:
+            raise RuntimeError('caching not enabled')
+        self._cache.set_show_progress_period(p)
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+
+import asyncio
+import concurrent.futures
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+
+import cache
+import extract_investments
+import issuance
+import issuance_async
+import issuance_server
+import metrics
+
+class TestAsyncIssuance(unittest.TestCase):
+
+    def start(self, investments, **kwargs):
+        server = issuance_server.SummaryServer(('localhost', 0), investments, seed=1, **kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        old_url = issuance.issuance_url
+        issuance.issuance_url = f'http://localhost:{server.server_address[1]}{issuance_server.summary_path}'
+        self.addCleanup(setattr, issuance, 'issuance_url', old_url)
+        return server
+
+    def source(self, *args, **kwargs):
+        src = issuance_async.AsyncIssuanceInvestmentData('aptera-rega', *args, **kwargs)
+        self.addCleanup(src.close)
+        return src
+
+    def test_extraction_with_faults(self):
+        rng = random.Random(3)
+        num_days = 5
+        max_inv = 10_000
+        investments = issuance_server.synthetic_investments(['aptera-rega'], 20, num_days,
+                                                            500, max_inv, rng)
+        self.start(investments, rate_429=0.1, rate_5xx=0.05, retry_after=0.01)
+        governor = issuance.RequestGovernor(base_backoff=0.001, max_retries=20)
+        for day_specific in [True, False]:
+            src = self.source(day_specific, max_in_flight=8, governor=governor)
+            src.enable_cache()
+            extractor = extract_investments.ExtractInvestment(
+                src, num_days, 0, max_inv, src_is_cumulative=not day_specific, batched=True)
+            self.assertEqual(sorted(extractor.fast_extraction()),
+                             sorted(investments['aptera-rega']))
+        self.assertGreater(governor.retries(), 0)
+        self.assertEqual(governor.in_flight(), 0)
+
+    def test_retry_after(self):
+        server = self.start({'aptera-rega': [(0, 600_000)]}, rate_429=1.0, retry_after=0.01)
+        # no governor: no retries
+        with self.assertRaises(IOError):
+            self.source()(None, 0)
+        self.assertEqual(server.num_requests, 1)
+
+        governor = issuance.RequestGovernor(base_backoff=10.0, max_retries=2)
+        with self.assertRaises(IOError):
+            self.source(governor=governor)(None, 0)
+        # the server's Retry-After is used rather than the 10s backoff
+        self.assertEqual(server.num_requests, 4)
+        self.assertEqual(governor.retries(), 2)
+        self.assertEqual(governor.in_flight(), 0)
+
+        server.rate_429 = 0.0
+        self.assertEqual(self.source(governor=governor)(None, 0), (600_000, 1))
+
+    def test_latency_includes_retries(self):
+        server = self.start({'aptera-rega': [(0, 600_000)]}, rate_429=1.0, retry_after=0.2)
+        query_metrics = metrics.QueryMetrics()
+        src = self.source(governor=issuance.RequestGovernor(), query_metrics=query_metrics)
+        # only the first request is throttled
+        timer = threading.Timer(0.1, setattr, (server, 'rate_429', 0.0))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual(src(None, 0), (600_000, 1))
+        self.assertEqual(server.num_requests, 2)
+        latency = query_metrics.report()['slugs']['aptera-rega']['latency_seconds']
+        self.assertEqual(latency['count'], 1)
+        self.assertGreaterEqual(latency['sum'], 0.2)
+
+    def test_cancel(self):
+        self.start({'aptera-rega': [(0, 600_000)]}, latency=lambda rng: 0.5)
+        governor = issuance.RequestGovernor()
+        src = self.source(governor=governor)
+        future = asyncio.run_coroutine_threadsafe(src.query(None, 0), src.loop())
+        while governor.in_flight() == 0:
+            time.sleep(0.01)
+        future.cancel()
+        with self.assertRaises(concurrent.futures.CancelledError):
+            future.result()
+        # the cancelled query gives its slot back (once the loop gets
+        # to cancel it), well before the reply would have come
+        deadline = time.monotonic() + 0.4
+        while governor.in_flight() != 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(governor.in_flight(), 0)
+
+    def test_cache_store(self):
+        server = self.start({'aptera-rega': [(0, 600_000), (1, 100_000)]})
+        real_today = issuance.today_day_number
+        issuance.today_day_number = lambda: 1
+        self.addCleanup(setattr, issuance, 'today_day_number', real_today)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, 'cache.db')
+        queries = [(None, 0), (None, 1), (500_000, 0)]
+        expected = [(600_000, 1), (100_000, 1), (600_000, 1)]
+
+        src = self.source()
+        store = cache.SqliteCacheStore(path, 'aptera-rega', 'day')
+        self.addCleanup(store.close)
+        src.enable_cache(store)
+        self.assertEqual(src.batch(queries), expected)
+        self.assertEqual(server.num_requests, 3)
+
+        # a later run reads the days before today from the store
+        src = self.source()
+        store = cache.SqliteCacheStore(path, 'aptera-rega', 'day')
+        self.addCleanup(store.close)
+        src.enable_cache(store)
+        self.assertEqual(src.batch(queries), expected)
+        self.assertEqual(server.num_requests, 4)
+        c = src.cache()
+        assert c is not None
+        self.assertEqual(c.stats()['hits'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+
+# Local stand-in for the Issuance /api/investments/summary/ end point,
+# for benchmarking and testing the real client code paths offline.
+# It understands the filters that issuance.py sends (slug,
+# shares_amount__gte, processed_at__date__gte/lte) and answers from a
+# synthetic or recorded investment set.  Replies can be delayed by a
+# configurable latency distribution, replaced by injected 429 or 5xx
+# errors, and redacted (no amount), like the real server.
+#
+# Point the clients at it with, e.g.,
+#   extract_coupon_investments --issuance-url http://localhost:8000/api/investments/summary/
+
+import argparse
+import csv
+import datetime
+import http.server
+import json
+import math
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from typing import Callable, Dict, List, Optional, Tuple
+
+import issuance
+
+options: Optional[argparse.Namespace] = None
+
+summary_path = '/api/investments/summary/'
+
+# Latency distributions, in seconds: 'fixed:S', 'uniform:LO:HI', or
+# 'lognormal:MEDIAN:SIGMA'.
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    fields = spec.split(':')
+    try:
+        args = [float(f) for f in fields[1:]]
+    except ValueError:
+        raise ValueError(f'bad latency specification {spec}')
+    if fields[0] == 'fixed' and len(args) == 1:
+        return lambda rng: args[0]
+    if fields[0] == 'uniform' and len(args) == 2:
+        return lambda rng: rng.uniform(args[0], args[1])
+    if fields[0] == 'lognormal' and len(args) == 2 and args[0] > 0:
+        mu = math.log(args[0])
+        return lambda rng: rng.lognormvariate(mu, args[1])
+    raise ValueError(f'bad latency specification {spec}')
+
+def synthetic_investments(slugs: List[str], num_entries: int, num_days: int,
+                          min_invest: int, max_invest: int,
+                          rng: random.Random) -> Dict[str, List[Tuple[int, int]]]:
+    return dict((slug, [(rng.randrange(num_days), rng.randrange(min_invest, max_invest))
+                        for _ in range(num_entries)])
+                for slug in slugs)
+
+# Read extract_coupon_investments csv output (slug, day, cents).
+def recorded_investments(fn: str) -> Dict[str, List[Tuple[int, int]]]:
+    investments: Dict[str, List[Tuple[int, int]]] = dict()
+    with open(fn, newline='') as istr:
+        for row in csv.reader(istr, skipinitialspace=True):
+            if len(row) != 3:
+                raise ValueError(f'{fn}: malformed row {row}')
+            investments.setdefault(row[0], []).append((int(row[1]), int(row[2])))
+    return investments
+
+class SummaryServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address: Tuple[str, int],
+                 investments: Dict[str, List[Tuple[int, int]]],
+                 latency: Callable[[random.Random], float] = lambda rng: 0.0,
+                 rate_429: float = 0.0,
+                 rate_5xx: float = 0.0,
+                 retry_after: float = 0.0,
+                 redact: bool = False,
+                 seed: int | None = None) -> None:
+        super().__init__(address, SummaryHandler)
+        self.investments = investments
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+        self.redact = redact
+        self.day_zero = datetime.date.fromisoformat(issuance.priority_program_start_date_iso)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.num_requests = 0
+
+    # random draws for one request: (latency, fault status or 0)
+    def draw(self) -> Tuple[float, int]:
+        with self._lock:
+            self.num_requests += 1
+            latency = self.latency(self._rng)
+            u = self._rng.random()
+        if u < self.rate_429:
+            return (latency, 429)
+        if u < self.rate_429 + self.rate_5xx:
+            return (latency, 503)
+        return (latency, 0)
+
+    def day_number(self, iso: str) -> int:
+        return (datetime.date.fromisoformat(iso) - self.day_zero).days
+
+    def summary(self, query: Dict[str, str]) -> Tuple[float, int]:
+        d = self.investments.get(query.get('slug', ''), [])
+        if 'shares_amount__gte' in query:
+            threshold = round(float(query['shares_amount__gte']) * 100)
+            d = [t for t in d if t[1] >= threshold]
+        if 'processed_at__date__gte' in query:
+            first = self.day_number(query['processed_at__date__gte'])
+            d = [t for t in d if t[0] >= first]
+        if 'processed_at__date__lte' in query:
+            last = self.day_number(query['processed_at__date__lte'])
+            d = [t for t in d if t[0] <= last]
+        return (sum(t[1] for t in d) / 100.0, len(d))
+
+class SummaryHandler(http.server.BaseHTTPRequestHandler):
+    server: SummaryServer
+
+    def reply(self, status: int, body: Dict, headers: Optional[Dict[str, str]] = None) -> None:
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlparse(self.path)
+        if url.path != summary_path:
+            self.reply(404, {'detail': 'Not found.'})
+            return
+        latency, fault = self.server.draw()
+        time.sleep(latency)
+        if fault == 429:
+            headers = dict()
+            if self.server.retry_after > 0:
+                headers['Retry-After'] = f'{self.server.retry_after:g}'
+            self.reply(429, {'detail': 'Request was throttled.'}, headers)
+            return
+        if fault != 0:
+            self.reply(fault, {'detail': 'Service unavailable.'})
+            return
+        query = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            amount, count = self.server.summary(query)
+        except ValueError as e:
+            self.reply(400, {'detail': str(e)})
+            return
+        committed: Dict[str, float | int] = {'count': count}
+        if not self.server.redact:
+            committed['amount'] = amount
+        self.reply(200, {'total_amount_committed': committed})
+
+    def log_message(self, format: str, *args) -> None:
+        if options is not None and options.verbose > 0:
+            super().log_message(format, *args)
+
+def main(argv: list[str]) -> int:
+    global options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='localhost',
+                        help='address to listen on')
+    parser.add_argument('--port', '-p', type=int, default=8000,
+                        help='port to listen on')
+    parser.add_argument('--investments', type=str, default='',
+                        help='serve investments from this extract_coupon_investments csv output instead of synthetic ones')
+    parser.add_argument('--num-entries', type=int, default=1000,
+                        help='number of synthetic investments per slug')
+    parser.add_argument('--num-days', type=int, default=issuance.today_day_number() + 1,
+                        help='synthetic investments are made over this many days')
+    parser.add_argument('--min-investment', type=int, default=1000 * 100,
+                        help='minimum synthetic investment, in cents')
+    parser.add_argument('--max-investment', type=int, default=10_000 * 100,
+                        help='maximum synthetic investment, in cents')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed for the synthetic investments, latencies and faults')
+    parser.add_argument('--latency', type=str, default='fixed:0',
+                        help='reply latency distribution: fixed:S, uniform:LO:HI or lognormal:MEDIAN:SIGMA (seconds)')
+    parser.add_argument('--rate-429', type=float, default=0.0,
+                        help='fraction of requests answered with 429 Too Many Requests')
+    parser.add_argument('--rate-5xx', type=float, default=0.0,
+                        help='fraction of requests answered with 503 Service Unavailable')
+    parser.add_argument('--retry-after', type=float, default=0.0,
+                        help='Retry-After seconds sent with 429 replies (0 for none)')
+    parser.add_argument('--redact', type=bool, default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help='omit the amount from replies, like the sanitized end point')
+    parser.add_argument('--verbose', '-v', action='count',
+                        default=0,
+                        help='increment the verbosity level by 1')
+    options = parser.parse_args(argv[1:])
+
+    try:
+        latency = parse_latency(options.latency)
+    except ValueError as e:
+        sys.stderr.write(f'{e}\n')
+        return 1
+    if options.investments != '':
+        investments = recorded_investments(options.investments)
+    else:
+        investments = synthetic_investments(['aptera-rega', 'aptera-regd'],
+                                            options.num_entries, options.num_days,
+                                            options.min_investment, options.max_investment,
+                                            random.Random(options.seed))
+    server = SummaryServer((options.host, options.port), investments,
+                           latency, options.rate_429, options.rate_5xx,
+                           options.retry_after, options.redact, options.seed)
+    sys.stderr.write(f'Serving http://{options.host}:{server.server_address[1]}{summary_path}\n')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+
+import os
+import random
+import tempfile
+import threading
+import unittest
+
+import cache
+import extract_investments
+import investment_data
+import issuance
+import issuance_server
+
+class TestIssuanceServer(unittest.TestCase):
+
+    def start(self, investments, **kwargs):
+        server = issuance_server.SummaryServer(('localhost', 0), investments, seed=1, **kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        old_url = issuance.issuance_url
+        issuance.issuance_url = f'http://localhost:{server.server_address[1]}{issuance_server.summary_path}'
+        self.addCleanup(setattr, issuance, 'issuance_url', old_url)
+        return server
+
+    def test_extraction_with_faults(self):
+        rng = random.Random(2)
+        num_days = 5
+        max_inv = 10_000
+        investments = issuance_server.synthetic_investments(['aptera-rega'], 20, num_days,
+                                                            500, max_inv, rng)
+        server = self.start(investments, rate_429=0.05, rate_5xx=0.05)
+        governor = issuance.RequestGovernor(base_backoff=0.001, max_retries=20)
+        for day_specific in [True, False]:
+            if day_specific:
+                src: investment_data.InvestmentData = issuance.IssuanceInvestmentDataSpecific('aptera-rega', governor=governor)
+            else:
+                src = issuance.IssuanceInvestmentData('aptera-rega', governor=governor)
+            src.enable_cache()
+            extractor = extract_investments.ExtractInvestment(
+                src, num_days, 0, max_inv, src_is_cumulative=not day_specific, jobs=2)
+            self.assertEqual(sorted(extractor.fast_extraction()),
+                             sorted(investments['aptera-rega']))
+        self.assertGreater(governor.retries(), 0)
+
+    def test_concurrent_batches(self):
+        investments = {'aptera-rega': [(0, 600_000), (1, 100_000), (1, 700_000)]}
+        self.start(investments)
+        src = issuance.IssuanceInvestmentDataSpecific('aptera-rega', batch_workers=2)
+        queries = [(t, d) for t in [None, 500_000] for d in range(3)]
+        expected = [(600_000, 1), (800_000, 2), (0, 0), (600_000, 1), (700_000, 1), (0, 0)]
+        results = [None] * 4
+        def run(ix):
+            results[ix] = src.batch(queries)
+        threads = [threading.Thread(target=run, args=(ix,)) for ix in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [expected] * 4)
+        src.close()
+        # a closed source starts a new pool if used again
+        self.assertEqual(src.batch(queries[:1]), expected[:1])
+        src.close()
+
+    # Two runs sharing a cache database, with investments arriving
+    # between them.
+    def test_cache_db_between_runs(self):
+        num_days = 3
+        investments = {'aptera-rega': [(0, 600_000), (1, 100_000), (2, 200_000)]}
+        server = self.start(investments)
+        real_today = issuance.today_day_number
+        issuance.today_day_number = lambda: num_days - 1
+        self.addCleanup(setattr, issuance, 'today_day_number', real_today)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, 'cache.db')
+
+        def run(day_specific):
+            if day_specific:
+                src: investment_data.InvestmentData = issuance.IssuanceInvestmentDataSpecific('aptera-rega')
+            else:
+                src = issuance.IssuanceInvestmentData('aptera-rega')
+            store = cache.SqliteCacheStore(path, 'aptera-rega', 'day' if day_specific else 'cumulative')
+            src.enable_cache(store)
+            extractor = extract_investments.ExtractInvestment(
+                src, num_days, 0, 1_000_000, src_is_cumulative=not day_specific)
+            result = sorted(extractor.fast_extraction())
+            src.close()
+            store.close()
+            return result
+
+        for day_specific in [True, False]:
+            self.assertEqual(run(day_specific), sorted(server.investments['aptera-rega']))
+        # a new investment today, and one arriving late for yesterday
+        # (which the day-specific cache then misses, as it should)
+        server.investments = {'aptera-rega': investments['aptera-rega'] + [(1, 300_000), (2, 400_000)]}
+        self.assertEqual(run(True), [(0, 600_000), (1, 100_000), (2, 200_000), (2, 400_000)])
+        self.assertEqual(run(False), sorted(server.investments['aptera-rega']))
+
+        # only the days before today were stored
+        store = cache.SqliteCacheStore(path, 'aptera-rega', 'day')
+        self.assertEqual(store.get((0, 1)), (100_000, 1))
+        self.assertIsNone(store.get((0, 2)))
+        store.close()
+        store = cache.SqliteCacheStore(path, 'aptera-rega', 'cumulative')
+        self.assertIsNone(store.get((0, 0)))
+        store.close()
+
+    def test_aggregates(self):
+        server = self.start({'aptera-rega': [(0, 600_000), (1, 100_000)],
+                             'aptera-regd': [(0, 50_000), (2, 700_000), (2, 900_000)]})
+        self.assertEqual(
+            issuance.fetch_all_amounts_and_counts(issuance.issuance_url, issuance.make_params(500_000)),
+            [(6000.0, 1), (16000.0, 2)])
+        self.assertEqual(issuance.total_committed_amount_and_count_at_threshold(None),
+                         (23500.0, 5))
+
+        # each pool thread queries on its own session
+        barrier = threading.Barrier(2)
+        def session_id(_):
+            barrier.wait()
+            return id(issuance.thread_session())
+        self.assertEqual(len(set(issuance._shared_pool().map(session_id, range(2)))), 2)
+
+        server.redact = True
+        self.assertEqual(issuance.total_committed_amount_and_count_at_threshold(500_000),
+                         (-1, 3))
+
+    def test_redaction(self):
+        self.start({'aptera-rega': [(0, 600_000), (1, 100_000)]}, redact=True)
+        src = issuance.IssuanceInvestmentDataSpecific('aptera-rega')
+        self.assertEqual(src(None, 0), (-1, 1))
+        self.assertEqual(src(500_000, 1), (-1, 0))
+
+if __name__ == '__main__':
+    unittest.main()
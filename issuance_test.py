@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+import unittest
+
+import requests
+
+import issuance
+import metrics
+
+# A clock that only advances when the governor sleeps or a fake
+# request takes time.
+class FakeTime:
+    def __init__(self) -> None:
+        self.now = 1000.0
+        self.sleeps: list[float] = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, delay: float) -> None:
+        self.sleeps.append(delay)
+        self.now += delay
+
+class FakeResponse:
+    def __init__(self, status_code: int, headers: dict[str, str] | None = None) -> None:
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = headers or dict()
+
+# Replies with the given (latency, status, headers) triples in turn.
+class FakeSession:
+    def __init__(self, clock: FakeTime, replies: list[tuple[float, int, dict[str, str]]]) -> None:
+        self._clock = clock
+        self._replies = list(replies)
+        self.requests = 0
+
+    def get(self, url: str, params: dict[str, str]) -> FakeResponse:
+        self.requests += 1
+        latency, status, headers = self._replies.pop(0)
+        self._clock.now += latency
+        return FakeResponse(status, headers)
+
+# Raises error on every request.
+class FailingSession:
+    def __init__(self, error: BaseException) -> None:
+        self._error = error
+
+    def get(self, url: str, params: dict[str, str]) -> FakeResponse:
+        raise self._error
+
+class TestRequestGovernor(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime()
+        real_time = issuance.time
+        issuance.time = self.clock
+        self.addCleanup(setattr, issuance, 'time', real_time)
+
+    def get(self, governor, replies):
+        session = FakeSession(self.clock, replies)
+        return governor.get(session, 'http://issuance/', {'slug': 'aptera-rega'}), session
+
+    def test_aimd(self):
+        governor = issuance.RequestGovernor(initial_limit=4.0, target_latency=1.0)
+        # fast replies: additive increase, by 1/limit each
+        self.get(governor, [(0.1, 200, {})])
+        self.assertAlmostEqual(governor.limit(), 4.25)
+        for _ in range(20):
+            self.get(governor, [(0.1, 200, {})])
+        self.assertGreater(governor.limit(), 7.0)
+        self.assertEqual(governor.in_flight(), 0)
+
+        # slow reply: gentle decrease
+        limit = governor.limit()
+        self.get(governor, [(2.0, 200, {})])
+        self.assertAlmostEqual(governor.limit(), limit * 0.9)
+
+        # throttled: halved, then increased again by the fast retry
+        limit = governor.limit()
+        self.get(governor, [(0.1, 429, {}), (0.1, 200, {})])
+        self.assertAlmostEqual(governor.limit(), limit / 2 + 2 / limit)
+        self.assertEqual(governor.retries(), 1)
+
+    def test_min_max_limit(self):
+        governor = issuance.RequestGovernor(initial_limit=2.0, min_limit=1.5, max_limit=2.2,
+                                            base_backoff=0.0)
+        self.get(governor, [(0.1, 503, {}), (0.1, 503, {}), (0.1, 200, {})])
+        self.assertAlmostEqual(governor.limit(), 1.5 + 1 / 1.5)
+        for _ in range(5):
+            self.get(governor, [(0.1, 200, {})])
+        self.assertAlmostEqual(governor.limit(), 2.2)
+
+    def test_retry_after(self):
+        governor = issuance.RequestGovernor(base_backoff=1.0, max_backoff=60.0)
+        data, session = self.get(governor, [(0.1, 429, {'Retry-After': '7'}),
+                                            (0.1, 503, {'Retry-After': '120'}),
+                                            (0.1, 200, {})])
+        self.assertEqual(data.status_code, 200)
+        self.assertEqual(session.requests, 3)
+        # Retry-After is honored, up to max_backoff
+        self.assertEqual(self.clock.sleeps, [7.0, 60.0])
+
+        # an HTTP date falls back to jittered exponential backoff
+        self.clock.sleeps = []
+        self.get(governor, [(0.1, 429, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}),
+                            (0.1, 429, {}), (0.1, 200, {})])
+        self.assertEqual(len(self.clock.sleeps), 2)
+        self.assertTrue(0.5 <= self.clock.sleeps[0] <= 1.0)
+        self.assertTrue(1.0 <= self.clock.sleeps[1] <= 2.0)
+
+    def test_give_up(self):
+        query_metrics = metrics.QueryMetrics()
+        governor = issuance.RequestGovernor(max_retries=3, base_backoff=0.5,
+                                            query_metrics=query_metrics)
+        with self.assertRaises(IOError):
+            self.get(governor, [(0.1, 500, {})] * 4)
+        self.assertEqual(len(self.clock.sleeps), 3)
+        self.assertEqual(governor.retries(), 3)
+        self.assertEqual(query_metrics.report()['slugs']['aptera-rega']['retries'], 3)
+        self.assertEqual(governor.in_flight(), 0)
+
+        # other errors are not retried
+        with self.assertRaises(IOError):
+            self.get(governor, [(0.1, 404, {})])
+        self.assertEqual(governor.retries(), 3)
+
+    def test_unexpected_error(self):
+        governor = issuance.RequestGovernor(initial_limit=1.0)
+        for error in [requests.TooManyRedirects('redirects'), KeyboardInterrupt()]:
+            with self.assertRaises(type(error)):
+                governor.get(FailingSession(error), 'http://issuance/', {})
+            # the slot is given back, so the next request does not block
+            self.assertEqual(governor.in_flight(), 0)
+        self.assertEqual(self.get(governor, [(0.1, 200, {})])[0].status_code, 200)
+
+    def test_rate(self):
+        governor = issuance.RequestGovernor(rate_window=10.0)
+        for _ in range(5):
+            self.get(governor, [(1.0, 200, {})])
+        self.assertAlmostEqual(governor.rate(), 0.5)
+        self.clock.now += 8.5
+        self.assertAlmostEqual(governor.rate(), 0.2)
+
+class TestGovernedGet(unittest.TestCase):
+
+    def test_ungoverned(self):
+        clock = FakeTime()
+        session = FakeSession(clock, [(0.1, 200, {}), (0.1, 429, {})])
+        self.assertEqual(issuance.governed_get(session, 'http://issuance/', {}, None).status_code, 200)
+        # without a governor, nothing is retried
+        with self.assertRaises(IOError):
+            issuance.governed_get(session, 'http://issuance/', {}, None)
+        self.assertEqual(session.requests, 2)
+
+    def test_governed(self):
+        clock = FakeTime()
+        real_time = issuance.time
+        issuance.time = clock
+        self.addCleanup(setattr, issuance, 'time', real_time)
+        session = FakeSession(clock, [(0.1, 429, {'Retry-After': '3'}), (0.1, 200, {})])
+        governor = issuance.RequestGovernor()
+        self.assertEqual(issuance.governed_get(session, 'http://issuance/', {}, governor).status_code, 200)
+        self.assertEqual(clock.sleeps, [3.0])
+
+if __name__ == '__main__':
+    unittest.main()
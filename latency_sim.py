@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+
+# An InvestmentData wrapper that charges each (uncached) query a
+# simulated latency in virtual time, so that extraction strategies can
+# be compared by projected wall-clock time without a network.
+#
+# Each thread querying through the wrapper has its own virtual clock;
+# a query issued at a thread's time t waits for one of max_in_flight
+# slots, takes the next latency, and advances the thread's clock to
+# its finish time.  A batch is issued all at once, so the clock
+# advances to the latest finish time in the batch.  A thread's clock
+# starts at the main thread's time when it first queries, since worker
+# threads (e.g., ExtractInvestment's jobs) are started by the main
+# thread after its own queries.  elapsed() is the latest of all the
+# threads' clocks, i.e., the projected wall time of the run.  Threads
+# run in real time, not in virtual time order, so a query takes the
+# free slot that was freed last (leaving the slots freed earlier to
+# threads that are behind in virtual time), or else the slot freed
+# first; each slot remembers only when it was freed last, so when many
+# threads contend for the slots the schedule is an approximation.
+#
+# Latencies come from a Latency: fixed, lognormal, or replayed in
+# order from measurements (a file of one latency in seconds per line,
+# or JSON lines with a latency field, such as a query trace).
+
+import bisect
+import json
+import math
+import random
+import threading
+from typing import Dict, List, Tuple
+
+import investment_data
+
+class Latency:
+    def __init__(self, spec: str, seed: int | None = None) -> None:
+        # 'fixed:S', 'lognormal:MEDIAN:SIGMA', 'replay:FILE', or just S
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._samples: List[float] = []
+        self._next = 0
+        fields = spec.split(':', 1)
+        self._kind = fields[0]
+        try:
+            if len(fields) == 1:
+                self._kind = 'fixed'
+                self._args = [float(fields[0])]
+            elif self._kind == 'fixed':
+                self._args = [float(fields[1])]
+            elif self._kind == 'lognormal':
+                self._args = [float(f) for f in fields[1].split(':')]
+                if len(self._args) != 2 or self._args[0] <= 0:
+                    raise ValueError(spec)
+                self._args[0] = math.log(self._args[0])
+            elif self._kind == 'replay':
+                self._samples = read_latencies(fields[1])
+                if not self._samples:
+                    raise ValueError(spec)
+            else:
+                raise ValueError(spec)
+        except ValueError:
+            raise ValueError(f'bad latency specification {spec}')
+        self.spec = spec
+
+    def __call__(self) -> float:
+        with self._lock:
+            if self._kind == 'fixed':
+                return self._args[0]
+            if self._kind == 'lognormal':
+                return self._rng.lognormvariate(self._args[0], self._args[1])
+            latency = self._samples[self._next]
+            self._next = (self._next + 1) % len(self._samples)
+            return latency
+
+def read_latencies(fn: str) -> List[float]:
+    latencies = []
+    with open(fn) as istr:
+        for line in istr:
+            line = line.strip()
+            if line == '':
+                continue
+            if line.startswith('{'):
+                record = json.loads(line)
+                if 'latency' in record:
+                    latencies.append(float(record['latency']))
+            else:
+                latencies.append(float(line))
+    return latencies
+
+class SimulatedLatencyInvestmentData(investment_data.CachingInvestmentData):
+    def __init__(self, src: investment_data.InvestmentData,
+                 latency: Latency,
+                 max_in_flight: int = 1) -> None:
+        # src should not cache; cache hits here cost no time
+        super().__init__()
+        self._src = src
+        self._latency = latency
+        self._max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # virtual times at which the slots become free, sorted
+        self._slots = [0.0] * max_in_flight
+        self._clocks: Dict[int, float] = dict()
+        self._queries = 0
+        self._busy = 0.0
+
+    def _now(self) -> float:
+        if not hasattr(self._local, 'now'):
+            with self._lock:
+                self._local.now = self._clocks.get(threading.main_thread().ident or 0, 0.0)
+        return self._local.now
+
+    def _advance(self, t: float) -> None:
+        self._local.now = t
+        with self._lock:
+            self._clocks[threading.get_ident()] = max(t, self._clocks.get(threading.get_ident(), 0.0))
+
+    # Schedule n queries issued at virtual time t; returns the time the
+    # last one finishes.
+    def _schedule(self, t: float, n: int) -> float:
+        finish = t
+        with self._lock:
+            for _ in range(n):
+                # the last slot freed by t, or else the first one freed
+                i = max(bisect.bisect_right(self._slots, t) - 1, 0)
+                free = self._slots.pop(i)
+                latency = self._latency()
+                end = max(t, free) + latency
+                bisect.insort(self._slots, end)
+                finish = max(finish, end)
+                self._queries += 1
+                self._busy += latency
+        return finish
+
+    def is_final(self, threshold: int | None, date: int) -> bool:
+        return self._src.is_final(threshold, date)
+
+    def real_work(self, threshold: int | None, date: int) -> Tuple[int, int]:
+        y = self._src(threshold, date)
+        self._advance(self._schedule(self._now(), 1))
+        return y
+
+    def real_batch(self, queries: List[Tuple[int | None, int]]) -> List[Tuple[int, int]]:
+        ys = self._src.batch(queries)
+        self._advance(self._schedule(self._now(), len(queries)))
+        return ys
+
+    # projected wall time: the latest virtual time of any thread
+    def elapsed(self) -> float:
+        with self._lock:
+            return max(self._clocks.values(), default=0.0)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            elapsed = max(self._clocks.values(), default=0.0)
+            return {
+                'queries': self._queries,
+                'elapsed': elapsed,
+                # average number of queries in flight
+                'concurrency': self._busy / elapsed if elapsed > 0 else 0.0,
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._slots = [0.0] * self._max_in_flight
+            self._clocks = dict()
+            self._queries = 0
+            self._busy = 0.0
+        self._local = threading.local()
@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+
+import os
+import random
+import tempfile
+import threading
+import unittest
+
+import latency_sim
+import synthetic_investments
+
+class TestSimulatedLatency(unittest.TestCase):
+
+    def setUp(self):
+        self.si = synthetic_investments.SyntheticInvestmentData(
+            50, 10, 100, 1000, random.Random(1).randrange)
+
+    def test_serial(self):
+        sim = latency_sim.SimulatedLatencyInvestmentData(self.si, latency_sim.Latency('fixed:0.1'))
+        for day in range(10):
+            self.assertEqual(sim(500, day), self.si(500, day))
+        self.assertAlmostEqual(sim.elapsed(), 1.0)
+
+    def test_batch(self):
+        queries = [(t, 3) for t in range(100, 1000, 100)]
+        for max_in_flight, expected in [(1, 0.9), (3, 0.3), (100, 0.1)]:
+            sim = latency_sim.SimulatedLatencyInvestmentData(
+                self.si, latency_sim.Latency('0.1'), max_in_flight)
+            self.assertEqual(sim.batch(queries), [self.si(*q) for q in queries])
+            self.assertAlmostEqual(sim.elapsed(), expected)
+
+    def test_cache_hits_are_free(self):
+        sim = latency_sim.SimulatedLatencyInvestmentData(self.si, latency_sim.Latency('0.1'))
+        sim.enable_cache()
+        sim(None, 1)
+        sim(None, 1)
+        sim.batch([(None, 1), (None, 2)])
+        self.assertAlmostEqual(sim.elapsed(), 0.2)
+        self.assertEqual(sim.stats()['queries'], 2)
+
+    def test_threads(self):
+        sim = latency_sim.SimulatedLatencyInvestmentData(self.si, latency_sim.Latency('0.1'), 4)
+        sim(None, 0)
+        def worker():
+            for day in range(10):
+                sim(500, day)
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # workers start after the main thread's query and run side by side
+        self.assertAlmostEqual(sim.elapsed(), 1.1)
+
+    def test_replay(self):
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'latencies')
+            with open(fn, 'w') as ostr:
+                ostr.write('0.5\n{"latency": 0.25}\n')
+            latency = latency_sim.Latency(f'replay:{fn}')
+        self.assertEqual([latency() for _ in range(3)], [0.5, 0.25, 0.5])
+        with self.assertRaises(ValueError):
+            latency_sim.Latency('normal:1:2')
+
+if __name__ == '__main__':
+    unittest.main()
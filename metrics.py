@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+
+# Query-level instrumentation for extraction runs.  The Issuance
+# InvestmentData sources record each real (uncached) query and its
+# latency, the request governor records retries (by the slug queried),
+# and ExtractInvestment records the wall time and number of
+# investments found for each day.  The cache statistics are added at
+# the end of a run.  The results are available as a JSON-able report
+# or in the Prometheus text exposition format.
+
+import bisect
+import threading
+from typing import Any, Dict, List, Tuple
+
+# upper bounds, in seconds
+default_latency_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+default_day_buckets = [0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0]
+
+class Histogram:
+    def __init__(self, buckets: List[float]) -> None:
+        self._buckets = sorted(buckets)
+        # the last count is for the implicit +Inf bucket
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, v: float) -> None:
+        self._counts[bisect.bisect_left(self._buckets, v)] += 1
+        self._sum += v
+        self._count += 1
+
+    # cumulative counts, as (upper bound, count) pairs
+    def cumulative(self) -> List[Tuple[float, int]]:
+        result = []
+        total = 0
+        for le, c in zip(self._buckets + [float('inf')], self._counts):
+            total += c
+            result.append((le, total))
+        return result
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            'buckets': [['+Inf' if le == float('inf') else le, c] for le, c in self.cumulative()],
+            'sum': self._sum,
+            'count': self._count,
+        }
+
+class SlugMetrics:
+    def __init__(self, latency_buckets: List[float], day_buckets: List[float]) -> None:
+        self.latency = Histogram(latency_buckets)
+        self.day_seconds = Histogram(day_buckets)
+        self.queries_per_day: Dict[int, int] = dict()
+        self.days: Dict[int, Dict[str, float]] = dict()
+        self.investments = 0
+        self.retries = 0
+        self.cache: Dict[str, int] = dict()
+
+    def queries(self) -> int:
+        return sum(self.queries_per_day.values())
+
+class QueryMetrics:
+    def __init__(self,
+                 latency_buckets: List[float] = default_latency_buckets,
+                 day_buckets: List[float] = default_day_buckets) -> None:
+        self._latency_buckets = latency_buckets
+        self._day_buckets = day_buckets
+        self._lock = threading.Lock()
+        self._slugs: Dict[str, SlugMetrics] = dict()
+
+    def _slug(self, slug: str) -> SlugMetrics:
+        # called with self._lock held
+        if slug not in self._slugs:
+            self._slugs[slug] = SlugMetrics(self._latency_buckets, self._day_buckets)
+        return self._slugs[slug]
+
+    def record_query(self, slug: str, day: int, latency: float) -> None:
+        with self._lock:
+            m = self._slug(slug)
+            m.latency.observe(latency)
+            m.queries_per_day[day] = m.queries_per_day.get(day, 0) + 1
+
+    def record_retry(self, slug: str) -> None:
+        with self._lock:
+            self._slug(slug).retries += 1
+
+    def record_day(self, slug: str, day: int, seconds: float, investments: int) -> None:
+        with self._lock:
+            m = self._slug(slug)
+            m.day_seconds.observe(seconds)
+            m.days[day] = {'seconds': seconds, 'investments': investments}
+            m.investments += investments
+
+    def set_cache_stats(self, slug: str, stats: Dict[str, int]) -> None:
+        with self._lock:
+            self._slug(slug).cache = dict(stats)
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            slugs = dict()
+            for slug, m in self._slugs.items():
+                queries = m.queries()
+                lookups = m.cache.get('hits', 0) + m.cache.get('misses', 0)
+                days = dict()
+                for day in sorted(set(m.days.keys()) | set(m.queries_per_day.keys())):
+                    d: Dict[str, float] = dict(m.days.get(day, {}))
+                    d['queries'] = m.queries_per_day.get(day, 0)
+                    days[str(day)] = d
+                slugs[slug] = {
+                    'queries': queries,
+                    'retries': m.retries,
+                    'investments': m.investments,
+                    'queries_per_investment': queries / m.investments if m.investments else None,
+                    'latency_seconds': m.latency.report(),
+                    'day_seconds': m.day_seconds.report(),
+                    'cache': m.cache,
+                    'cache_hit_ratio': m.cache.get('hits', 0) / lookups if lookups else None,
+                    'days': days,
+                }
+            return {'slugs': slugs}
+
+    def prometheus(self) -> str:
+        lines: List[str] = []
+        def header(name: str, kind: str, text: str) -> None:
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+        def histogram(name: str, slug: str, h: Histogram) -> None:
+            for le, c in h.cumulative():
+                bound = '+Inf' if le == float('inf') else f'{le:g}'
+                lines.append(f'{name}_bucket{{slug="{slug}",le="{bound}"}} {c}')
+            r = h.report()
+            lines.append(f'{name}_sum{{slug="{slug}"}} {r["sum"]:g}')
+            lines.append(f'{name}_count{{slug="{slug}"}} {r["count"]}')
+
+        with self._lock:
+            slugs = sorted(self._slugs.items())
+            header('issuance_query_latency_seconds', 'histogram',
+                   'Latency of uncached Issuance summary queries, including any retries.')
+            for slug, m in slugs:
+                histogram('issuance_query_latency_seconds', slug, m.latency)
+            header('issuance_queries_total', 'counter',
+                   'Number of uncached Issuance summary queries.')
+            for slug, m in slugs:
+                lines.append(f'issuance_queries_total{{slug="{slug}"}} {m.queries()}')
+            header('issuance_query_retries_total', 'counter',
+                   'Number of Issuance queries retried after a transient failure.')
+            for slug, m in slugs:
+                lines.append(f'issuance_query_retries_total{{slug="{slug}"}} {m.retries}')
+            header('query_cache_hits_total', 'counter', 'Query cache hits.')
+            for slug, m in slugs:
+                lines.append(f'query_cache_hits_total{{slug="{slug}"}} {m.cache.get("hits", 0)}')
+            header('query_cache_misses_total', 'counter', 'Query cache misses.')
+            for slug, m in slugs:
+                lines.append(f'query_cache_misses_total{{slug="{slug}"}} {m.cache.get("misses", 0)}')
+            header('extraction_day_seconds', 'histogram',
+                   'Wall time to extract the investments of one day.')
+            for slug, m in slugs:
+                histogram('extraction_day_seconds', slug, m.day_seconds)
+            header('extraction_investments_total', 'counter',
+                   'Number of investments extracted.')
+            for slug, m in slugs:
+                lines.append(f'extraction_investments_total{{slug="{slug}"}} {m.investments}')
+            header('extraction_queries_per_investment', 'gauge',
+                   'Uncached queries per extracted investment.')
+            for slug, m in slugs:
+                if m.investments:
+                    lines.append(f'extraction_queries_per_investment{{slug="{slug}"}} {m.queries() / m.investments:g}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+import json
+import unittest
+
+import metrics
+
+class TestHistogram(unittest.TestCase):
+
+    def test_buckets(self):
+        h = metrics.Histogram([1.0, 0.1, 0.5])
+        for v in [0.05, 0.1, 0.3, 0.7, 2.0, 3.0]:
+            h.observe(v)
+        # cumulative, and a value at a bound is in that bound's bucket
+        self.assertEqual(h.cumulative(), [(0.1, 2), (0.5, 3), (1.0, 4), (float('inf'), 6)])
+        r = h.report()
+        self.assertEqual(r['buckets'], [[0.1, 2], [0.5, 3], [1.0, 4], ['+Inf', 6]])
+        self.assertAlmostEqual(r['sum'], 6.15)
+        self.assertEqual(r['count'], 6)
+
+    def test_empty(self):
+        h = metrics.Histogram([1.0])
+        self.assertEqual(h.report(), {'buckets': [[1.0, 0], ['+Inf', 0]], 'sum': 0.0, 'count': 0})
+
+class TestQueryMetrics(unittest.TestCase):
+
+    def record(self):
+        m = metrics.QueryMetrics(latency_buckets=[0.1, 1.0], day_buckets=[1.0, 10.0])
+        m.record_query('aptera-rega', 0, 0.05)
+        m.record_query('aptera-rega', 0, 0.5)
+        m.record_query('aptera-rega', 1, 2.0)
+        m.record_retry('aptera-rega')
+        m.record_retry('aptera-rega')
+        m.record_query('aptera-regd', 0, 0.2)
+        m.record_retry('aptera-regd')
+        m.record_day('aptera-rega', 0, 0.5, 2)
+        m.record_day('aptera-rega', 1, 5.0, 1)
+        m.set_cache_stats('aptera-rega', {'hits': 3, 'misses': 3})
+        return m
+
+    def test_report(self):
+        r = json.loads(json.dumps(self.record().report()))
+        rega = r['slugs']['aptera-rega']
+        self.assertEqual(rega['queries'], 3)
+        self.assertEqual(rega['retries'], 2)
+        self.assertEqual(rega['investments'], 3)
+        self.assertEqual(rega['queries_per_investment'], 1.0)
+        self.assertEqual(rega['latency_seconds']['buckets'], [[0.1, 1], [1.0, 2], ['+Inf', 3]])
+        self.assertEqual(rega['day_seconds']['count'], 2)
+        self.assertEqual(rega['cache_hit_ratio'], 0.5)
+        self.assertEqual(rega['days'], {'0': {'seconds': 0.5, 'investments': 2, 'queries': 2},
+                                        '1': {'seconds': 5.0, 'investments': 1, 'queries': 1}})
+        regd = r['slugs']['aptera-regd']
+        self.assertEqual(regd['retries'], 1)
+        # nothing extracted, nothing looked up
+        self.assertIsNone(regd['queries_per_investment'])
+        self.assertIsNone(regd['cache_hit_ratio'])
+
+    def test_prometheus(self):
+        lines = self.record().prometheus().splitlines()
+        for line in [
+                '# HELP issuance_query_latency_seconds Latency of uncached Issuance summary queries, including any retries.',
+                '# TYPE issuance_query_latency_seconds histogram',
+                'issuance_query_latency_seconds_bucket{slug="aptera-rega",le="0.1"} 1',
+                'issuance_query_latency_seconds_bucket{slug="aptera-rega",le="1"} 2',
+                'issuance_query_latency_seconds_bucket{slug="aptera-rega",le="+Inf"} 3',
+                'issuance_query_latency_seconds_sum{slug="aptera-rega"} 2.55',
+                'issuance_query_latency_seconds_count{slug="aptera-rega"} 3',
+                'issuance_queries_total{slug="aptera-regd"} 1',
+                '# TYPE issuance_query_retries_total counter',
+                'issuance_query_retries_total{slug="aptera-rega"} 2',
+                'issuance_query_retries_total{slug="aptera-regd"} 1',
+                'query_cache_hits_total{slug="aptera-rega"} 3',
+                'extraction_day_seconds_bucket{slug="aptera-rega",le="10"} 2',
+                'extraction_investments_total{slug="aptera-rega"} 3',
+                'extraction_queries_per_investment{slug="aptera-rega"} 1']:
+            self.assertIn(line, lines)
+        # no gauge without investments
+        self.assertFalse(any(line.startswith('extraction_queries_per_investment{slug="aptera-regd"')
+                             for line in lines))
+        # every sample belongs to a declared metric family
+        families = [line.split()[2] for line in lines if line.startswith('# TYPE')]
+        for line in lines:
+            if not line.startswith('#'):
+                name = line.split('{')[0].split(' ')[0]
+                self.assertTrue(any(name == f or name in (f + '_bucket', f + '_sum', f + '_count')
+                                    for f in families), line)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,19 @@
 #!/usr/bin/python3
 
+import argparse
+import http.server
 import json
 import requests
 import sys
+import threading
+import time
+
+from typing import Any, Callable, Dict, Optional, Tuple
 
 import issuance
 
+options: Optional[argparse.Namespace] = None
+
 def fetch_and_sanitize():
     """Fetch number of priority delivery slots and strip everything
     but the number of slots taken.
@@ -14,9 +22,170 @@ def fetch_and_sanitize():
     sums = issuance.total_committed_amount_and_count_at_threshold(threshold)
     return {'total_amount_committed': { 'count': sums[1] } }
 
-def main(_):
-    response = fetch_and_sanitize()
-    print(json.dumps(response))
+class SanitizedCount:
+    """In-memory copy of the sanitized response, for serving many
+    readers from few upstream fetches.
+
+    A value younger than ttl seconds is returned as is.  An older one
+    is still returned, but the first reader to see it starts a
+    background refresh; a value older than max_stale seconds (or no
+    value at all) makes readers wait for a fresh one.  At most one
+    fetch is in progress at a time, and concurrent readers that need
+    to wait share its result, so upstream sees at most about one fetch
+    per ttl no matter how many readers there are.  When a fetch fails,
+    the last good value keeps being served until it is max_stale
+    seconds old, and the fetch is not retried for ttl seconds.
+    """
+
+    def __init__(self, fetch: Callable[[], Dict[str, Any]],
+                 ttl: float = 10.0, max_stale: float = 300.0) -> None:
+        self._fetch = fetch
+        self._ttl = ttl
+        self._max_stale = max_stale
+        self._cond = threading.Condition()
+        self._value: Dict[str, Any] | None = None
+        self._fetched_at = 0.0
+        self._fetching = False
+        self._error: Exception | None = None
+        self._retry_at = 0.0
+        self.num_fetches = 0
+
+    def _refresh(self) -> None:
+        """Run one fetch; the caller has set self._fetching."""
+        try:
+            value = self._fetch()
+            error = None
+        except Exception as e:
+            value = None
+            error = e
+        with self._cond:
+            self.num_fetches += 1
+            if value is not None:
+                self._value = value
+                self._fetched_at = time.monotonic()
+            self._error = error
+            if error is not None:
+                self._retry_at = time.monotonic() + self._ttl
+            self._fetching = False
+            self._cond.notify_all()
+        if error is not None:
+            sys.stderr.write(f'upstream fetch failed: {error}\n')
+
+    def get(self) -> Tuple[Dict[str, Any], float]:
+        """Return the response and its age in seconds.  Raises the last
+        fetch error if no usable value is available."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                age = now - self._fetched_at
+                if self._value is not None and age < self._ttl:
+                    return (self._value, age)
+                if self._value is not None and age < self._max_stale:
+                    if not self._fetching and now >= self._retry_at:
+                        self._fetching = True
+                        threading.Thread(target=self._refresh, daemon=True).start()
+                    return (self._value, age)
+                if not self._fetching:
+                    if self._error is not None and now < self._retry_at:
+                        raise self._error
+                    break
+                self._cond.wait()
+                # a failed fetch wakes its waiters with nothing usable
+                if self._error is not None and (self._value is None or
+                                                time.monotonic() - self._fetched_at >= self._max_stale):
+                    raise self._error
+            self._fetching = True
+        self._refresh()
+        with self._cond:
+            if self._error is not None:
+                raise self._error
+            assert self._value is not None
+            return (self._value, time.monotonic() - self._fetched_at)
+
+class SanitizerServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address: Tuple[str, int], count: SanitizedCount,
+                 path: str = '/', ttl: float = 10.0) -> None:
+        super().__init__(address, SanitizerHandler)
+        self.count = count
+        self.serve_path = path
+        self.ttl = ttl
+
+class SanitizerHandler(http.server.BaseHTTPRequestHandler):
+    server: SanitizerServer
+
+    def reply(self, status: int, body: Dict, headers: Optional[Dict[str, str]] = None) -> None:
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        # the banner is shown on another site
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] != self.server.serve_path:
+            self.reply(404, {'detail': 'Not found.'})
+            return
+        try:
+            value, age = self.server.count.get()
+        except Exception:
+            self.reply(502, {'detail': 'Upstream unavailable.'})
+            return
+        max_age = max(0, int(self.server.ttl - age))
+        self.reply(200, value, {'Cache-Control': f'public, max-age={max_age}'})
+
+    def log_message(self, format: str, *args) -> None:
+        if options is not None and options.verbose > 0:
+            super().log_message(format, *args)
+
+def main(argv: list[str]) -> int:
+    global options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--serve', type=bool, default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help='serve the sanitized count over HTTP instead of printing it once')
+    parser.add_argument('--host', type=str, default='localhost',
+                        help='address to listen on (--serve)')
+    parser.add_argument('--port', '-p', type=int, default=8000,
+                        help='port to listen on (--serve)')
+    parser.add_argument('--path', type=str, default='/',
+                        help='URL path to serve the count at (--serve)')
+    parser.add_argument('--ttl', type=float, default=10.0,
+                        help='seconds a fetched count is served before it is refreshed in the background (--serve)')
+    parser.add_argument('--max-stale', type=float, default=300.0,
+                        help='seconds an old count may still be served while refreshing or after upstream errors (--serve)')
+    parser.add_argument('--issuance-url', type=str, default=issuance.issuance_url,
+                        help='Issuance investment summary end point (e.g., an issuance_server stand-in)')
+    parser.add_argument('--verbose', '-v', action='count',
+                        default=0,
+                        help='increment the verbosity level by 1')
+    options = parser.parse_args(argv[1:])
+
+    issuance.verbose = options.verbose
+    issuance.issuance_url = options.issuance_url
+
+    if not options.serve:
+        response = fetch_and_sanitize()
+        print(json.dumps(response))
+        return 0
+
+    if options.ttl <= 0 or options.max_stale < options.ttl:
+        sys.stderr.write('--ttl must be positive and at most --max-stale\n')
+        return 1
+    count = SanitizedCount(fetch_and_sanitize, options.ttl, options.max_stale)
+    server = SanitizerServer((options.host, options.port), count, options.path, options.ttl)
+    sys.stderr.write(f'Serving http://{options.host}:{server.server_address[1]}{options.path}\n')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
     return 0
 
 if __name__ == '__main__':
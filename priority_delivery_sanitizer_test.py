@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+import json
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+import priority_delivery_sanitizer
+
+class SlowCount:
+    def __init__(self, delay):
+        self.delay = delay
+        self.count = 0
+        self.fail = False
+
+    def __call__(self):
+        time.sleep(self.delay)
+        if self.fail:
+            raise IOError('upstream down')
+        self.count += 1
+        return {'total_amount_committed': {'count': self.count}}
+
+class TestSanitizedCount(unittest.TestCase):
+
+    def test_coalescing(self):
+        upstream = SlowCount(0.1)
+        count = priority_delivery_sanitizer.SanitizedCount(upstream, ttl=10.0)
+        results = []
+        def reader():
+            results.append(count.get()[0])
+        threads = [threading.Thread(target=reader) for _ in range(50)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(count.num_fetches, 1)
+        self.assertEqual(len(results), 50)
+        self.assertTrue(all(r['total_amount_committed']['count'] == 1 for r in results))
+
+    def test_background_refresh(self):
+        upstream = SlowCount(0.05)
+        count = priority_delivery_sanitizer.SanitizedCount(upstream, ttl=0.1, max_stale=10.0)
+        self.assertEqual(count.get()[0]['total_amount_committed']['count'], 1)
+        time.sleep(0.15)
+        # stale: served at once while one refresh runs in the background
+        start = time.monotonic()
+        for _ in range(20):
+            self.assertEqual(count.get()[0]['total_amount_committed']['count'], 1)
+        self.assertLess(time.monotonic() - start, 0.05)
+        time.sleep(0.1)
+        self.assertEqual(count.get()[0]['total_amount_committed']['count'], 2)
+        self.assertEqual(count.num_fetches, 2)
+
+    def test_upstream_failure(self):
+        upstream = SlowCount(0.0)
+        count = priority_delivery_sanitizer.SanitizedCount(upstream, ttl=0.05, max_stale=0.3)
+        count.get()
+        upstream.fail = True
+        time.sleep(0.1)
+        # the last good value is served while it is not too stale
+        self.assertEqual(count.get()[0]['total_amount_committed']['count'], 1)
+        time.sleep(0.3)
+        with self.assertRaises(IOError):
+            count.get()
+
+class TestSanitizerServer(unittest.TestCase):
+
+    def test_serve(self):
+        upstream = SlowCount(0.0)
+        count = priority_delivery_sanitizer.SanitizedCount(upstream, ttl=10.0)
+        server = priority_delivery_sanitizer.SanitizerServer(('localhost', 0), count, '/count', 10.0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = f'http://localhost:{server.server_address[1]}'
+            for _ in range(3):
+                with urllib.request.urlopen(f'{url}/count') as reply:
+                    self.assertEqual(json.loads(reply.read()), {'total_amount_committed': {'count': 1}})
+                    self.assertTrue(reply.headers['Cache-Control'].startswith('public, max-age='))
+            self.assertEqual(count.num_fetches, 1)
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f'{url}/other')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+
+# Recording and replaying query traces, so that extraction can be
+# debugged and tuned offline against real production data and
+# latencies.
+#
+# A trace is a JSON lines file (gzip compressed if its name ends in
+# .gz), one record per real query:
+#   {"ts": 1700000000.123, "slug": "aptera-rega", "mode": "day",
+#    "threshold": 500000, "day": 12, "amount": 123400, "count": 3,
+#    "latency": 0.21}
+# threshold is null for day totals.  Queries made as part of a batch
+# carry "batch": n, and the latency of the whole batch.  The latency
+# field makes a trace usable as latency_sim replay input too.
+#
+# ReplayInvestmentData answers from a trace deterministically.  A
+# query recorded several times (e.g., because the data changed during
+# the recorded run) gets the recorded answers in order, the last one
+# repeating.  A query that was not recorded is answered if the trace
+# determines it: counts and amounts only change at investment amounts,
+# so a threshold between two recorded thresholds of the same date with
+# equal answers has that answer too.  Extraction records the
+# thresholds on both sides of every investment amount, so a trace of a
+# complete extraction answers the queries of other extraction
+# algorithms as well.  In cumulative mode this is done per day, on
+# the differences of the recorded (threshold, day) and (threshold,
+# day + 1) pairs, and the days' answers are summed.  Otherwise
+# LookupError is raised.
+
+import bisect
+import gzip
+import json
+import threading
+import time
+from typing import Any, Dict, IO, List, Tuple
+
+import investment_data
+
+def open_trace(fn: str, mode: str) -> IO[str]:
+    if fn.endswith('.gz'):
+        return gzip.open(fn, mode + 't')  # type: ignore[return-value]
+    return open(fn, mode)
+
+# Writes trace records, flushing them at least every flush_interval
+# seconds so that the trace of a run that dies is mostly there.  Use
+# it in a with statement (or call close) so that the file is closed,
+# and a .gz trace gets its trailer, however the run ends.
+class TraceWriter:
+    def __init__(self, fn: str, flush_interval: float = 5.0) -> None:
+        self._ostr = open_trace(fn, 'w')
+        self._lock = threading.Lock()
+        self._flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+
+    def __enter__(self) -> 'TraceWriter':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._ostr.write(line)
+            now = time.monotonic()
+            if now - self._last_flush >= self._flush_interval:
+                self._ostr.flush()
+                self._last_flush = now
+
+    def close(self) -> None:
+        with self._lock:
+            self._ostr.close()
+
+class RecordingInvestmentData(investment_data.CachingInvestmentData):
+    def __init__(self, src: investment_data.InvestmentData,
+                 trace: TraceWriter, slug: str, mode: str) -> None:
+        # src should not cache, so that only real queries are recorded;
+        # enable_cache caches here instead
+        super().__init__()
+        self._src = src
+        self._trace = trace
+        self._slug = slug
+        self._mode = mode
+
+    def _record(self, threshold: int | None, date: int, y: Tuple[int, int],
+                ts: float, latency: float, batch: int = 0) -> None:
+        record: Dict[str, Any] = {
+            'ts': round(ts, 3), 'slug': self._slug, 'mode': self._mode,
+            'threshold': threshold, 'day': date, 'amount': y[0], 'count': y[1],
+            'latency': round(latency, 6),
+        }
+        if batch > 0:
+            record['batch'] = batch
+        self._trace.write(record)
+
+    def is_final(self, threshold: int | None, date: int) -> bool:
+        return self._src.is_final(threshold, date)
+
+    def real_work(self, threshold: int | None, date: int) -> Tuple[int, int]:
+        ts = time.time()
+        start = time.monotonic()
+        y = self._src(threshold, date)
+        self._record(threshold, date, y, ts, time.monotonic() - start)
+        return y
+
+    def real_batch(self, queries: List[Tuple[int | None, int]]) -> List[Tuple[int, int]]:
+        ts = time.time()
+        start = time.monotonic()
+        ys = self._src.batch(queries)
+        latency = time.monotonic() - start
+        for (threshold, date), y in zip(queries, ys):
+            self._record(threshold, date, y, ts, latency, len(queries))
+        return ys
+
+# The recorded answers for one date, by threshold; threshold None (no
+# threshold) sorts as 0, since amounts are not negative.
+class _DayTrace:
+    def __init__(self) -> None:
+        self.answers: Dict[int | None, List[Tuple[int, int, float]]] = dict()
+        self.thresholds: List[int] = []
+
+    def add(self, threshold: int | None, amount: int, count: int, latency: float) -> None:
+        self.answers.setdefault(threshold, []).append((amount, count, latency))
+
+    def finish(self) -> None:
+        self.thresholds = sorted(set(0 if t is None else t for t in self.answers))
+
+    def final(self, t: int) -> Tuple[int, int] | None:
+        answers = self.answers.get(t)
+        if answers is None and t == 0:
+            answers = self.answers.get(None)
+        if answers is None:
+            return None
+        return (answers[-1][0], answers[-1][1])
+
+    # the answer for an unrecorded threshold, if the trace determines it
+    def infer(self, threshold: int) -> Tuple[int, int] | None:
+        i = bisect.bisect_right(self.thresholds, threshold)
+        if i == 0:
+            return None
+        below = self.final(self.thresholds[i - 1])
+        if self.thresholds[i - 1] == threshold:
+            return below
+        if i == len(self.thresholds):
+            # nothing at or above the highest threshold with no investments
+            return below if below is not None and below[1] == 0 else None
+        above = self.final(self.thresholds[i])
+        return below if below == above else None
+
+class ReplayInvestmentData(investment_data.CachingInvestmentData):
+    def __init__(self, fn: str, slug: str, mode: str, speed: float = 0.0) -> None:
+        # mode is 'cumulative' or 'day' (day-specific queries).  speed
+        # scales the recorded latencies: 1 replays at the recorded
+        # speed, 2 twice as fast, and 0 without delays
+        super().__init__()
+        self._cumulative = mode == 'cumulative'
+        self._speed = speed
+        self._days: Dict[int, _DayTrace] = dict()
+        self._latencies: List[float] = []
+        with open_trace(fn, 'r') as istr:
+            for line in istr:
+                if line.strip() == '':
+                    continue
+                r = json.loads(line)
+                if r['slug'] != slug or r['mode'] != mode:
+                    continue
+                day = self._days.setdefault(r['day'], _DayTrace())
+                day.add(r['threshold'], r['amount'], r['count'], r['latency'])
+                self._latencies.append(r['latency'])
+        for day in self._days.values():
+            day.finish()
+        # in cumulative mode, the answers for investments made on each
+        # day, where the trace has them
+        self._daily: Dict[int, _DayTrace] = dict()
+        if self._cumulative:
+            last = self.max_day()
+            for date, day in self._days.items():
+                daily = _DayTrace()
+                following = self._days.get(date + 1)
+                for t in day.answers:
+                    y = day.final(0 if t is None else t)
+                    assert y is not None
+                    if date < last:
+                        if following is None:
+                            continue
+                        z = following.final(0 if t is None else t)
+                        if z is None:
+                            continue
+                        amount = -1 if y[0] == -1 or z[0] == -1 else y[0] - z[0]
+                        y = (amount, y[1] - z[1])
+                    daily.add(t, y[0], y[1], 0.0)
+                daily.finish()
+                self._daily[date] = daily
+        self._lock = threading.Lock()
+        # number of times each recorded query has been replayed
+        self._replays: Dict[Tuple[int | None, int], int] = dict()
+        self._next_latency = 0
+
+    # the latest day in the trace, i.e., the recorded run's today
+    def max_day(self) -> int:
+        return max(self._days.keys(), default=-1)
+
+    def _infer(self, threshold: int, date: int) -> Tuple[int, int] | None:
+        if not self._days:
+            return None
+        if not self._cumulative:
+            day = self._days.get(date)
+            return None if day is None else day.infer(threshold)
+        amount = 0
+        count = 0
+        for d in range(max(date, 0), self.max_day() + 1):
+            daily = self._daily.get(d)
+            y = None if daily is None else daily.infer(threshold)
+            if y is None:
+                return None
+            amount = -1 if amount == -1 or y[0] == -1 else amount + y[0]
+            count += y[1]
+        return (amount, count)
+
+    def _answer(self, threshold: int | None, date: int) -> Tuple[Tuple[int, int], float]:
+        day = self._days.get(date)
+        if day is not None:
+            with self._lock:
+                answers = day.answers.get(threshold)
+                if answers is not None:
+                    n = self._replays.get((threshold, date), 0)
+                    self._replays[(threshold, date)] = n + 1
+                    amount, count, latency = answers[min(n, len(answers) - 1)]
+                    return ((amount, count), latency)
+        y = self._infer(0 if threshold is None else threshold, date)
+        if y is None:
+            raise LookupError(f'query ({threshold}, {date}) is not determined by the trace')
+        with self._lock:
+            latency = self._latencies[self._next_latency % len(self._latencies)]
+            self._next_latency += 1
+        return (y, latency)
+
+    def real_work(self, threshold: int | None, date: int) -> Tuple[int, int]:
+        y, latency = self._answer(threshold, date)
+        if self._speed > 0:
+            time.sleep(latency / self._speed)
+        return y
+
+    def real_batch(self, queries: List[Tuple[int | None, int]]) -> List[Tuple[int, int]]:
+        # a batch takes as long as its slowest query
+        results = []
+        slowest = 0.0
+        for threshold, date in queries:
+            y, latency = self._answer(threshold, date)
+            slowest = max(slowest, latency)
+            results.append(y)
+        if self._speed > 0:
+            time.sleep(slowest / self._speed)
+        return results
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+import json
+import os
+import random
+import tempfile
+import time
+import unittest
+
+import extract_investments
+import query_trace
+import synthetic_investments
+
+class TestQueryTrace(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def record(self, fn, si, num_days, **kwargs):
+        with query_trace.TraceWriter(fn) as trace:
+            src = query_trace.RecordingInvestmentData(si, trace, 'aptera-rega', 'cumulative')
+            src.enable_cache()
+            return extract_investments.ExtractInvestment(
+                src, num_days, 500, 10_000, **kwargs).fast_extraction()
+
+    def test_trace_writer(self):
+        fn = os.path.join(self._dir.name, 'trace.jsonl')
+        record = {'slug': 'aptera-rega', 'mode': 'day', 'threshold': None, 'day': 0,
+                  'amount': 0, 'count': 0, 'latency': 0.1}
+        # flushed as it goes, before the run ends
+        trace = query_trace.TraceWriter(fn, flush_interval=0.0)
+        trace.write(record)
+        with open(fn) as istr:
+            self.assertEqual([json.loads(line) for line in istr], [record])
+        trace.close()
+
+        # closed when the run fails, with every record in it
+        fn = os.path.join(self._dir.name, 'trace.jsonl.gz')
+        with self.assertRaises(RuntimeError):
+            with query_trace.TraceWriter(fn) as trace:
+                trace.write(record)
+                raise RuntimeError('extraction failed')
+        with query_trace.open_trace(fn, 'r') as istr:
+            self.assertEqual([json.loads(line) for line in istr], [record])
+
+    def test_record_replay(self):
+        num_days = 10
+        si = synthetic_investments.SyntheticInvestmentData(
+            100, num_days, 500, 10_000, random.Random(1).randrange)
+        fn = os.path.join(self._dir.name, 'trace.jsonl.gz')
+        expected = self.record(fn, si, num_days)
+        self.assertEqual(sorted(expected), sorted(si.investments()))
+
+        # replayed by other algorithms, which probe other thresholds
+        for kwargs in [dict(), dict(batched=True), dict(split_k=4), dict(use_amounts=True)]:
+            src = query_trace.ReplayInvestmentData(fn, 'aptera-rega', 'cumulative')
+            self.assertEqual(src.max_day(), num_days - 1)
+            src.enable_cache()
+            extractor = extract_investments.ExtractInvestment(
+                src, num_days, 500, 10_000, **kwargs)
+            self.assertEqual(extractor.fast_extraction(), expected, f'{kwargs}')
+        src = query_trace.ReplayInvestmentData(fn, 'aptera-rega', 'cumulative')
+        self.assertEqual(sorted(extract_investments.ExtractInvestment(
+            src, num_days, 500, 10_000).extract_investments()), sorted(expected))
+
+        # other slugs and modes are not in the trace
+        src = query_trace.ReplayInvestmentData(fn, 'aptera-regd', 'cumulative')
+        with self.assertRaises(LookupError):
+            src(None, 0)
+
+    def test_replay_in_order(self):
+        fn = os.path.join(self._dir.name, 'trace.jsonl')
+        with open(fn, 'w') as ostr:
+            for count, latency in [(1, 0.05), (2, 0.1)]:
+                ostr.write(json.dumps({'ts': 0, 'slug': 's', 'mode': 'day', 'threshold': None,
+                                       'day': 0, 'amount': count * 100, 'count': count,
+                                       'latency': latency}) + '\n')
+        src = query_trace.ReplayInvestmentData(fn, 's', 'day', speed=1.0)
+        start = time.monotonic()
+        self.assertEqual([src(None, 0) for _ in range(3)], [(100, 1), (200, 2), (200, 2)])
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+
+if __name__ == '__main__':
+    unittest.main()
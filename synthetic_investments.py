@@ -1,33 +1,125 @@
 #!/usr/bin/python3
 
+from array import array
+import bisect
 import functools
+import itertools
 import random
-from typing import Any, Callable, Dict, Tuple, Union
+import threading
+from typing import Any, Callable, Dict, List, Tuple, Union
 
 import cache
 import investment_data
 
+# Investments with the same day, as a sorted array of amounts and the
+# suffix sums sums[i] = sum(amounts[i:]), so that the count and total
+# of the amounts >= a threshold take one binary search.
+class AmountIndex:
+    def __init__(self, amounts: List[int]) -> None:
+        amounts.sort()
+        self._amounts = array('q', amounts)
+        sums = list(itertools.accumulate(reversed(amounts), initial=0))
+        sums.reverse()
+        self._sums = array('q', sums)
+
+    def query(self, threshold: int | None) -> Tuple[int, int]:
+        if threshold is None:
+            i = 0
+        else:
+            i = bisect.bisect_left(self._amounts, threshold)
+        return (self._sums[i], len(self._amounts) - i)
+
 class SyntheticInvestmentData(investment_data.InvestmentData):
+    # Queries are answered from an index, built on the first query
+    # after the investments change.  A day-specific query (investments
+    # on date) is one binary search in that day's AmountIndex, O(log
+    # n).  A cumulative query (investments on or after date) uses a
+    # Fenwick tree over the days, in reverse order, whose nodes are
+    # AmountIndexes of the investments in their day ranges, so it
+    # combines O(log days) binary searches, O(log days * log n); that
+    # index takes O(n log days) space, and is only built in cumulative
+    # mode.
     def __init__(self, num_entries: int, num_days: int,
                  min_invest: int, max_invest: int,
-                 rng: Callable[..., int]) -> None:
+                 rng: Callable[..., int],
+                 day_specific: bool = False) -> None:
         # rng should be something like random.randrange, and take one
         # or two integer arguments
         self._investments = [
             (rng(num_days),
              rng(min_invest, max_invest))
             for _ in range(num_entries)]
+        self._num_days = num_days
+        self._day_specific = day_specific
         self._num_queries = 0
+        self._lock = threading.Lock()
+        self._days: List[AmountIndex] | None = None
+        self._fenwick: List[AmountIndex] = []
+
+    def investments(self) -> List[Tuple[int, int]]:
+        return self._investments
+
+    # Replace or extend the investments, e.g., to simulate late
+    # arrivals.  The index is rebuilt on the next query.
+    def set_investments(self, investments: List[Tuple[int, int]]) -> None:
+        with self._lock:
+            self._investments = list(investments)
+            self._days = None
+
+    def add_investments(self, investments: List[Tuple[int, int]]) -> None:
+        with self._lock:
+            self._investments += investments
+            self._days = None
+
+    def _build_index(self) -> None:
+        # called with self._lock held
+        num_days = max([self._num_days] + [day + 1 for (day, _) in self._investments])
+        by_day: List[List[int]] = [[] for _ in range(num_days)]
+        for day, value in self._investments:
+            by_day[day].append(value)
+        self._days = [AmountIndex(list(amounts)) for amounts in by_day]
+        # Fenwick node j (1-based, stored at j - 1) covers the
+        # (0-based) reversed days j - lowbit(j) through j - 1, where
+        # reversed day r is day num_days - 1 - r.
+        self._fenwick = []
+        if self._day_specific:
+            return
+        for j in range(1, num_days + 1):
+            lo = j - (j & -j)
+            self._fenwick.append(AmountIndex(
+                [v for r in range(lo, j) for v in by_day[num_days - 1 - r]]))
 
     def __call__(self, threshold: int | None, date: int) -> Tuple[int, int]:
-        self._num_queries += 1
-        d = self._investments
-        if threshold is not None:
-            d = [t for t in d if t[1] >= threshold]
-        d = [t for t in d if t[0] >= date]
+        with self._lock:
+            self._num_queries += 1
+            if self._days is None:
+                self._build_index()
+            days = self._days
+            fenwick = self._fenwick
+        assert days is not None
+        if self._day_specific:
+            if date < 0 or date >= len(days):
+                return (0, 0)
+            return days[date].query(threshold)
+        # investments on days >= date are those on reversed days
+        # <= num_days - 1 - date
+        j = len(days) - max(date, 0)
+        total = 0
+        count = 0
+        while j > 0:
+            s, c = fenwick[j - 1].query(threshold)
+            total += s
+            count += c
+            j -= j & -j
+        return (total, count)
+
+    # never cached
+    def real_work(self, threshold: int | None, date: int) -> Tuple[int, int]:
+        return self(threshold, date)
 
-        dl = [t[1] for t in d]
-        return (sum(dl), len(dl))
+    def enable_cache(self, store: cache.CacheStore | None = None,
+                     max_entries: int = 0, ttl: float = 0.0) -> None:
+        return
 
     def flush_cache(self):
         return  # no-op
@@ -38,9 +130,6 @@ class SyntheticInvestmentData(investment_data.InvestmentData):
     def set_cache(self, c: Dict[Any, Any]) -> None:
         return
 
-    def enable_cache(self) -> None:
-        return
-
     def set_progress_period(self, p: int) -> None:
         return
 
@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+
+import random
+import unittest
+
+import synthetic_investments
+
+# the unindexed queries
+def scan(investments, threshold, date, day_specific):
+    d = investments
+    if threshold is not None:
+        d = [t for t in d if t[1] >= threshold]
+    if day_specific:
+        d = [t for t in d if t[0] == date]
+    else:
+        d = [t for t in d if t[0] >= date]
+    dl = [t[1] for t in d]
+    return (sum(dl), len(dl))
+
+class TestSyntheticInvestmentData(unittest.TestCase):
+
+    def test_index(self):
+        rng = random.Random(1)
+        num_days = 37
+        for day_specific in [False, True]:
+            si = synthetic_investments.SyntheticInvestmentData(
+                500, num_days, 100, 1000, rng.randrange, day_specific)
+            si.add_investments([(3, 500), (3, 500), (num_days - 1, 1000)])
+            investments = si.investments()
+            thresholds = [None, 0, 99, 100, 500, 501, 999, 1000, 1001]
+            thresholds += [rng.randrange(100, 1000) for _ in range(20)]
+            for date in range(-1, num_days + 1):
+                for threshold in thresholds:
+                    self.assertEqual(si(threshold, date),
+                                     scan(investments, threshold, date, day_specific),
+                                     f'threshold {threshold} date {date} day_specific {day_specific}')
+
+    def test_set_investments(self):
+        si = synthetic_investments.SyntheticInvestmentData(
+            10, 5, 100, 1000, random.Random(2).randrange)
+        si(None, 0)
+        si.set_investments([(0, 100), (2, 200), (7, 300)])
+        self.assertEqual(si(None, 0), (600, 3))
+        self.assertEqual(si(150, 1), (500, 2))
+        self.assertEqual(si(None, 6), (300, 1))
+
+if __name__ == '__main__':
+    unittest.main()